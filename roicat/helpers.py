@@ -19,6 +19,9 @@ import csv
 import warnings
 import time
 import datetime
+import threading
+import hashlib
+import collections
 
 import numpy as np
 import torch
@@ -592,6 +595,8 @@ class Convergence_checker_optuna:
             List to hold the best values obtained in the trials.
         best (float):
             Best value obtained among the trials. Initialized with infinity.
+        stopped (bool):
+            Whether a stopping criterion has been met.
 
     Example:
         .. highlight:: python
@@ -631,6 +636,7 @@ class Convergence_checker_optuna:
         self.value_stop = value_stop
         self.num_trial = 0
         self.verbose = verbose
+        self.stopped = False
         
     def check(
         self, 
@@ -647,7 +653,8 @@ class Convergence_checker_optuna:
             trial (optuna.trial.FrozenTrial): 
                 Optuna trial object.
         """
-        dur_first, dur_last = study.trials[0].datetime_complete, trial.datetime_complete
+        ## study.trials deep copies every trial, which is slow for long studies
+        dur_first, dur_last = study.get_trials(deepcopy=False)[0].datetime_complete, trial.datetime_complete
         if (dur_first is not None) and (dur_last is not None):
             duration = (dur_last - dur_first).total_seconds()
         else:
@@ -660,26 +667,39 @@ class Convergence_checker_optuna:
         bests_recent = np.unique(self.bests[-self.n_patience:])
         if self.best == 0:
             print(f'Stopping. Best value is 0.') if self.verbose else None
-            study.stop()
+            self._stop(study)
         elif self.num_trial > self.n_patience and ((np.abs(bests_recent.max() - bests_recent.min()) / np.abs(self.best)) < self.tol_frac):
             print(f'Stopping. Convergence reached. Best value ({self.best*10000}) over last ({self.n_patience}) trials fractionally changed less than ({self.tol_frac})') if self.verbose else None
-            study.stop()
+            self._stop(study)
         elif self.num_trial >= self.max_trials:
             print(f'Stopping. Trial number limit reached. num_trial={self.num_trial}, max_trials={self.max_trials}.') if self.verbose else None
-            study.stop()
+            self._stop(study)
         elif duration > self.max_duration:
             print(f'Stopping. Duration limit reached. study.duration={duration}, max_duration={self.max_duration}.') if self.verbose else None
-            study.stop()
+            self._stop(study)
 
         if self.value_stop is not None:
             if self.best <= self.value_stop:
                 print(f'Stopping. Best value ({self.best}) is less than or equal to value_stop ({self.value_stop}).') if self.verbose else None
-                study.stop()
+                self._stop(study)
             
         if self.verbose:
             print(f'Trial num: {self.num_trial}. Duration: {duration:.3f}s. Best value: {self.best:3e}. Current value:{trial.value:3e}') if self.verbose else None
         self.num_trial += 1
 
+    def _stop(self, study: object) -> None:
+        """
+        Flags the optimization as converged and stops the study. ``study.stop``
+        is only allowed inside ``study.optimize``. When trials are run with the
+        ask-and-tell interface instead, the caller should check
+        ``self.stopped``.
+        """
+        self.stopped = True
+        try:
+            study.stop()
+        except RuntimeError:
+            pass
+
 
 class OptunaProgressBar:
     """
@@ -768,12 +788,12 @@ class OptunaProgressBar:
         # Update progress bar
         if self._n_trials is not None:
             ## Get the current trial number
-            i_trial = len(study.trials)
+            i_trial = len(study.get_trials(deepcopy=False))
             self.bar.update(i_trial - self.bar.n)
         elif self._timeout is not None:
             # Get the total elapsed time for the study (last trial - first trial)
-            t_start = study.trials[0].datetime_start
-            t_last = study.trials[-1].datetime_complete
+            t_start = study.get_trials(deepcopy=False)[0].datetime_start
+            t_last = study.get_trials(deepcopy=False)[-1].datetime_complete
             t_last = datetime.datetime.now()
             elapsed_seconds = t_last - t_start
             self.bar.update(elapsed_seconds.total_seconds() - self.bar.n)
@@ -1222,6 +1242,160 @@ def merge_sparse_arrays(
     return s_full
 
 
+def merge_sparse_arrays_max(
+    s_lists: List[List[scipy.sparse.spmatrix]],
+    idx_list: List[np.ndarray],
+    shape_full: Tuple[int, int],
+) -> List[scipy.sparse.csr_matrix]:
+    """
+    Merges several sets of square sparse arrays (e.g. per-block similarity
+    matrices) into full sized sparse arrays, taking the maximum value where
+    entries from different sets overlap. All arrays within a set are assumed to
+    share the sparsity pattern of the first array in the set. The (row, col,
+    value) triples of all sets are concatenated, sorted once with a lexsort,
+    and max-reduced, so the outputs share the same index structure. Explicitly
+    stored zeros are kept.
+
+    Args:
+        s_lists (List[List[scipy.sparse.spmatrix]]):
+            List of sets of sparse arrays to merge. Each set is a list of
+            arrays with the same shape *(len(idx), len(idx))*, such as
+            ``[s_sf, s_NN, s_SWT, s_sesh]`` for one block. Entries of the
+            other arrays outside the pattern of the first array are ignored.
+        idx_list (List[np.ndarray]):
+            List of integer arrays, one per set, containing the row/column
+            indices in the full array of each row/column of the set's arrays.
+        shape_full (Tuple[int, int]):
+            Shape of the full arrays.
+
+    Returns:
+        (List[scipy.sparse.csr_matrix]):
+            s_full (List[scipy.sparse.csr_matrix]):
+                One merged array per position in each set. All arrays have
+                identical ``indptr`` and ``indices`` (but do not share memory).
+    """
+    def values_at(s, ref):
+        s = s.tocsr()
+        s.sort_indices()
+        if np.array_equal(s.indptr, ref.indptr) and np.array_equal(s.indices, ref.indices):
+            return s.data
+        r = np.repeat(np.arange(ref.shape[0]), np.diff(ref.indptr))
+        return np.asarray(s[r, ref.indices]).reshape(-1)
+
+    n_arrays = len(s_lists[0]) if len(s_lists) > 0 else 0
+    rows, cols, vals = [], [], [[] for _ in range(n_arrays)]
+    for s_set, idx in zip(s_lists, idx_list):
+        idx = np.asarray(idx, dtype=np.int64)
+        ref = s_set[0].tocsr()
+        ref.sort_indices()
+        rows.append(idx[np.repeat(np.arange(ref.shape[0]), np.diff(ref.indptr))])
+        cols.append(idx[ref.indices])
+        [v.append(values_at(s, ref)) for v, s in zip(vals, s_set)]
+
+    if len(rows) == 0:
+        return [scipy.sparse.csr_matrix(shape_full) for _ in range(n_arrays)]
+
+    row, col = np.concatenate(rows), np.concatenate(cols)
+    order = np.lexsort((col, row))
+    row, col = row[order], col[order]
+
+    ## find the first element of each unique (row, col) pair
+    bool_first = np.ones(len(row), dtype=np.bool_)
+    bool_first[1:] = (row[1:] != row[:-1]) | (col[1:] != col[:-1])
+    idx_first = np.where(bool_first)[0]
+
+    row_u, col_u = row[idx_first], col[idx_first]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(row_u, minlength=shape_full[0])))).astype(np.int64)
+
+    s_full = []
+    for v in vals:
+        v = np.concatenate(v)[order]
+        data = np.maximum.reduceat(v, idx_first) if len(v) > 0 else v
+        s_full.append(scipy.sparse.csr_matrix((data, col_u.copy(), indptr.copy()), shape=shape_full))
+    return s_full
+
+
+def check_same_sparsity_pattern(
+    a: scipy.sparse.spmatrix,
+    b: scipy.sparse.spmatrix,
+) -> bool:
+    """
+    Checks whether two CSR/CSC matrices store entries at exactly the same
+    positions in the same order (identical ``indptr`` and ``indices``). In that
+    case, elementwise operations between them can be done directly on their
+    ``.data`` arrays.
+
+    Args:
+        a (scipy.sparse.spmatrix):
+            First sparse matrix.
+        b (scipy.sparse.spmatrix):
+            Second sparse matrix.
+
+    Returns:
+        (bool): 
+            same (bool):
+                ``True`` if the matrices have the same format, shape, and
+                index arrays.
+    """
+    if not (scipy.sparse.issparse(a) and scipy.sparse.issparse(b)):
+        return False
+    if (a.format != b.format) or (a.format not in ['csr', 'csc']):
+        return False
+    if (a.shape != b.shape) or (a.nnz != b.nnz):
+        return False
+    ## Matrices that are views onto the same index arrays need no comparison
+    if (a.indptr.ctypes.data == b.indptr.ctypes.data) and (a.indices.ctypes.data == b.indices.ctypes.data):
+        return True
+    return np.array_equal(a.indptr, b.indptr) and np.array_equal(a.indices, b.indices)
+
+
+def mask_sparse_arrays_sharedPattern(
+    arrays: List[Optional[scipy.sparse.csr_matrix]],
+    mask: np.ndarray,
+    dtype: Optional[np.dtype] = np.float32,
+) -> List[Optional[scipy.sparse.csr_matrix]]:
+    """
+    Keeps only the stored entries selected by a boolean mask over the
+    ``.data`` array, for several CSR matrices that share one sparsity pattern.
+    The new ``indptr`` is computed once from the mask in O(nnz), and each
+    output gets its own copy of the index arrays. Explicitly stored zeros that
+    are selected by the mask are kept.
+
+    Args:
+        arrays (List[Optional[scipy.sparse.csr_matrix]]):
+            CSR matrices with identical ``indptr`` and ``indices`` (see
+            ``check_same_sparsity_pattern``). ``None`` entries are passed
+            through.
+        mask (np.ndarray):
+            Boolean array of shape *(nnz,)*. ``True`` for entries to keep.
+        dtype (Optional[np.dtype]):
+            Data type of the output ``.data`` arrays. If ``None``, the input
+            data type is kept. (Default is ``np.float32``)
+
+    Returns:
+        (List[Optional[scipy.sparse.csr_matrix]]): 
+            arrays_masked (List[Optional[scipy.sparse.csr_matrix]]):
+                Masked matrices, in the same order as ``arrays``.
+    """
+    arrays_valid = [a for a in arrays if a is not None]
+    if len(arrays_valid) == 0:
+        return list(arrays)
+    ref = arrays_valid[0]
+    assert all(check_same_sparsity_pattern(ref, a) for a in arrays_valid[1:]), 'All arrays must share the same sparsity pattern.'
+    mask = np.asarray(mask, dtype=bool)
+    assert mask.shape == (ref.nnz,), f'mask must have shape (nnz,) = ({ref.nnz},). Got {mask.shape}.'
+
+    ## Number of kept entries before each row boundary
+    csum = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(mask, dtype=np.int64)])
+    indptr = csum[ref.indptr].astype(ref.indptr.dtype)
+    indices = ref.indices[mask]
+
+    return [None if a is None else scipy.sparse.csr_matrix(
+        (a.data[mask].astype(dtype) if dtype is not None else a.data[mask], indices.copy(), indptr.copy()),
+        shape=ref.shape,
+    ) for a in arrays]
+
+
 def scipy_sparse_to_torch_coo(
     sp_array: scipy.sparse.coo_matrix, 
     dtype: Optional[type] = None
@@ -4253,7 +4427,10 @@ def remap_sparse_images(
     safe: bool = True,
     n_workers: int = -1,
     verbose: bool = True,
-) -> List[scipy.sparse.csr_matrix]:
+    query_local: bool = True,
+    batch_size: int = 1,
+    return_stacked: bool = False,
+) -> Union[List[scipy.sparse.csr_matrix], scipy.sparse.csr_matrix]:
     """
     Remaps a list of sparse images using the given remap field.
     RH 2023
@@ -4286,11 +4463,29 @@ def remap_sparse_images(
             available CPU cores.
         verbose (bool):
             Whether or not to use a tqdm progress bar. (Default is ``True``)
+        query_local (bool):
+            If ``True``, each image is only interpolated at the output pixels
+            whose source coordinates fall inside the bounding box of the
+            image's nonzero pixels (plus a 1 pixel margin). These are found
+            with a coarse spatial index of the remap field that is built once
+            (see ``make_remappingIdx_lookup``). Pixels outside of the bounding
+            box are outside of the convex hull, so the output is the same as
+            interpolating the full frame. Only used if ``fill_value == 0`` and
+            ``method != 'nearest'``; otherwise the full frame is interpolated.
+            (Default is ``True``)
+        batch_size (int):
+            Number of images warped per parallel task. (Default is *1*)
+        return_stacked (bool):
+            If ``True``, returns one CSR matrix with one flattened image per
+            row, built directly from the warped pixels. (Default is
+            ``False``)
 
     Returns:
-        (List[scipy.sparse.csr_matrix]): 
-            ims_sparse_out (List[scipy.sparse.csr_matrix]): 
-                A list of remapped sparse images.
+        (Union[List[scipy.sparse.csr_matrix], scipy.sparse.csr_matrix]): 
+            ims_sparse_out (Union[List[scipy.sparse.csr_matrix], scipy.sparse.csr_matrix]): 
+                A list of remapped sparse images of shape *(H, W)*. If
+                ``return_stacked`` is ``True``, a single matrix of shape
+                *(n_images, H * W)*.
 
     Raises:
         AssertionError: If the image and remappingIdx have different spatial
@@ -4309,14 +4504,23 @@ def remap_sparse_images(
     
     dtype = ims_sparse[0].dtype if dtype is None else dtype
     
-    if safe:
-        conv2d = Toeplitz_convolution2d(
-            x_shape=(dims_ims[0], dims_ims[1]),
-            k=np.array([[0   , 1e-8, 0   ],
-                        [1e-8, 1,    1e-8],
-                        [0   , 1e-8, 0   ]], dtype=dtype),
-            dtype=dtype,
-        )
+    ## The blur for degenerate images is only built if an image needs it.
+    ##  Building it is slow for large frames.
+    conv2d_cache, conv2d_lock = {}, threading.Lock()
+    def conv2d(im, batching=False):
+        with conv2d_lock:
+            if 'conv2d' not in conv2d_cache:
+                conv2d_cache['conv2d'] = Toeplitz_convolution2d(
+                    x_shape=(dims_ims[0], dims_ims[1]),
+                    k=np.array([[0   , 1e-8, 0   ],
+                                [1e-8, 1,    1e-8],
+                                [0   , 1e-8, 0   ]], dtype=dtype),
+                    dtype=dtype,
+                )
+        return conv2d_cache['conv2d'](im, batching=batching)
+
+    ## Spatial index of the source coordinates, shared by all images
+    lookup = make_remappingIdx_lookup(remappingIdx) if (query_local and (fill_value == 0) and (method != 'nearest')) else None
 
     def warp_sparse_image(
         im_sparse: scipy.sparse.csr_matrix,
@@ -4324,8 +4528,8 @@ def remap_sparse_images(
         method: str = method,
         fill_value: float = fill_value,
         safe: bool = safe
-    ) -> scipy.sparse.csr_matrix:
-        
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the flat indices (sorted) and values of the nonzero warped pixels."""
         # Convert sparse image to COO format
         im_coo = scipy.sparse.coo_matrix(im_sparse)
 
@@ -4351,26 +4555,214 @@ def remap_sparse_images(
                 # warp convolved sparse image directly without interpolation
                 return warp_sparse_image(im_sparse=conv2d(im_sparse, batching=False), remappingIdx=remappingIdx)
 
+        # Output pixels to interpolate and their source coordinates
+        if lookup is not None:
+            idx_px = query_remappingIdx_lookup(
+                lookup=lookup,
+                bounds=(rows.min() - 1, rows.max() + 1, cols.min() - 1, cols.max() + 1),
+            )
+            xi = (lookup['src_y'][idx_px], lookup['src_x'][idx_px])
+        else:
+            idx_px = None
+            xi = remappingIdx[:,:,::-1]
+
         # Get values at the grid points
         try:
             grid_values = scipy.interpolate.griddata(
                 points=(rows, cols), 
                 values=data, 
-                xi=remappingIdx[:,:,::-1], 
+                xi=xi, 
                 method=method, 
                 fill_value=fill_value,
-            )
+            ) if (idx_px is None) or (len(idx_px) > 0) else np.zeros((0,))
         except Exception as e:
             raise Exception(f"Error interpolating sparse image. Something is either weird about one of the input images or the remappingIdx. Error: {e}")
         
-        # Create a new sparse image from the nonzero pixels
-        warped_sparse_image = scipy.sparse.csr_matrix(grid_values, dtype=dtype)
-        warped_sparse_image.eliminate_zeros()
-        return warped_sparse_image
-    
-    wsi_partial = partial(warp_sparse_image, remappingIdx=remappingIdx)
-    ims_sparse_out = map_parallel(func=wsi_partial, args=[ims_sparse,], method='multithreading', n_workers=n_workers, prog_bar=verbose)
-    return ims_sparse_out
+        # Keep the nonzero pixels
+        grid_values = np.asarray(grid_values, dtype=dtype).reshape(-1)
+        isNonzero = grid_values != 0
+        idx_px = np.nonzero(isNonzero)[0] if idx_px is None else idx_px[isNonzero]
+        return idx_px, grid_values[isNonzero]
+
+    def warp_batch(ims_batch: List[scipy.sparse.csr_matrix]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [warp_sparse_image(im_sparse=im, remappingIdx=remappingIdx) for im in ims_batch]
+
+    batch_size = max(int(batch_size), 1)
+    batches = [ims_sparse[ii:ii+batch_size] for ii in range(0, len(ims_sparse), batch_size)]
+    out = map_parallel(func=warp_batch, args=[batches,], method='multithreading', n_workers=n_workers, prog_bar=verbose)
+    out = [o for out_batch in out for o in out_batch]
+
+    n_px = dims_ims[0] * dims_ims[1]
+    if return_stacked:
+        indptr = np.concatenate([[0], np.cumsum([len(idx) for idx, _ in out])]).astype(np.int64)
+        indices = np.concatenate([idx for idx, _ in out] + [np.zeros((0,), dtype=np.int64)]).astype(np.int64)
+        data = np.concatenate([vals for _, vals in out] + [np.zeros((0,), dtype=dtype)]).astype(dtype)
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(out), n_px))
+    return [
+        scipy.sparse.csr_matrix((vals, (idx // dims_ims[1], idx % dims_ims[1])), shape=dims_ims, dtype=dtype) for idx, vals in out
+    ]
+
+
+def make_remappingIdx_lookup(
+    remappingIdx: np.ndarray,
+    size_cell: int = 16,
+) -> Dict[str, Any]:
+    """
+    Makes a coarse spatial index of the source coordinates of a remap field,
+    so that the output pixels whose source coordinates fall in a box can be
+    found without scanning the whole field (see
+    ``query_remappingIdx_lookup``). Output pixels are grouped into square
+    cells of their source coordinates. Pixels with non-finite source
+    coordinates are left out.
+
+    Args:
+        remappingIdx (np.ndarray): 
+            Remap field of shape *(H, W, 2)*. ``remappingIdx[i, j]`` is the
+            source *(x, y)* coordinate of output pixel *(i, j)*.
+        size_cell (int): 
+            Side length of the cells in pixels. (Default is *16*)
+
+    Returns:
+        (Dict[str, Any]): 
+            lookup (Dict[str, Any]): 
+                The index. ``'src_y'`` and ``'src_x'`` hold the source
+                coordinates of all *H * W* output pixels (flattened).
+    """
+    src_x = np.asarray(remappingIdx[:, :, 0], dtype=np.float64).reshape(-1)
+    src_y = np.asarray(remappingIdx[:, :, 1], dtype=np.float64).reshape(-1)
+    idx_valid = np.nonzero(np.isfinite(src_x) & np.isfinite(src_y))[0]
+    if len(idx_valid) == 0:
+        cell_y0, cell_x0, n_cy, n_cx = 0, 0, 1, 1
+        key = np.zeros((0,), dtype=np.int64)
+    else:
+        cell_y, cell_x = np.floor(src_y[idx_valid] / size_cell).astype(np.int64), np.floor(src_x[idx_valid] / size_cell).astype(np.int64)
+        cell_y0, cell_x0 = cell_y.min(), cell_x.min()
+        n_cy, n_cx = cell_y.max() - cell_y0 + 1, cell_x.max() - cell_x0 + 1
+        key = (cell_y - cell_y0) * n_cx + (cell_x - cell_x0)
+    order = np.argsort(key, kind='stable')
+    return {
+        'src_y': src_y,
+        'src_x': src_x,
+        'idx_sorted': idx_valid[order],
+        'ptr': np.concatenate([[0], np.cumsum(np.bincount(key, minlength=n_cy * n_cx))]),
+        'size_cell': size_cell,
+        'cell0': (int(cell_y0), int(cell_x0)),
+        'n_cells': (int(n_cy), int(n_cx)),
+    }
+
+
+def query_remappingIdx_lookup(
+    lookup: Dict[str, Any],
+    bounds: Tuple[float, float, float, float],
+) -> np.ndarray:
+    """
+    Finds the output pixels whose source coordinates fall inside a box.
+
+    Args:
+        lookup (Dict[str, Any]): 
+            Index made by ``make_remappingIdx_lookup``.
+        bounds (Tuple[float, float, float, float]): 
+            Box in source coordinates: *(y_min, y_max, x_min, x_max)*,
+            inclusive.
+
+    Returns:
+        (np.ndarray): 
+            idx_px (np.ndarray): 
+                Sorted flat indices of the output pixels inside the box.
+    """
+    y_min, y_max, x_min, x_max = bounds
+    size_cell, (cell_y0, cell_x0), (n_cy, n_cx) = lookup['size_cell'], lookup['cell0'], lookup['n_cells']
+    cy = np.arange(max(int(np.floor(y_min / size_cell)) - cell_y0, 0), min(int(np.floor(y_max / size_cell)) - cell_y0, n_cy - 1) + 1)
+    cx_a, cx_b = max(int(np.floor(x_min / size_cell)) - cell_x0, 0), min(int(np.floor(x_max / size_cell)) - cell_x0, n_cx - 1)
+    if (len(cy) == 0) or (cx_a > cx_b):
+        return np.zeros((0,), dtype=np.int64)
+    ## Each row of cells is one contiguous slice of the sorted pixels
+    starts, ends = lookup['ptr'][cy * n_cx + cx_a], lookup['ptr'][cy * n_cx + cx_b + 1]
+    idx = np.concatenate([lookup['idx_sorted'][a:b] for a, b in zip(starts, ends)])
+    src_y, src_x = lookup['src_y'][idx], lookup['src_x'][idx]
+    return np.sort(idx[(src_y >= y_min) & (src_y <= y_max) & (src_x >= x_min) & (src_x <= x_max)])
+
+
+def make_remapping_operator(
+    remappingIdx: np.ndarray,
+    method: str = 'linear',
+    dtype: np.dtype = np.float32,
+) -> scipy.sparse.csr_matrix:
+    """
+    Compiles a remap field into a sparse linear operator, so that many images
+    can be warped with the same field using a single sparse matrix product.
+    ``operator @ image.reshape(-1)`` equals ``remap_images(image,
+    remappingIdx, interpolation_method=method, border_mode='constant',
+    border_value=0)`` up to floating point error. To warp a stack of
+    flattened images of shape *(N, H * W)*, use ``images @ operator.T``.
+
+    Args:
+        remappingIdx (np.ndarray): 
+            Remap field of shape *(H, W, 2)*. ``remappingIdx[i, j]`` is the
+            source *(x, y)* coordinate of output pixel *(i, j)*.
+        method (str): 
+            Interpolation method. Either \n
+                * ``'nearest'``: Nearest neighbor.
+                * ``'linear'``: Bilinear.
+                * ``'cubic'``: Bicubic (Keys kernel with ``a=-0.75``, same as
+                  ``cv2.remap`` and ``torch.nn.functional.grid_sample``). \n
+            (Default is ``'linear'``)
+        dtype (np.dtype): 
+            Data type of the operator. (Default is ``np.float32``)
+
+    Returns:
+        (scipy.sparse.csr_matrix): 
+            operator (scipy.sparse.csr_matrix): 
+                Operator of shape *(H * W, H * W)*. Row *i* holds the
+                interpolation weights of output pixel *i* over the input
+                pixels. Rows of output pixels with non-finite source
+                coordinates, and weights of taps that fall outside the
+                image, are empty.
+    """
+    assert remappingIdx.ndim == 3 and remappingIdx.shape[2] == 2, f"remappingIdx must be of shape (H, W, 2). Got shape {remappingIdx.shape}"
+    H, W = remappingIdx.shape[:2]
+    src_x = np.asarray(remappingIdx[:, :, 0], dtype=np.float64).reshape(-1)
+    src_y = np.asarray(remappingIdx[:, :, 1], dtype=np.float64).reshape(-1)
+    valid = np.isfinite(src_x) & np.isfinite(src_y)
+    src_x, src_y = np.where(valid, src_x, -2**20), np.where(valid, src_y, -2**20)
+
+    def _taps(s):
+        """Returns the tap offsets (shape (k,)), the first tap (shape (n,)) and the weights (shape (n, k)) along one axis."""
+        if method == 'nearest':
+            return np.array([0]), np.rint(s).astype(np.int64), np.ones((len(s), 1))
+        s0 = np.floor(s)
+        t = s - s0
+        s0 = s0.astype(np.int64)
+        if method == 'linear':
+            return np.array([0, 1]), s0, np.stack([1 - t, t], axis=1)
+        elif method == 'cubic':
+            a = -0.75
+            w_m1 = ((a * (t + 1) - 5 * a) * (t + 1) + 8 * a) * (t + 1) - 4 * a
+            w_0 = ((a + 2) * t - (a + 3)) * t * t + 1
+            w_1 = ((a + 2) * (1 - t) - (a + 3)) * (1 - t) * (1 - t) + 1
+            return np.array([-1, 0, 1, 2]), s0, np.stack([w_m1, w_0, w_1, 1 - w_m1 - w_0 - w_1], axis=1)
+        else:
+            raise ValueError(f"method must be one of 'nearest', 'linear', or 'cubic'. Got {method}")
+
+    offsets, y0, wy = _taps(src_y)
+    _, x0, wx = _taps(src_x)
+
+    ## Taps are ordered by (dy, dx), so the columns of each row come out sorted
+    cols, weights = [], []
+    for iy, dy in enumerate(offsets):
+        y = y0 + dy
+        in_y = (y >= 0) & (y < H)
+        for ix, dx in enumerate(offsets):
+            x = x0 + dx
+            cols.append(np.where(in_y & (x >= 0) & (x < W), y * W + x, -1))
+            weights.append(wy[:, iy] * wx[:, ix])
+    cols, weights = np.stack(cols, axis=1), np.stack(weights, axis=1)
+    keep = (cols >= 0) & (weights != 0) & valid[:, None]
+
+    return scipy.sparse.csr_matrix(
+        (weights[keep].astype(dtype), cols[keep].astype(np.int32), np.concatenate([[0], np.cumsum(keep.sum(1))]).astype(np.int32)),
+        shape=(H * W, H * W),
+    )
 
 
 def invert_remappingIdx(
@@ -4942,6 +5334,96 @@ def resize_images(
     return images_resized
 
 
+class SpectrumCache:
+    """
+    LRU cache of the 2D real FFTs (``torch.fft.rfft2``) of images, so that
+    images scored or correlated several times only have their spectra
+    computed once. Images are keyed by a hash of their contents along with
+    their shape, dtype, and device, so a modified or new image never reuses
+    a stale spectrum.
+
+    Args:
+        max_bytes (int):
+            Maximum total size of the cached spectra in bytes. The least
+            recently used spectra are evicted past this size. If ``0``,
+            nothing is cached. (Default is ``2**29``)
+
+    Attributes:
+        n_hits (int):
+            Number of images whose spectrum was found in the cache.
+        n_misses (int):
+            Number of images whose spectrum had to be computed.
+    """
+    def __init__(
+        self,
+        max_bytes: int = 2**29,
+    ):
+        self.max_bytes = int(max_bytes)
+        self.n_hits = 0
+        self.n_misses = 0
+        self._spectra = collections.OrderedDict()
+        self._nbytes = 0
+
+    def rfft2(
+        self,
+        images: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Returns the 2D real FFT of each image, using cached spectra where
+        possible.
+
+        Args:
+            images (torch.Tensor):
+                Real images. Shape: *(..., height, width)*
+
+        Returns:
+            (torch.Tensor):
+                spectra (torch.Tensor):
+                    Same as ``torch.fft.rfft2(images, dim=(-2, -1))``. Shape:
+                    *(..., height, width // 2 + 1)*
+        """
+        shape = images.shape
+        ims = images.reshape(-1, *shape[-2:])
+        keys = [self._make_key(im) for im in ims]
+        spectra = [self._spectra.get(key) for key in keys]
+
+        idx_missing = [ii for ii, spec in enumerate(spectra) if spec is None]
+        self.n_hits += len(keys) - len(idx_missing)
+        self.n_misses += len(idx_missing)
+        if len(idx_missing) > 0:
+            spectra_new = torch.fft.rfft2(ims[idx_missing], dim=(-2, -1))
+            for ii, spec in zip(idx_missing, spectra_new):
+                spectra[ii] = spec
+                self._add(keys[ii], spec.clone())
+        for key in keys:
+            if key in self._spectra:
+                self._spectra.move_to_end(key)
+
+        return torch.stack(spectra, dim=0).reshape(*shape[:-2], *spectra[0].shape[-2:])
+
+    def clear(self):
+        """
+        Removes all cached spectra.
+        """
+        self._spectra.clear()
+        self._nbytes = 0
+
+    def _make_key(self, image: torch.Tensor) -> Tuple:
+        arr = image.detach().cpu().contiguous().numpy()
+        return (hashlib.sha1(arr).hexdigest(), tuple(image.shape), str(image.dtype), str(image.device))
+
+    def _add(self, key: Tuple, spectrum: torch.Tensor):
+        nbytes = spectrum.element_size() * spectrum.nelement()
+        if (key in self._spectra) or (nbytes > self.max_bytes):
+            return
+        self._spectra[key] = spectrum
+        self._nbytes += nbytes
+        ## Evict least recently used spectra
+        while self._nbytes > self.max_bytes:
+            _, spec_old = self._spectra.popitem(last=False)
+            self._nbytes -= spec_old.element_size() * spec_old.nelement()
+
+
 class ImageAlignmentChecker:
     """
     Class to check the alignment of images using phase correlation.
@@ -4971,6 +5453,12 @@ class ImageAlignmentChecker:
             values higher than 5 can lead to collapse of the filter.
         device (str):
             Torch device to use for computations. (Default is 'cpu')
+        cache_fft (Union[bool, SpectrumCache]):
+            Cache of the image spectra, reused across calls of
+            ``score_alignment``. If ``True``, a new ``SpectrumCache`` is
+            made. If ``False``, nothing is cached between calls. Pass the
+            same ``SpectrumCache`` to several checkers to share it. (Default
+            is ``True``)
 
     Attributes:
         hw (Tuple[int, int]): 
@@ -4984,6 +5472,8 @@ class ImageAlignmentChecker:
             The 'in' filter used for scoring the alignment.
         filt_out (torch.Tensor):
             The 'out' filter used for scoring the alignment.
+        cache_fft (Optional[SpectrumCache]):
+            The cache of image spectra. ``None`` if caching is disabled.
     """
     def __init__(
         self,
@@ -4992,6 +5482,7 @@ class ImageAlignmentChecker:
         radius_out: Union[float, Tuple[float, float]],
         order: int = 5,
         device: str = 'cpu',
+        cache_fft: Union[bool, 'SpectrumCache'] = True,
     ):
         ## Set attributes
         ### Convert to torch.Tensor
@@ -5000,6 +5491,10 @@ class ImageAlignmentChecker:
         ### Set other attributes
         self.order = int(order)
         self.device = str(device)
+        if isinstance(cache_fft, SpectrumCache):
+            self.cache_fft = cache_fft
+        else:
+            self.cache_fft = SpectrumCache() if cache_fft else None
         ### Set filter attributes
         if isinstance(radius_in, (int, float, complex)):
             radius_in = (float(0.0), float(radius_in))
@@ -5026,11 +5521,16 @@ class ImageAlignmentChecker:
         self,
         images: Union[np.ndarray, torch.Tensor],
         images_ref: Optional[Union[np.ndarray, torch.Tensor]] = None,
+        batch_size: Optional[int] = None,
+        return_pc: bool = False,
     ):
         """
         Score the alignment of a set of images using phase correlation. Computes
         the stats of the center ('in') of the phase correlation image over the
         stats of the outer region ('out') of the phase correlation image.
+        The all-to-all comparison is done in tiles of (moving x reference)
+        pairs that are reduced to the metrics as they go, so the full stack
+        of phase correlation images is only held if ``return_pc=True``.
         RH 2024
 
         Args:
@@ -5041,10 +5541,19 @@ class ImageAlignmentChecker:
                 will be compared against these images. If not provided, the
                 images will be compared against themselves. (Default is
                 ``None``)
+            batch_size (Optional[int]):
+                Maximum number of image pairs per tile. If ``None``, it is set
+                so that each tile holds about 2**25 pixels. (Default is
+                ``None``)
+            return_pc (bool):
+                If ``True``, the phase correlation images are also returned
+                under the key ``'pc'``. Shape: *(n_images, n_images_ref,
+                height, width)*. (Default is ``False``)
 
         Returns:
             (Dict): 
-                Dictionary containing the following keys:
+                Dictionary containing the following keys. The values are
+                arrays of shape *(n_images, n_images_ref)*.
                 * 'mean_out': 
                     Mean of the phase correlation image weighted by the
                     'out' filter
@@ -5069,6 +5578,9 @@ class ImageAlignmentChecker:
                     max_diff divided by the 'std_out' value
                 * 'r_in': 
                     max_diff divided by the 'ptile95_out' value
+                * 'pc':
+                    The phase correlation images. Only returned if
+                    ``return_pc=True``.
         """
         def _fix_images(ims):
             assert isinstance(ims, (np.ndarray, torch.Tensor, list, tuple)), f'images must be np.ndarray, torch.Tensor, or a list/tuple of np.ndarray or torch.Tensor. Found type: {type(ims)}'
@@ -5090,10 +5602,57 @@ class ImageAlignmentChecker:
 
         images = _fix_images(images)
         images_ref = _fix_images(images_ref) if images_ref is not None else images
-        
-        pc = phase_correlation(images_ref[None, :, :, :], images[:, None, :, :])  ## All to all phase correlation. Shape: (n_images, n_images, height, width)
+        n_mov, n_ref = images.shape[0], images_ref.shape[0]
+
+        ## Tile the all to all comparison: up to batch_size pairs of (moving x reference) images at a time
+        batch_size = max(1, 2**25 // (self.hw[0] * self.hw[1])) if batch_size is None else int(batch_size)
+        assert batch_size > 0, f'batch_size must be a positive integer. Found: {batch_size}'
+        size_ref = min(n_ref, batch_size)
+        size_mov = max(1, batch_size // size_ref)
+
+        ## Compute the spectrum of each image only once
+        rfft2 = self.cache_fft.rfft2 if self.cache_fft is not None else partial(torch.fft.rfft2, dim=(-2, -1))
+        fft_mov = rfft2(images)
+        fft_ref = rfft2(images_ref) if images_ref is not images else fft_mov
+
+        outs = {}
+        for i_mov in range(0, n_mov, size_mov):
+            outs_row = {}
+            for i_ref in range(0, n_ref, size_ref):
+                pc = _phase_correlation_from_rfft(
+                    fft_template=fft_ref[None, i_ref:i_ref + size_ref, :, :],
+                    fft_moving=fft_mov[i_mov:i_mov + size_mov, None, :, :],
+                    hw=self.hw,
+                )  ## Shape: (size_mov, size_ref, height, width)
+                metrics = self._compute_metrics(pc)
+                if return_pc:
+                    metrics['pc'] = pc.cpu()
+                for k, val in metrics.items():
+                    outs_row.setdefault(k, []).append(val)
+            for k, val in outs_row.items():
+                outs.setdefault(k, []).append(torch.cat(val, dim=1))
+        outs = {k: torch.cat(val, dim=0).cpu().numpy() for k, val in outs.items()}
+
+        return outs
+
+    def _compute_metrics(
+        self,
+        pc: torch.Tensor,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Computes the alignment metrics from a tile of phase correlation images.
+        See ``score_alignment`` for a description of the metrics.
 
-        ## metrics
+        Args:
+            pc (torch.Tensor):
+                Phase correlation images. Shape: *(n_moving, n_ref, height,
+                width)*
+
+        Returns:
+            (Dict[str, torch.Tensor]):
+                metrics (Dict[str, torch.Tensor]):
+                    The metrics. Each of shape *(n_moving, n_ref)*.
+        """
         filt_in, filt_out = self.filt_in[None, None, :, :], self.filt_out[None, None, :, :]
         mean_out = (pc * filt_out).sum(dim=(-2, -1)) / filt_out.sum(dim=(-2, -1))
         mean_in =  (pc * filt_in).sum(dim=(-2, -1))  / filt_in.sum(dim=(-2, -1))
@@ -5106,8 +5665,7 @@ class ImageAlignmentChecker:
         z_in = max_diff / std_out
         r_in = max_diff / ptile95_out
 
-        outs = {
-            'pc': pc.cpu().numpy(),
+        return {
             'mean_out': mean_out,
             'mean_in': mean_in,
             'ptile95_out': ptile95_out,
@@ -5118,20 +5676,17 @@ class ImageAlignmentChecker:
             'z_in': z_in,  ## z-score of in value over out distribution
             'r_in': r_in,
         }
-
-        outs = {k: val.cpu().numpy() if isinstance(val, torch.Tensor) else val for k, val in outs.items()}
-        
-        return outs
     
     def __call__(
         self,
         images: Union[np.ndarray, torch.Tensor],
+        **kwargs,
     ):
         """
         Calls the `score_alignment` method. See `self.score_alignment` docstring
         for more info.
         """
-        return self.score_alignment(images)
+        return self.score_alignment(images, **kwargs)
 
 
 def make_2D_frequency_filter(
@@ -5194,6 +5749,7 @@ def phase_correlation(
     mask_fft: Optional[Union[np.ndarray, torch.Tensor]] = None,
     return_filtered_images: bool = False,
     eps: float = 1e-8,
+    cache_fft: Optional[SpectrumCache] = None,
 ) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
     """
     Perform phase correlation on two images. Calculation performed along the
@@ -5217,6 +5773,10 @@ def phase_correlation(
             ``False``)
         eps (float):
             Epsilon value to prevent division by zero. (Default is ``1e-8``)
+        cache_fft (Optional[SpectrumCache]):
+            If provided, the spectra of the input images are looked up in
+            and added to this cache. Not used for complex images or for masks
+            that are not conjugate symmetric. (Default is ``None``)
     
     Returns:
         (Tuple[np.ndarray, np.ndarray, np.ndarray]): tuple containing:
@@ -5229,35 +5789,52 @@ def phase_correlation(
                 The filtered moving image. Only returned if
                 return_filtered_images is ``True``.
     """
-    fft2, fftshift, ifft2 = torch.fft.fft2, torch.fft.fftshift, torch.fft.ifft2
+    fft2, fftshift, ifft2, irfft2 = torch.fft.fft2, torch.fft.fftshift, torch.fft.ifft2, torch.fft.irfft2
     abs, conj = torch.abs, torch.conj
     axes = (-2, -1)
 
     return_numpy = isinstance(im_template, np.ndarray)
     im_template = torch.as_tensor(im_template)
     im_moving = torch.as_tensor(im_moving)
-
-    fft_template = fft2(im_template, dim=axes)
-    fft_moving   = fft2(im_moving, dim=axes)
+    hw = tuple(im_template.shape[-2:])
 
     if mask_fft is not None:
         mask_fft = torch.as_tensor(mask_fft)
         # Normalize and shift the mask
         mask_fft = fftshift(mask_fft, dim=axes)
-        mask = mask_fft[tuple([None] * (im_template.ndim - 2) + [slice(None)] * 2)]
-        fft_template *= mask
-        fft_moving *= mask
-
-    # Compute the cross-power spectrum
-    R = fft_template * conj(fft_moving)
-
-    # Normalize to obtain the phase correlation function
-    R /= abs(R) + eps  # Add epsilon to prevent division by zero
+    ## For real images and a conjugate symmetric mask (e.g. any radial
+    ## filter of even sized images), the phase correlation is real and only
+    ## half of each spectrum is needed.
+    use_rfft = not (torch.is_complex(im_template) or torch.is_complex(im_moving))
+    if use_rfft and (mask_fft is not None):
+        use_rfft = torch.allclose(mask_fft, conj(torch.roll(torch.flip(mask_fft, dims=axes), shifts=(1, 1), dims=axes)))
+
+    if use_rfft:
+        rfft2 = cache_fft.rfft2 if cache_fft is not None else partial(torch.fft.rfft2, dim=axes)
+        fft_template = rfft2(im_template)
+        fft_moving   = rfft2(im_moving)
+        ifft = partial(irfft2, s=hw, dim=axes)
+    else:
+        fft_template = fft2(im_template, dim=axes)
+        fft_moving   = fft2(im_moving, dim=axes)
+        ifft = partial(ifft2, dim=axes)
 
-    # Compute the magnitude of the inverse FFT to ensure symmetry
-    # cc = abs(fftshift(ifft2(R, dim=axes), dim=axes))
-    # Compute the real component of the inverse FFT (not symmetric)
-    cc = fftshift(ifft2(R, dim=axes), dim=axes).real
+    if mask_fft is not None:
+        mask = mask_fft[:, :fft_template.shape[-1]]
+        mask = mask[tuple([None] * (im_template.ndim - 2) + [slice(None)] * 2)]
+        ## Not in place, so that cached spectra are not modified
+        fft_template = fft_template * mask
+        fft_moving = fft_moving * mask
+
+    if use_rfft:
+        cc = _phase_correlation_from_rfft(fft_template=fft_template, fft_moving=fft_moving, hw=hw, eps=eps)
+    else:
+        # Compute the cross-power spectrum
+        R = fft_template * conj(fft_moving)
+        # Normalize to obtain the phase correlation function
+        R /= abs(R) + eps  # Add epsilon to prevent division by zero
+        # Compute the real component of the inverse FFT (not symmetric)
+        cc = fftshift(ifft2(R, dim=axes), dim=axes).real
 
     if return_filtered_images == False:
         return cc.cpu().numpy() if return_numpy else cc
@@ -5265,11 +5842,50 @@ def phase_correlation(
         if return_numpy:
             return (
                 cc.cpu().numpy(), 
-                abs(ifft2(fft_template, dim=axes)).cpu().numpy(), 
-                abs(ifft2(fft_moving, dim=axes)).cpu().numpy()
+                abs(ifft(fft_template)).cpu().numpy(), 
+                abs(ifft(fft_moving)).cpu().numpy()
             )
         else:
-            return cc, abs(ifft2(fft_template, dim=axes)), abs(ifft2(fft_moving, dim=axes))
+            return cc, abs(ifft(fft_template)), abs(ifft(fft_moving))
+
+
+def _phase_correlation_from_rfft(
+    fft_template: torch.Tensor,
+    fft_moving: torch.Tensor,
+    hw: Tuple[int, int],
+    eps: float = 1e-8,
+) -> torch.Tensor:
+    """
+    Computes the phase correlation from the real FFTs (``torch.fft.rfft2``)
+    of the images. See ``phase_correlation``.
+
+    Args:
+        fft_template (torch.Tensor):
+            Spectra of the template images. Shape: *(..., height, width // 2
+            + 1)*
+        fft_moving (torch.Tensor):
+            Spectra of the moving images. Leading dimensions must broadcast
+            with ``fft_template``.
+        hw (Tuple[int, int]):
+            Height and width of the images.
+        eps (float):
+            Epsilon value to prevent division by zero. (Default is ``1e-8``)
+
+    Returns:
+        (torch.Tensor):
+            cc (torch.Tensor):
+                The phase correlation. Shape: *(..., height, width)*
+    """
+    # Compute the cross-power spectrum
+    R = fft_template * torch.conj(fft_moving)
+
+    # Normalize to obtain the phase correlation function
+    R /= torch.abs(R) + eps  # Add epsilon to prevent division by zero
+
+    # Compute the magnitude of the inverse FFT to ensure symmetry
+    # cc = abs(fftshift(ifft2(R, dim=axes), dim=axes))
+    # Compute the real component of the inverse FFT (not symmetric)
+    return torch.fft.fftshift(torch.fft.irfft2(R, s=tuple(hw), dim=(-2, -1)), dim=(-2, -1))
         
 
 ######################################################################################################################################
@@ -5870,6 +6486,7 @@ def compute_cluster_similarity_matrices(
     s: Union[scipy.sparse.csr_matrix, np.ndarray, sparse.COO], 
     l: np.ndarray, 
     verbose: bool = True,
+    return_sparse: bool = False,
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Computes the similarity matrices for each cluster in ``l``. This algorithm
@@ -5883,6 +6500,12 @@ def compute_cluster_similarity_matrices(
             Labels for each row of ``s``. Labels should ideally be integers.
         verbose (bool): 
             Whether to print warnings. (Default is ``True``)
+        return_sparse (bool):
+            If ``True``, ``cs_mean``, ``cs_max``, and ``cs_min`` are returned
+            as *(n_clusters, n_clusters)* ``scipy.sparse.csr_matrix`` objects
+            that only store cluster pairs with at least one entry in ``s``.
+            All other elements are 0. Use for large numbers of clusters.
+            (Default is ``False``)
 
     Returns:
         (tuple): tuple containing:
@@ -5939,50 +6562,65 @@ def compute_cluster_similarity_matrices(
             print("Warning: Similarity matrix has NaNs. Will set to 0.") if verbose else None
             ss.data[np.isnan(ss.data)] = 0
 
-    ## Make a boolean matrix for labels
-    l_bool = sparse.COO(np.stack([l_arr == u for u in l_u], axis=0))
-    samp_per_clust = l_bool.sum(1).todense()
-    n_clusters = len(samp_per_clust)
+    ## Group the stored entries by cluster pair instead of building a 4-D
+    ##  (n_clusters, n_clusters, n_samples, n_samples) array. Entry (i, j)
+    ##  belongs to element [l[j], l[i]] of the outputs. Time and memory are
+    ##  O(nnz + n_clusters) (plus the dense outputs if requested).
+    l_u, l_idx, samp_per_clust = np.unique(l_arr, return_inverse=True, return_counts=True)
+    l_idx = l_idx.reshape(-1).astype(np.int64)
+    n_clusters = len(l_u)
     n_samples = ss.shape[0]
-    
-    ## Force diagonal to be 1s
-    ss = ss.tolil()
-    ss[range(n_samples), range(n_samples)] = 1
-    ss = sparse.COO(ss)
-
-    ## Compute the similarity matrix for each pair of clusters
-    s_big_conj = ss[None,None,:,:] * l_bool[None,:,:,None] * l_bool[:,None,None,:]  ## shape: (n_clusters, n_clusters, n_samples, n_samples)
-    s_big_diag = sparse.eye(n_samples) * l_bool[None,:,:,None] * l_bool[:,None,None,:]
-
-    ## Compute the mean similarity matrix for each cluster
-    samp_per_clust_crossGrid = samp_per_clust[:,None] * samp_per_clust[None,:]  ## shape: (n_clusters, n_clusters). This is the product of the number of samples in each cluster. Will be used to divide by the sum of similarities.
-    norm_mat = samp_per_clust_crossGrid.copy()  ## above variable will be used again and this one will be mutated.
-    fixed_diag = samp_per_clust * (samp_per_clust - 1)  ## shape: (n_clusters,). For the diagonal, we need to subtract 1 from the number of samples in each cluster because samples have only 1 similarity with themselves along the diagonal.
-    norm_mat[range(n_clusters), range(n_clusters)] = fixed_diag  ## Correcting the diagonal
-    s_big_sum_raw = s_big_conj.sum(axis=(2,3)).todense()
-    s_big_sum_raw[range(n_clusters), range(n_clusters)] = s_big_sum_raw[range(n_clusters), range(n_clusters)] - samp_per_clust  ## subtract off the number of samples in each cluster from the diagonal
-    cs_mean = s_big_sum_raw / norm_mat  ## shape: (n_clusters, n_clusters). Compute mean by finding the sum of the similarities and dividing by the norm_mat.
-
-    ## Compute the min similarity matrix for each cluster
-    ### This is done in two steps:
-    #### 1. Compute the minimum similarity between each pair of clusters by inverting the similarity matrix and finding the maximum similarity between each pair of clusters.
-    #### 2. Since the first step doesn't invert any values that happen to be 0 (since they are sparse), we need to find out if there are any 0 values there are in each cluster pair, and if there then the minimum similarity between the two clusters is 0.
-    val_max = s_big_conj.max() + 1
-    cs_min = s_big_conj.copy()
-    cs_min.data = val_max - cs_min.data  ## Invert the values
-    cs_min = cs_min.max(axis=(2,3))  ## Find the max similarity
-    cs_min.data = val_max - cs_min.data  ## Invert the values back
-    cs_min.fill_value = 0.0  ## Set the fill value to 0.0 since it gets messed up by these subtraction operations
-    
-    n_missing_values = (samp_per_clust_crossGrid - (s_big_conj > 0).sum(axis=(2,3)).todense())  ## shape: (n_clusters, n_clusters). Compute the number of missing values by subtracting the number of non-zero values from the number of samples in each cluster.
-    # n_missing_values[range(len(samp_per_clust)), range(len(samp_per_clust))] = (samp_per_clust**2 - samp_per_clust) - ((s_big_conj[range(len(samp_per_clust)), range(len(samp_per_clust))] > 0).sum(axis=(1,2))).todense()  ## Correct the diagonal by subtracting the number of non-zero values from the number of samples in each cluster. This is because the diagonal is the number of samples in each cluster squared minus the number of samples in each cluster.
-    bool_nonMissing_values = (n_missing_values == 0)  ## shape: (n_clusters, n_clusters). Make a boolean matrix for where there are no missing values.
-    cs_min = cs_min.todense() * bool_nonMissing_values  ## Set the minimum similarity to 0 where there are missing values.
 
-    ## Compute the max similarity matrix for each cluster
-    cs_max = (s_big_conj - s_big_diag).max(axis=(2,3))
+    ## Force diagonal to be 1s. Explicit zeros are dropped: they do not change
+    ##  any output, and numpy's pairwise float32 sums should not depend on them.
+    ss = ss.tocoo()
+    mask_offDiag = (ss.row != ss.col) & (ss.data != 0)
+    rows = np.concatenate([ss.row[mask_offDiag], np.arange(n_samples)]).astype(np.int64)
+    cols = np.concatenate([ss.col[mask_offDiag], np.arange(n_samples)]).astype(np.int64)
+    vals = np.concatenate([ss.data[mask_offDiag], np.ones(n_samples, dtype=np.float32)])
+    vals_offDiag = np.concatenate([ss.data[mask_offDiag], np.zeros(n_samples, dtype=np.float32)])  ## diagonal excluded for the max
+
+    ## Sort entries by cluster pair (then row-major within each pair) and
+    ##  reduce each segment
+    key = l_idx[cols] * n_clusters + l_idx[rows]
+    order = np.lexsort((cols, rows, key))
+    key, vals, vals_offDiag = key[order], vals[order], vals_offDiag[order]
+    idx_starts = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+    key_u = key[idx_starts]
+    a, b = key_u // n_clusters, key_u % n_clusters  ## output row and column of each segment
+
+    seg_sum = np.add.reduceat(vals, idx_starts)
+    seg_max = np.maximum.reduceat(vals_offDiag, idx_starts).astype(np.float64)
+    seg_min = np.minimum.reduceat(vals, idx_starts)
+    seg_nPos = np.add.reduceat((vals > 0).astype(np.int64), idx_starts)
+
+    ## Mean: for the diagonal, subtract the self similarities and only count
+    ##  non-self pairs.
+    isDiag = a == b
+    seg_norm = samp_per_clust[a] * samp_per_clust[b]
+    seg_norm[isDiag] = samp_per_clust[a[isDiag]] * (samp_per_clust[a[isDiag]] - 1)
+    seg_mean = seg_sum - np.where(isDiag, samp_per_clust[a], 0)
+    ## Clusters with one sample have no non-self pairs: NaN (as 0 / 0 was before)
+    seg_mean = np.divide(seg_mean, seg_norm, out=np.full(len(seg_mean), np.nan), where=seg_norm > 0)
+
+    ## Min: 0 if any pair of samples between the two clusters is missing (sparse)
+    seg_min = seg_min * (seg_nPos == (samp_per_clust[a] * samp_per_clust[b]))
+
+    if return_sparse:
+        to_csr = lambda v: scipy.sparse.csr_matrix((v, (a, b)), shape=(n_clusters, n_clusters))
+        return l_u, to_csr(seg_mean), to_csr(seg_max), to_csr(seg_min)
+
+    def to_dense(v, fill, dtype):
+        out = np.full((n_clusters, n_clusters), fill, dtype=dtype)
+        out[a, b] = v
+        return out
+    ## Diagonal elements always have an entry (self similarity), so only
+    ##  off-diagonal elements can be missing, and their mean is 0.
+    cs_mean = to_dense(seg_mean, 0.0, np.float64)
+    cs_max = to_dense(seg_max, 0.0, np.float64)
+    cs_min = to_dense(seg_min, 0.0, np.float32)
 
-    return l_u, cs_mean, cs_max.todense(), cs_min
+    return l_u, cs_mean, cs_max, cs_min
 
 
 ######################################################################################################################################
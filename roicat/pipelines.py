@@ -228,6 +228,12 @@ def pipeline_tracking(params: dict, custom_data: data_importing.Data_roicat = No
     if params['clustering']['mixing_method'] == 'automatic':
         kwargs_makeConjunctiveDistanceMatrix_best = clusterer.find_optimal_parameters_for_pruning(
             seed=SEED,
+            fingerprint_findParameters={
+                'n_sessions': int(data.n_sessions),
+                'FOV_height': int(data.FOV_height),
+                'FOV_width': int(data.FOV_width),
+                'um_per_pixel': float(np.round(np.mean(data.um_per_pixel), 3)),
+            },
             **params['clustering']['parameters_automatic_mixing'],
         )
     elif params['clustering']['mixing_method'] == 'manual':
@@ -246,7 +252,7 @@ def pipeline_tracking(params: dict, custom_data: data_importing.Data_roicat = No
             method_out = 'hdbscan'.upper() if n_sessions >= n_sessions_switch else 'sequential_hungarian'.upper()
         else:
             method_out = method.upper()
-        assert method_out.upper() in ['hdbscan'.upper(), 'sequential_hungarian'.upper()]
+        assert method_out.upper() in ['hdbscan'.upper(), 'sequential_hungarian'.upper(), 'single_linkage'.upper()]
         return method_out
     method_clustering = choose_clustering_method(
         method=params['clustering']['cluster_method']['method'],
@@ -266,6 +272,12 @@ def pipeline_tracking(params: dict, custom_data: data_importing.Data_roicat = No
             session_bool=data.session_bool,  ## Boolean array of which ROIs belong to which sessions
             **params['clustering']['sequential_hungarian'],
         )
+    elif method_clustering == 'single_linkage'.upper():
+        labels = clusterer.fit_sessionConstrainedLinkage(
+            d_conj=clusterer.dConj_pruned,  ## Input distance matrix
+            session_bool=data.session_bool,  ## Boolean array of which ROIs belong to which sessions
+            **params['clustering']['single_linkage'],
+        )
     else:
         raise ValueError('Clustering method not recognized. This should never happen.')
 
@@ -5,6 +5,8 @@ import functools
 import PIL
 from pathlib import Path
 import math
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
 
 import numpy as np
 import scipy.optimize
@@ -106,6 +108,8 @@ class Aligner(util.ROICaT_Module):
         self.remappingIdx_nonrigid = None
 
         self._HW = None
+        ## Spectra of the FOV images, shared by the ImageAlignmentCheckers of the geometric and nonrigid steps
+        self._cache_fft = helpers.SpectrumCache()
 
     def augment_FOV_images(
         self,
@@ -254,6 +258,7 @@ class Aligner(util.ROICaT_Module):
             'max_iter': 10,
             'confidence': 0.99,
         },
+        n_workers: int = 1,
         verbose: Optional[bool] = None,
     ) -> np.ndarray:
         """
@@ -312,6 +317,12 @@ class Aligner(util.ROICaT_Module):
                   (Default is 10)
                 * 'confidence' (float): Confidence level for RANSAC. (Default is
                   0.99)
+            n_workers (int):
+                Number of processes used to register the pairs of images in
+                the all-to-all / match search step. Only used for the CPU
+                methods ('ECC_cv2', 'PhaseCorrelation', 'SIFT', 'ORB') with
+                ``device='cpu'``; other methods run serially. If ``-1``, all
+                cores are used. (Default is ``1``)
             verbose (Optional[bool]):
                 Whether to print progress updates. If ``None``, the verbose
                 level set during initialization will be used.
@@ -331,11 +342,13 @@ class Aligner(util.ROICaT_Module):
                 'method',
                 'kwargs_method',
                 'kwargs_RANSAC',
+                'n_workers',
                 'verbose',
             ],
         )
 
         verbose = verbose if verbose is not None else self._verbose
+        n_workers = mp.cpu_count() if n_workers == -1 else int(n_workers)
 
         methods_lut = {
             'RoMa': RoMa,
@@ -368,6 +381,16 @@ class Aligner(util.ROICaT_Module):
         H, W = ims_moving[0].shape
         self._HW = (H,W) if self._HW is None else self._HW
 
+        ## Extend 2x3 affine warp matrix into 3x3 homography matrix if necessary
+        def _extend_warp_matrix(warp_matrix):
+            if warp_matrix.shape == (2, 3):
+                warp_matrix = np.vstack([warp_matrix, [0, 0, 1]])
+            elif warp_matrix.shape == (3, 3):
+                pass
+            else:
+                raise ValueError(f'Unexpected warp_matrix shape: {warp_matrix.shape}')
+            return warp_matrix
+
         def _register(
             ims_moving: List[np.ndarray],
             template: Union[int, np.ndarray],
@@ -423,19 +446,34 @@ class Aligner(util.ROICaT_Module):
             elif template_method == 'image':
                 warp_matrices = warp_matrices_raw
 
-            ## Extend 2x3 affine warp matrix into 3x3 homography matrix if necessary
-            def _extend_warp_matrix(warp_matrix):
-                if warp_matrix.shape == (2, 3):
-                    warp_matrix = np.vstack([warp_matrix, [0, 0, 1]])
-                elif warp_matrix.shape == (3, 3):
-                    pass
-                else:
-                    raise ValueError(f'Unexpected warp_matrix shape: {warp_matrix.shape}')
-                return warp_matrix
             warp_matrices = [_extend_warp_matrix(warp_matrix) for warp_matrix in warp_matrices]
             warp_matrices = np.stack(warp_matrices, axis=0)  ## shape: (N, 3, 3)
 
             return warp_matrices
+
+        def _register_pairs(
+            pairs: List[Tuple[int, int]],
+        ):
+            """
+            Registers pairs of (idx_template, idx_moving) images. CPU methods are
+            fanned out to a process pool.
+            """
+            ims_cropped = [self._crop_image(im, mask_borders) for im in ims_moving]
+            use_pool = (n_workers > 1) and (len(pairs) > 1) and (method in ['ECC_cv2', 'PhaseCorrelation', 'SIFT', 'ORB']) and (str(self.device) == 'cpu')
+            if use_pool:
+                with ProcessPoolExecutor(
+                    max_workers=min(n_workers, len(pairs)),
+                    initializer=_init_pairwise_registration_worker,
+                    initargs=(methods_lut[method], kwargs_method[method], kwargs_RANSAC, ims_cropped),
+                ) as executor:
+                    warp_matrices = list(tqdm(executor.map(_register_pair, pairs, chunksize=max(1, len(pairs) // (n_workers * 4))), desc='Finding geometric registration warps', total=len(pairs), disable=not self._verbose))
+            else:
+                warp_matrices = [model.fit_rigid(
+                    im_template=ims_cropped[idx_template],
+                    im_moving=ims_cropped[idx_moving],
+                    **kwargs_RANSAC,
+                ) for idx_template, idx_moving in tqdm(pairs, desc='Finding geometric registration warps', total=len(pairs), disable=not self._verbose)]
+            return [_extend_warp_matrix(warp_matrix) for warp_matrix in warp_matrices]
         
         ## Run initial registration
         warp_matrices_all_to_template = _register(ims_moving=ims_moving, template=template, template_method=template_method)  ## shape: [(3, 3) * n_images]
@@ -453,6 +491,7 @@ class Aligner(util.ROICaT_Module):
             radius_out=self.radius_out * self.um_per_pixel,
             order=self.order,
             device=self.device,
+            cache_fft=self._cache_fft,
         )
         score_template_to_all = iac_geo.score_alignment(
             images=images_warped_all_to_template,
@@ -474,6 +513,35 @@ class Aligner(util.ROICaT_Module):
             
             if self.use_match_search or self.all_to_all:
                 print('Attempting to find best matches using match search algorithm...')
+                ## Make a function that registers, warps, and scores (idx_to, idx_from) pairs of images
+                def _update_pairs(
+                    pairs: List[Tuple[int, int]],  ## (idx_to, idx_from) pairs of images
+                    warp_matrices_all_to_all: np.ndarray,  ## shape: (N, N, 3, 3). Rows are to, columns are from
+                    alignment_all_to_all: np.ndarray,
+                    score_all_to_all: np.ndarray,
+                ):
+                    ## Pairs whose reverse is already aligned use the inverse warp. The others are registered (self pairs are already the identity)
+                    pairs_toRegister = []
+                    for idx_to, idx_from in pairs:
+                        if idx_to == idx_from:
+                            continue
+                        elif alignment_all_to_all[idx_from, idx_to] == True:
+                            warp_matrices_all_to_all[idx_to, idx_from] = np.linalg.inv(warp_matrices_all_to_all[idx_from, idx_to])
+                        else:
+                            pairs_toRegister.append((idx_to, idx_from))
+                    for (idx_to, idx_from), warp_matrix in zip(pairs_toRegister, _register_pairs(pairs=pairs_toRegister)):
+                        warp_matrices_all_to_all[idx_to, idx_from] = warp_matrix
+
+                    ## Warp and score the pairs, batched by template
+                    for idx_to in np.unique([idx_to for idx_to, _ in pairs]):
+                        idx_from = np.array([b for a, b in pairs if a == idx_to])
+                        ## warp the images
+                        remappingIdx_geo_to_current = [helpers.warp_matrix_to_remappingIdx(warp_matrix=warp_matrix, x=W, y=H) for warp_matrix in warp_matrices_all_to_all[idx_to, idx_from]]
+                        images_warped_to_current = self.transform_images(ims_moving=[ims_moving[ii] for ii in idx_from], remappingIdx=remappingIdx_geo_to_current)
+                        ## Check alignment
+                        score_all_to_all[idx_to, idx_from] = iac_geo.score_alignment(images=images_warped_to_current, images_ref=ims_moving[idx_to])['z_in'][:, 0]
+                        alignment_all_to_all[idx_to, idx_from] = score_all_to_all[idx_to, idx_from] > self.z_threshold
+
                 ## Make a function that wraps up all the above steps
                 def _update_warps(
                     idx: Union[np.ndarray, List[int]],  ## indices of images to use as templates
@@ -481,21 +549,28 @@ class Aligner(util.ROICaT_Module):
                     alignment_all_to_all: np.ndarray,
                     score_all_to_all: np.ndarray,
                 ):
-                    ## Register all ims_moving to the template (which is one of the ims_moving defined by idx_template)
+                    ## Register all ims_moving to the templates (which are the ims_moving defined by idx)
+                    ### An image is not registered to itself. Of each pair (a, b) where both
+                    ###  directions are needed, only one direction is registered at first;
+                    ###  if it is aligned, the other direction is its inverse.
+                    pairs = [(idx_current, idx_from) for idx_current in idx for idx_from in range(len(ims_moving)) if idx_from != idx_current]
+                    pairs_set = set(pairs)
+                    pairs_first = [(a, b) for a, b in pairs if (a < b) or ((b, a) not in pairs_set)]
+                    pairs_second = [(a, b) for a, b in pairs if not ((a < b) or ((b, a) not in pairs_set))]
                     for idx_current in idx:
-                        ## Run the registration algo
-                        im_current = ims_moving[idx_current]
-                        warp_matrices_all_to_all[idx_current] = (_register(ims_moving=ims_moving, template=im_current, template_method='image'))  ## returns shape: (N, 3, 3)
-                        ## Make the transpose the inverse of the warp matrices
-                        # warp_matrices_all_to_all[:, idx_current] = np.linalg.inv(warp_matrices_all_to_all[idx_current])  ## inv along last two axes
-                        ## warp the images
-                        remappingIdx_geo_all_to_current = [helpers.warp_matrix_to_remappingIdx(warp_matrix=warp_matrix, x=W, y=H) for warp_matrix in warp_matrices_all_to_all[idx_current]]
-                        images_warped_all_to_current = self.transform_images(ims_moving=ims_moving, remappingIdx=remappingIdx_geo_all_to_current)
-                        ## Check alignment
-                        score_all_to_all[idx_current] = iac_geo.score_alignment(images=images_warped_all_to_current, images_ref=im_current)['z_in'][:, 0]  ## shape: (N,)
-                        # score_all_to_all[:, idx_current] = score_all_to_all[idx_current]  ## add the transpose of the score matrix
-                        alignment_all_to_all[idx_current] = score_all_to_all[idx_current] > self.z_threshold  ## returns a boolean array of shape (n_images,)
-                        # alignment_all_to_all[:, idx_current] = alignment_all_to_all[idx_current]  ## add the transpose of the alignment matrix
+                        warp_matrices_all_to_all[idx_current, idx_current] = np.eye(3, 3)
+                    _update_pairs(
+                        pairs=[(idx_current, idx_current) for idx_current in idx] + pairs_first,
+                        warp_matrices_all_to_all=warp_matrices_all_to_all,
+                        alignment_all_to_all=alignment_all_to_all,
+                        score_all_to_all=score_all_to_all,
+                    )
+                    _update_pairs(
+                        pairs=pairs_second,
+                        warp_matrices_all_to_all=warp_matrices_all_to_all,
+                        alignment_all_to_all=alignment_all_to_all,
+                        score_all_to_all=score_all_to_all,
+                    )
                         
                     ## Recompute warp matrices based on shortest path between each image and the template (through the all_to_all alignment matrix)
                     ### Make a connection graph by appending the template alignment_matrix (1D) on top of the all_to_all alignment_matrix (N x N)
@@ -847,6 +922,7 @@ class Aligner(util.ROICaT_Module):
             radius_out=self.radius_out * self.um_per_pixel,
             order=self.order,
             device=self.device,
+            cache_fft=self._cache_fft,
         )
         score_all_to_all_final = iac_nonrigid.score_alignment(images=self.ims_registered_geo)['z_in']
         alignment_all_to_all_final = score_all_to_all_final > self.z_threshold
@@ -859,6 +935,8 @@ class Aligner(util.ROICaT_Module):
                 'score_all_to_all': score_all_to_all_final,
             },
         }
+        ## Nothing is scored after this step, so free the cached spectra
+        self._cache_fft.clear()
 
         return self.ims_registered_nonrigid
     
@@ -974,6 +1052,8 @@ class Aligner(util.ROICaT_Module):
         ROIs: np.ndarray, 
         remappingIdx: Optional[np.ndarray] = None,
         normalize: bool = True,
+        interpolation_method: str = 'griddata',
+        operators: Optional[List[scipy.sparse.csr_matrix]] = None,
     ) -> List[np.ndarray]:
         """
         Transforms ROIs based on remapping indices and normalization settings.
@@ -988,6 +1068,26 @@ class Aligner(util.ROICaT_Module):
                 ``None``)
             normalize (bool): 
                 If ``True``, data is normalized. (Default is ``True``)
+            interpolation_method (str):
+                How the ROIs are interpolated. Either \n
+                    * ``'griddata'``: Each ROI is interpolated separately with
+                      ``scipy.interpolate.griddata`` (cubic) over its own
+                      nonzero pixels. See ``helpers.remap_sparse_images``.
+                    * ``'linear'`` or ``'cubic'``: Each session's remapping
+                      is compiled into a sparse interpolation operator
+                      (bilinear or bicubic weights, see
+                      ``helpers.make_remapping_operator``) and all of its
+                      ROIs are warped with one sparse matrix product. Much
+                      faster for many ROIs, but values at the edges of ROIs
+                      differ slightly from ``'griddata'`` since the pixels
+                      around each ROI are treated as zeros. \n
+                (Default is ``'griddata'``)
+            operators (Optional[List[scipy.sparse.csr_matrix]]):
+                Operators from ``get_remapping_operators`` to reuse, one per
+                session, when ``interpolation_method`` is ``'linear'`` or
+                ``'cubic'``. If ``None``, they are built for this call only.
+                Operators are not stored on the Aligner since each is *(H *
+                W, H * W)* and would be saved with it. (Default is ``None``)
 
         Returns:
             (List[np.ndarray]): 
@@ -999,8 +1099,10 @@ class Aligner(util.ROICaT_Module):
             locals_dict=locals(),
             keys=[
                 'normalize',
+                'interpolation_method',
             ],
         )
+        assert interpolation_method in ['griddata', 'linear', 'cubic'], f"interpolation_method must be one of 'griddata', 'linear', or 'cubic'. Got {interpolation_method}"
 
         if remappingIdx is None:
             assert (self.remappingIdx_geo is not None) or (self.remappingIdx_nonrigid is not None), 'If remappingIdx is not provided, then geometric or nonrigid registration must be performed first.'
@@ -1008,19 +1110,29 @@ class Aligner(util.ROICaT_Module):
 
         H, W = remappingIdx[0].shape[:2]
 
+        if interpolation_method == 'griddata':
+            assert operators is None, "operators can only be used with interpolation_method 'linear' or 'cubic'."
+        elif operators is None:
+            operators = self.get_remapping_operators(remappingIdx=remappingIdx, method=interpolation_method)
+        assert (operators is None) or (len(operators) == len(remappingIdx)), f'operators must have one operator per session. Got {len(operators)} for {len(remappingIdx)} sessions.'
+
         print('Registering ROIs...') if self._verbose else None
         self.ROIs_aligned = []
         for ii, (remap, rois) in tqdm(enumerate(zip(remappingIdx, ROIs)), total=len(remappingIdx), mininterval=1, disable=not self._verbose, desc='Registering ROIs', position=1):
-            rois_aligned = helpers.remap_sparse_images(
-                ims_sparse=[roi.reshape((H, W)) for roi in rois],
-                remappingIdx=remap,
-                method='cubic',
-                fill_value=0,
-                dtype=np.float32,
-                safe=True,
-                verbose=False,
-            )
-            rois_aligned = scipy.sparse.vstack([roi.reshape(1, -1) for roi in rois_aligned])
+            if interpolation_method == 'griddata':
+                rois_aligned = helpers.remap_sparse_images(
+                    ims_sparse=[roi.reshape((H, W)) for roi in rois],
+                    remappingIdx=remap,
+                    method='cubic',
+                    fill_value=0,
+                    dtype=np.float32,
+                    safe=True,
+                    verbose=False,
+                    return_stacked=True,
+                )
+            else:
+                rois_aligned = (scipy.sparse.csr_matrix(rois, dtype=np.float32) @ operators[ii].T).tocsr()
+                rois_aligned.eliminate_zeros()
 
             if normalize:
                 rois_aligned.data[rois_aligned.data < 0] = 0
@@ -1039,6 +1151,50 @@ class Aligner(util.ROICaT_Module):
 
         return self.ROIs_aligned
 
+    def get_remapping_operators(
+        self,
+        remappingIdx: Optional[List[np.ndarray]] = None,
+        method: str = 'cubic',
+    ) -> List[scipy.sparse.csr_matrix]:
+        """
+        Returns a sparse interpolation operator for each session's remapping
+        (see ``helpers.make_remapping_operator``). Warping a stack of
+        flattened images of shape *(N, H * W)* is then ``images @
+        operator.T``. Sessions with identical remappings share one
+        operator. The operators are not stored on the Aligner (each is
+        *(H * W, H * W)* and would otherwise be saved with it). Pass the
+        returned list to ``transform_ROIs(operators=...)`` to reuse them.
+
+        Args:
+            remappingIdx (Optional[List[np.ndarray]]):
+                The remapping indices for each session. If ``None``, the
+                nonrigid (or, if not available, the geometric) remapping
+                indices are used. (Default is ``None``)
+            method (str):
+                Interpolation method: ``'nearest'``, ``'linear'``, or
+                ``'cubic'``. (Default is ``'cubic'``)
+
+        Returns:
+            (List[scipy.sparse.csr_matrix]):
+                operators (List[scipy.sparse.csr_matrix]):
+                    Operators of shape *(H * W, H * W)*, one per session.
+        """
+        import hashlib
+
+        if remappingIdx is None:
+            assert (self.remappingIdx_geo is not None) or (self.remappingIdx_nonrigid is not None), 'If remappingIdx is not provided, then geometric or nonrigid registration must be performed first.'
+            remappingIdx = self.remappingIdx_nonrigid if self.remappingIdx_nonrigid is not None else self.remappingIdx_geo
+
+        cache = {}
+        operators = []
+        for remap in remappingIdx:
+            remap = np.ascontiguousarray(remap, dtype=np.float32)
+            key = (method, remap.shape, hashlib.sha1(remap).hexdigest())
+            if key not in cache:
+                cache[key] = helpers.make_remapping_operator(remappingIdx=remap, method=method, dtype=np.float32)
+            operators.append(cache[key])
+        return operators
+
     def get_ROIsAligned_maxIntensityProjection(
         self, 
         H: Optional[int] = None, 
@@ -1242,6 +1398,43 @@ class Aligner(util.ROICaT_Module):
         return fig
 
 
+## Registration model and images held by each pairwise registration worker
+##  process. See _init_pairwise_registration_worker.
+_pairwise_registration_worker_data = {}
+
+def _init_pairwise_registration_worker(
+    model_class: type,
+    kwargs_model: Dict[str, Any],
+    kwargs_RANSAC: Dict[str, Any],
+    ims: List[np.ndarray],
+) -> None:
+    """
+    Initializer for the pairwise registration worker processes used by
+    ``Aligner.fit_geometric``. Builds the registration model once per process
+    (OpenCV feature detectors cannot be pickled) and keeps the images.
+    """
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+    _pairwise_registration_worker_data['model'] = model_class(device='cpu', verbose=False, **kwargs_model)
+    _pairwise_registration_worker_data['kwargs_RANSAC'] = kwargs_RANSAC
+    _pairwise_registration_worker_data['ims'] = ims
+
+def _register_pair(
+    pair: Tuple[int, int],
+) -> np.ndarray:
+    """
+    Registers the image at index ``pair[1]`` to the image at index
+    ``pair[0]`` in a pairwise registration worker process.
+    """
+    idx_template, idx_moving = pair
+    ims = _pairwise_registration_worker_data['ims']
+    return _pairwise_registration_worker_data['model'].fit_rigid(
+        im_template=ims[idx_template],
+        im_moving=ims[idx_moving],
+        **_pairwise_registration_worker_data['kwargs_RANSAC'],
+    )
+
+
 def clahe(
     im: np.ndarray, 
     grid_size: Union[int, Tuple[int, int]] = 50,
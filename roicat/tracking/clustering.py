@@ -1,10 +1,20 @@
 import warnings
+import functools
+import os
+import json
+import datetime
+import time
+import tempfile
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from typing import Union, Tuple, List, Dict, Optional, Any, Callable
 
 import numpy as np
 import scipy
 import scipy.optimize
 import scipy.sparse
+import scipy.sparse.csgraph
 import scipy.signal
 import sklearn
 import matplotlib.pyplot as plt
@@ -22,6 +32,8 @@ class Clusterer(util.ROICaT_Module):
             * self.make_pruned_similarity_graphs()
         * Clustering:
             * self.fit(): Which uses a modified HDBSCAN
+            * self.fit_sessionConstrainedLinkage(): Which uses single-linkage
+              with at most one ROI per session in each cluster.
             * self.fit_sequentialHungarian: Which uses a method similar to
               CaImAn's clustering method.
         * Quality control:
@@ -123,9 +135,17 @@ class Clusterer(util.ROICaT_Module):
         ## assert that all feature similarity matrices have the same nnz
         assert self.s_sf.nnz == self.s_NN_z.nnz == self.s_SWT_z.nnz
 
-        self.s_sesh_inv = (self.s_sf != 0).astype(np.bool_)
-        self.s_sesh_inv[self.s_sesh.astype(np.bool_)] = False
-        self.s_sesh_inv.eliminate_zeros()
+        if helpers.check_same_sparsity_pattern(self.s_sf, self.s_sesh):
+            ## Shared structure (e.g. views from ROI_graph.s_graph): build the
+            ##  intra-session mask directly on the data arrays.
+            self._mask_sesh_inv_data = (self.s_sf.data != 0) & np.logical_not(self.s_sesh.data.astype(np.bool_))
+            self.s_sesh_inv = scipy.sparse.csr_matrix((self._mask_sesh_inv_data.copy(), self.s_sf.indices.copy(), self.s_sf.indptr.copy()), shape=self.s_sf.shape)
+            self.s_sesh_inv.eliminate_zeros()
+        else:
+            self._mask_sesh_inv_data = None
+            self.s_sesh_inv = (self.s_sf != 0).astype(np.bool_)
+            self.s_sesh_inv[self.s_sesh.astype(np.bool_)] = False
+            self.s_sesh_inv.eliminate_zeros()
 
         self.s_sesh = self.s_sesh.tolil()
         self.s_sesh[range(self.s_sesh.shape[0]), range(self.s_sesh.shape[1])] = 0
@@ -156,6 +176,18 @@ class Clusterer(util.ROICaT_Module):
             'sig_SWT_kwargs_b': [0.1, 1.5],  ## Bounds for the sigmoid slope for s_SWT
         },
         n_jobs_findParameters: int = -1,
+        method_parallel_findParameters: str = 'multithreading',
+        storage_findParameters: Optional[str] = None,
+        batch_size_findParameters: int = 1,
+        n_samples_findParameters: Optional[int] = None,
+        n_verify_findParameters: int = 10,
+        tolerance_activation_findParameters: Optional[float] = None,
+        path_cache_findParameters: Optional[str] = None,
+        fingerprint_findParameters: Optional[Dict[str, Any]] = None,
+        kwargs_warmStart_findParameters: Dict[str, int] = {
+            'n_seeds': 10,
+            'n_patience': 30,
+        },
         n_bins: Optional[int] = None,
         smoothing_window_bins: Optional[int] = None,
         seed=None,
@@ -183,7 +215,70 @@ class Clusterer(util.ROICaT_Module):
                 Bounds for the parameters to be optimized.
             n_jobs_findParameters (int):
                 Number of jobs to use when finding the optimal parameters. If
-                -1, use all available cores.
+                -1, use all available cores. Only used if
+                ``batch_size_findParameters == 1``.
+            method_parallel_findParameters (str):
+                How the ``n_jobs_findParameters`` jobs are run. Either \n
+                * ``'multithreading'``: Threads inside ``study.optimize``.
+                * ``'multiprocessing'``: Worker processes that share one
+                  Optuna storage (see ``storage_findParameters``). The
+                  similarity matrices are put in shared memory once and each
+                  worker attaches to them. The convergence checker and the
+                  progress bar run in this process and follow the trials
+                  completed by all workers. \n
+                (Default is ``'multithreading'``)
+            storage_findParameters (Optional[str]):
+                Only used if ``method_parallel_findParameters ==
+                'multiprocessing'``. Either a path to an Optuna journal file
+                or a database URL (e.g. ``'sqlite:///study.db'``). If
+                ``None``, a temporary journal file is used and the study is
+                copied into memory at the end. (Default is ``None``)
+            batch_size_findParameters (int):
+                Number of candidate parameter sets evaluated per optimization
+                step. If ``1``, each trial is evaluated separately with
+                ``study.optimize``. If > 1, candidates are drawn with Optuna's
+                ask-and-tell interface and evaluated together in one
+                tensorized pass (see
+                ``self._objectiveFn_distSameMagnitude_batch``). (Default is
+                ``1``)
+            n_samples_findParameters (Optional[int]):
+                If not ``None``, the objective is evaluated on a fixed random
+                subsample of this many graph edges instead of all of them. The
+                subsample is stratified to keep the proportion of intra-session
+                and inter-session edges, and is drawn once using ``seed``.
+                Tuning time then depends on this number rather than on the
+                size of the graph. Requires the similarity matrices to share
+                one sparsity pattern. (Default is ``None``)
+            n_verify_findParameters (int):
+                Only used if ``n_samples_findParameters`` is not ``None``. The
+                best ``n_verify_findParameters`` trials on the subsample are
+                re-scored on the full data, and the best of those is returned.
+                Results are stored in ``self.verification_findParameters``.
+                (Default is ``10``)
+            tolerance_activation_findParameters (Optional[float]):
+                If not ``None``, trials evaluated with the sequential objective
+                use the lookup-table approximation of the activations and
+                p-norm with this tolerance (see ``tolerance_activation`` in
+                ``self.make_conjunctive_distance_matrix``). (Default is
+                ``None``)
+            path_cache_findParameters (Optional[str]):
+                Path to a JSON file that caches the best trials of past
+                searches, keyed by a dataset fingerprint (see
+                ``self._make_fingerprint_findParameters``). If an entry for
+                this dataset exists, its best trials are enqueued as the first
+                trials of the search (warm start). The entry is replaced by
+                the results of this search at the end. If ``None``, no cache
+                is used. (Default is ``None``)
+            fingerprint_findParameters (Optional[Dict[str, Any]]):
+                JSON-serializable descriptors of the dataset (e.g. number of
+                sessions, FOV shape, um_per_pixel) added to the fingerprint.
+                (Default is ``None``)
+            kwargs_warmStart_findParameters (Dict[str, int]):
+                Only used on a warm start. \n
+                * ``'n_seeds'``: Number of cached trials to enqueue. The TPE
+                  sampler skips its random startup trials.
+                * ``'n_patience'``: Replaces ``n_patience`` of the convergence
+                  checker if smaller.
             n_bins Optional[int]: 
                 Overwrites ``n_bins`` specified in __init__. \n
                 Number of bins to use when estimating the distributions. Using a
@@ -215,6 +310,15 @@ class Clusterer(util.ROICaT_Module):
                 'kwargs_findParameters',
                 'bounds_findParameters',
                 'n_jobs_findParameters',
+                'method_parallel_findParameters',
+                'storage_findParameters',
+                'batch_size_findParameters',
+                'n_samples_findParameters',
+                'n_verify_findParameters',
+                'tolerance_activation_findParameters',
+                'path_cache_findParameters',
+                'fingerprint_findParameters',
+                'kwargs_warmStart_findParameters',
                 'n_bins',
                 'smoothing_window_bins',
                 'seed',
@@ -229,6 +333,18 @@ class Clusterer(util.ROICaT_Module):
         self._seed = seed
         np.random.seed(self._seed)
 
+        self._tolerance_activation = tolerance_activation_findParameters
+        self._idx_findParameters = self._make_stratified_edge_subsample(n_samples=n_samples_findParameters, seed=self._seed) if n_samples_findParameters is not None else None
+
+        ## Warm start from the best trials of a past search on the same kind of dataset
+        self.fingerprint_findParameters = self._make_fingerprint_findParameters(fingerprint=fingerprint_findParameters)
+        params_warmStart = self._load_cache_findParameters(path=path_cache_findParameters, n_seeds=kwargs_warmStart_findParameters['n_seeds']) if path_cache_findParameters is not None else []
+        n_startup_trials = kwargs_findParameters['n_patience']//2
+        if len(params_warmStart) > 0:
+            print(f'Warm start: enqueued {len(params_warmStart)} cached trials from {path_cache_findParameters}') if self._verbose else None
+            n_startup_trials = len(params_warmStart)
+            kwargs_findParameters = {**kwargs_findParameters, 'n_patience': min(kwargs_findParameters['n_patience'], kwargs_warmStart_findParameters['n_patience'])}
+
         print('Finding mixing parameters using automated hyperparameter tuning...') if self._verbose else None
         optuna.logging.set_verbosity(optuna.logging.WARNING)
         self.checker = helpers.Convergence_checker_optuna(verbose=self._verbose>=2, **kwargs_findParameters)
@@ -239,19 +355,60 @@ class Clusterer(util.ROICaT_Module):
             mininterval=5.0,
         )
         self.study = optuna.create_study(direction='minimize', sampler=optuna.samplers.TPESampler(
-            n_startup_trials=kwargs_findParameters['n_patience']//2,
+            n_startup_trials=n_startup_trials,
             seed=self._seed,
+            constant_liar=batch_size_findParameters > 1,  ## Spread out candidates that are asked for before any of them are told
         ))
-        self.study.optimize(
-            func=self._objectiveFn_distSameMagnitude, 
-            n_jobs=n_jobs_findParameters, 
-            callbacks=[self.checker.check, prog_bar],
-            n_trials=kwargs_findParameters['max_trials'],
-            # show_progress_bar=self._verbose >= 1,
-            show_progress_bar=False,
-        )
-
-        self.best_params = self.study.best_params.copy()
+        assert method_parallel_findParameters in ['multithreading', 'multiprocessing'], f"method_parallel_findParameters must be one of ['multithreading', 'multiprocessing'], got {method_parallel_findParameters}"
+        ## The multiprocessing path optimizes its own study and enqueues the warm-start trials there
+        [self.study.enqueue_trial(params) for params in params_warmStart] if method_parallel_findParameters != 'multiprocessing' else None
+        if method_parallel_findParameters == 'multiprocessing':
+            assert batch_size_findParameters <= 1, 'batch_size_findParameters > 1 is not supported with multiprocessing.'
+            self.study = self._optimize_multiprocessing(
+                n_workers=mp.cpu_count() if n_jobs_findParameters == -1 else n_jobs_findParameters,
+                storage=storage_findParameters,
+                n_startup_trials=n_startup_trials,
+                max_trials=kwargs_findParameters['max_trials'],
+                params_enqueue=params_warmStart,
+                callbacks=[self.checker.check, prog_bar],
+            )
+        elif batch_size_findParameters <= 1:
+            self.study.optimize(
+                func=self._objectiveFn_distSameMagnitude, 
+                n_jobs=n_jobs_findParameters, 
+                callbacks=[self.checker.check, prog_bar],
+                n_trials=kwargs_findParameters['max_trials'],
+                # show_progress_bar=self._verbose >= 1,
+                show_progress_bar=False,
+            )
+        else:
+            n_trials_done = 0
+            while (n_trials_done < kwargs_findParameters['max_trials']) and (not self.checker.stopped):
+                n_ask = min(int(batch_size_findParameters), kwargs_findParameters['max_trials'] - n_trials_done)
+                trials = [self.study.ask() for _ in range(n_ask)]
+                losses = self._objectiveFn_distSameMagnitude_batch([self._suggest_mixing_params(trial) for trial in trials], idx_data=self._idx_findParameters)
+                for trial, loss in zip(trials, losses):
+                    trial_frozen = self.study.tell(trial, float(loss))
+                    n_trials_done += 1
+                    ## The whole batch is already evaluated, so it is always told
+                    [fn(self.study, trial_frozen) for fn in [self.checker.check, prog_bar]] if not self.checker.stopped else None
+
+        trial_best = self.study.best_trial
+        self.verification_findParameters = None
+        if self._idx_findParameters is not None:
+            ## Re-score the best trials on the full data and keep the best one
+            trials_top = sorted(self.study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)), key=lambda t: t.value)[:max(int(n_verify_findParameters), 1)]
+            losses_full = self._objectiveFn_distSameMagnitude_batch([self._suggest_mixing_params(optuna.trial.FixedTrial(t.params)) for t in trials_top], idx_data=None)
+            trial_best = trials_top[int(np.argmin(losses_full))]
+            self.verification_findParameters = {
+                'trial_numbers': [t.number for t in trials_top],
+                'losses_subsample': np.array([t.value for t in trials_top]),
+                'losses_full': losses_full,
+            }
+            print(f'Verified the best {len(trials_top)} trials on the full data. Selected trial {trial_best.number} with full-data value {losses_full.min()} (subsample value {trial_best.value})') if self._verbose else None
+        params_best = trial_best.params
+
+        self.best_params = params_best.copy()
         [self.best_params.pop(p) for p in [
             # 'sig_SF_kwargs_mu',
             # 'sig_SF_kwargs_b',
@@ -262,10 +419,10 @@ class Clusterer(util.ROICaT_Module):
         # # self.best_params['sig_SF_kwargs'] = {'mu': self.study.best_params['sig_SF_kwargs_mu'],
         # #                                 'b': self.study.best_params['sig_SF_kwargs_b'],}
         # self.best_params['sig_SF_kwargs'] = None
-        self.best_params['sig_NN_kwargs'] = {'mu': self.study.best_params['sig_NN_kwargs_mu'],
-                                        'b': self.study.best_params['sig_NN_kwargs_b'],}
-        self.best_params['sig_SWT_kwargs'] = {'mu': self.study.best_params['sig_SWT_kwargs_mu'],
-                                            'b': self.study.best_params['sig_SWT_kwargs_b'],}
+        self.best_params['sig_NN_kwargs'] = {'mu': params_best['sig_NN_kwargs_mu'],
+                                        'b': params_best['sig_NN_kwargs_b'],}
+        self.best_params['sig_SWT_kwargs'] = {'mu': params_best['sig_SWT_kwargs_mu'],
+                                            'b': params_best['sig_SWT_kwargs_b'],}
 
         self.kwargs_makeConjunctiveDistanceMatrix_best={
             'power_SF': None,
@@ -277,9 +434,121 @@ class Clusterer(util.ROICaT_Module):
             'sig_SWT_kwargs': None,
         }
         self.kwargs_makeConjunctiveDistanceMatrix_best.update(self.best_params)
-        print(f'Best value found: {self.study.best_value} with parameters {self.best_params}') if self._verbose else None
+        print(f'Best value found: {trial_best.value} with parameters {self.best_params}') if self._verbose else None
+
+        if path_cache_findParameters is not None:
+            self._save_cache_findParameters(path=path_cache_findParameters, trial_best=trial_best)
         return self.kwargs_makeConjunctiveDistanceMatrix_best
 
+    def _make_fingerprint_findParameters(
+        self,
+        fingerprint: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Makes the dataset fingerprint used as the key of the warm-start cache.
+        The number of ROIs is binned in half-octaves so that runs with a few
+        more or fewer ROIs share an entry.
+
+        Args:
+            fingerprint (Optional[Dict[str, Any]]):
+                Additional JSON-serializable descriptors of the dataset.
+                (Default is ``None``)
+
+        Returns:
+            (Dict[str, Any]):
+                fingerprint (Dict[str, Any]):
+                    Fingerprint of the dataset.
+        """
+        n_rois = self.s_sf.shape[0]
+        return {
+            'n_rois_bin': int(np.round(np.log2(max(n_rois, 1)) * 2)),
+            **(fingerprint if fingerprint is not None else {}),
+        }
+
+    def _load_cache_findParameters(
+        self,
+        path: str,
+        n_seeds: int,
+    ) -> List[Dict[str, float]]:
+        """
+        Loads the best cached trials for ``self.fingerprint_findParameters``.
+        Trials with parameters outside of ``self.bounds_findParameters`` are
+        skipped.
+
+        Args:
+            path (str):
+                Path to the JSON cache file.
+            n_seeds (int):
+                Maximum number of trials to return.
+
+        Returns:
+            (List[Dict[str, float]]):
+                params_list (List[Dict[str, float]]):
+                    Optuna parameters of the cached trials, best first. Empty
+                    if the file or the entry does not exist.
+        """
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            warnings.warn(f'Could not read the warm-start cache at {path}: {e}')
+            return []
+        entry = cache.get(json.dumps(self.fingerprint_findParameters, sort_keys=True), None)
+        if entry is None:
+            return []
+        isInBounds = lambda params: all([(key in self.bounds_findParameters) and (self.bounds_findParameters[key][0] <= val <= self.bounds_findParameters[key][1]) for key, val in params.items()])
+        return [t['params'] for t in entry['trials'] if isInBounds(t['params'])][:max(int(n_seeds), 0)]
+
+    def _save_cache_findParameters(
+        self,
+        path: str,
+        trial_best: object,
+        n_trials_keep: int = 50,
+    ) -> None:
+        """
+        Replaces the cache entry for ``self.fingerprint_findParameters`` with
+        the best trials of ``self.study``. The file is written to a temporary
+        file first and then moved into place.
+
+        Args:
+            path (str):
+                Path to the JSON cache file.
+            trial_best (optuna.trial.FrozenTrial):
+                Selected best trial. Stored first.
+            n_trials_keep (int):
+                Number of trials to store. (Default is ``50``)
+        """
+        import optuna
+
+        cache = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError) as e:
+                warnings.warn(f'Could not read the warm-start cache at {path}. It will be overwritten. Error: {e}')
+        trials = sorted(self.study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)), key=lambda t: t.value)
+        trials = [trial_best] + [t for t in trials if t.number != trial_best.number][:max(int(n_trials_keep) - 1, 0)]
+        cache[json.dumps(self.fingerprint_findParameters, sort_keys=True)] = {
+            'fingerprint': self.fingerprint_findParameters,
+            'date': datetime.datetime.now().isoformat(),
+            'trials': [{'params': t.params, 'value': float(t.value)} for t in trials],
+        }
+        dir_cache = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dir_cache, exist_ok=True)
+        f = tempfile.NamedTemporaryFile('w', dir=dir_cache, suffix='.tmp', delete=False)
+        try:
+            with f:
+                json.dump(cache, f, indent=1)
+            os.replace(f.name, path)
+        except Exception:
+            ## Do not leave a partial temporary file next to the cache
+            if os.path.exists(f.name):
+                os.unlink(f.name)
+            raise
+
     def make_pruned_similarity_graphs(
         self,
         convert_to_probability: bool = False,
@@ -372,11 +641,6 @@ class Clusterer(util.ROICaT_Module):
             'd_crossover': d_crossover,
         }
 
-        ssf, snn, sswt, ssesh = self.s_sf.copy(), self.s_NN_z.copy(), self.s_SWT_z.copy(), self.s_sesh.copy()
-        # ssf.data[ssf.data == 0] = 1e-10
-        # snn.data[snn.data == 0] = 1e-10
-        # sswt.data[sswt.data == 0] = 1e-10
-
         min_d = np.nanmin(self.dConj.data)
         range_d = d_crossover - min_d
         self.d_cutoff = min_d + range_d * stringency if d_cutoff is None else d_cutoff
@@ -386,17 +650,27 @@ class Clusterer(util.ROICaT_Module):
         self.graph_pruned.data = self.graph_pruned.data < self.d_cutoff
         self.graph_pruned.eliminate_zeros()
         
-        def prune(s, graph_pruned):
-            import scipy.sparse
-            if s is None:
-                return None
-            s_pruned = scipy.sparse.csr_matrix(graph_pruned.shape, dtype=np.float32)
-            s_pruned[graph_pruned] = s[graph_pruned]
-            s_pruned = s_pruned.tocsr()
-            return s_pruned
-
-        self.s_sf_pruned, self.s_NN_pruned, self.s_SWT_pruned, self.s_sesh_pruned = tuple([prune(s, self.graph_pruned) for s in [ssf, snn, sswt, ssesh]])
-        self.dConj_pruned, self.sConj_pruned = prune(self.dConj, self.graph_pruned), prune(self.sConj, self.graph_pruned)
+        arrays = [self.s_sf, self.s_NN_z, self.s_SWT_z, self.s_sesh, self.dConj, self.sConj]
+        if all(helpers.check_same_sparsity_pattern(self.dConj, s) for s in arrays if s is not None):
+            ## Shared structure: prune all matrices with one mask on .data
+            arrays_pruned = helpers.mask_sparse_arrays_sharedPattern(
+                arrays=arrays,
+                mask=self.dConj.data < self.d_cutoff,
+                dtype=np.float32,
+            )
+        else:
+            def prune(s, graph_pruned):
+                import scipy.sparse
+                if s is None:
+                    return None
+                s_pruned = scipy.sparse.csr_matrix(graph_pruned.shape, dtype=np.float32)
+                s_pruned[graph_pruned] = s[graph_pruned]
+                s_pruned = s_pruned.tocsr()
+                return s_pruned
+
+            arrays_pruned = [prune(s.copy() if s is not None else None, self.graph_pruned) for s in arrays]
+
+        self.s_sf_pruned, self.s_NN_pruned, self.s_SWT_pruned, self.s_sesh_pruned, self.dConj_pruned, self.sConj_pruned = tuple(arrays_pruned)
 
     def fit(
         self,
@@ -528,7 +802,7 @@ class Clusterer(util.ROICaT_Module):
             labels = self.hdbs.labels_[:-1]
             self.labels = labels
 
-            print(f'Initial number of violating clusters: {len(np.unique(labels)[np.array([(session_bool[labels==u].sum(0)>1).sum().item() for u in np.unique(labels)]) > 0])}') if self._verbose else None
+            print(f'Initial number of violating clusters: {len(find_session_violations(labels=labels, session_bool=session_bool))}') if self._verbose else None
 
             ## Split up labels with multiple ROIs per session
             ## The below code is a bit of a mess, but it works.
@@ -539,25 +813,22 @@ class Clusterer(util.ROICaT_Module):
                 labels = labels.copy()
                 # d_cut = float(d.data.max())
 
-                sb_t = torch.as_tensor(session_bool, dtype=torch.float32) # (n_rois, n_sessions)
                 # print(f'num violating clusters: {np.unique(labels)[np.array([(session_bool[labels==u].sum(0)>1).sum().item() for u in np.unique(labels)]) > 0]}')
                 n = len(d_conj.data)
                 dcd = np.sort(d_conj.data)
                 cuts_all = np.sort(np.unique([dcd[0]/2] + [dcd[int(n*ii)] for ii in np.linspace(0., 1., num=n_steps_clusterSplit, endpoint=False)[::-1]] + [dcd[-1]]))[::-1]
+                d_coo = d.tocoo()
                 for d_cut in cuts_all:
-                    labels_t = torch.as_tensor(labels, dtype=torch.int64)
-                    lab_u_t, lab_u_idx_t = torch.unique(labels_t, return_inverse=True) # (n_clusters,), (n_rois,)
-                    lab_oneHot_t = helpers.idx_to_oneHot(lab_u_idx_t, dtype=torch.float32)
-                    violations_labels = lab_u_t[((sb_t.T @ lab_oneHot_t) > 1.5).sum(0) > 0]
+                    violations_labels = find_session_violations(labels=labels, session_bool=session_bool)
                     violations_labels = violations_labels[violations_labels > -1]
 
                     if len(violations_labels) == 0:
                         break
                     
-                    for l in violations_labels:
-                        idx = np.where(labels==l)[0]
-                        if d[idx][:,idx].nnz == 0:
-                            labels[idx] = -1
+                    ## Violating clusters without any edges between their ROIs are discarded
+                    isIntra = (labels[d_coo.row] == labels[d_coo.col]) & np.isin(labels[d_coo.row], violations_labels)
+                    labels_withEdges = np.unique(labels[d_coo.row[isIntra]])
+                    labels[np.isin(labels, violations_labels[~np.isin(violations_labels, labels_withEdges)])] = -1
 
                     labels_new = self.hdbs.single_linkage_tree_.get_clusters(
                         cut_distance=d_cut,
@@ -577,27 +848,16 @@ class Clusterer(util.ROICaT_Module):
             l_u = l_u[l_u > -1]
             if ii < n_iter_violationCorrection - 1:
                 # print(f'Post-separation number of violating clusters: {n_violating_clusters}') if self._verbose else None
-                ## find sessions represented in each cluster and set distances to ROIs in those sessions to 1.
-                d = d.tocsr()
-                for ii, l in enumerate(np.unique(labels)):
-                    if l == -1:
-                        continue
-                    idx = np.where(labels==l)[0]
-                    
-                    d_sub = d[idx][:,idx]
-                    idx_grid = np.meshgrid(idx, idx)
-                    ## set distances of ROIs from same session to 0
-                    sesh_to_exclude = 1 - (session_bool @ (session_bool[idx].max(0)))  ## make a mask of sessions that are not represented in the cluster
-                    d[idx,:] = d[idx,:].multiply(sesh_to_exclude[None,:])  ## set distances to ROIs from sessions represented in the cluster to 1
-                    d[:,idx] = d[:,idx].multiply(sesh_to_exclude[:,None])  ## set distances to ROIs from sessions represented in the cluster to 1
-                    d[idx_grid[0], idx_grid[1]] = d_sub  ## undo the above for ROIs in the cluster
-                d = d.tocsr()
-                d.eliminate_zeros()  ## remove zeros
+                ## find sessions represented in each cluster and remove edges
+                ##  between ROIs in a cluster and ROIs outside of the cluster
+                ##  that are from those sessions. Done in one masked pass over
+                ##  the edges.
+                d = disconnect_represented_sessions(d=d, labels=labels, session_bool=session_bool)
 
 
         labels = helpers.squeeze_integers(labels)
         
-        violations_labels = np.unique(labels)[np.array([(session_bool[labels==u].sum(0)>1).sum().item() for u in np.unique(labels)]) > 0]
+        violations_labels = find_session_violations(labels=labels, session_bool=session_bool)
         violations_labels = violations_labels[violations_labels > -1]
         self.violations_labels = violations_labels
 
@@ -609,11 +869,73 @@ class Clusterer(util.ROICaT_Module):
         self.labels = labels
         return self.labels
 
+    def fit_sessionConstrainedLinkage(
+        self,
+        d_conj: scipy.sparse.csr_matrix,
+        session_bool: np.ndarray,
+        d_cutoff: Optional[float] = None,
+        min_cluster_size: int = 2,
+    ) -> np.ndarray:
+        """
+        Fits clustering using single-linkage on the sparse distance graph with
+        the constraint that each cluster contains at most one ROI per session.
+        The constraint is enforced while merging (see
+        ``session_constrained_single_linkage``), so unlike ``self.fit``, no
+        iterative violation correction is needed. Scales to large numbers of
+        ROIs.
+
+        Args:
+            d_conj (scipy.sparse.csr_matrix): 
+                Conjunctive distance matrix. Usually ``self.dConj_pruned``.
+            session_bool (np.ndarray): 
+                Boolean array indicating which ROIs belong to which session.
+                Shape: *(n_rois, n_sessions)*
+            d_cutoff (Optional[float]): 
+                Only ROI pairs with distances below this value can be merged.
+                If ``None``, all edges in ``d_conj`` are used (the pruned graph
+                is already cut at ``self.d_cutoff``). (Default is ``None``)
+            min_cluster_size (int): 
+                Minimum cluster size to be considered a cluster. Smaller
+                clusters are set to -1. (Default is *2*)
+
+        Returns:
+            (np.ndarray): 
+                labels (np.ndarray): 
+                    Cluster labels for each ROI, shape: *(n_rois_total)*
+        """
+        ## Store parameter (but not data) args as attributes
+        self.params['fit_sessionConstrainedLinkage'] = self._locals_to_params(
+            locals_dict=locals(),
+            keys=[
+                'd_cutoff',
+                'min_cluster_size',
+            ],
+        )
+
+        print('Clustering with session-constrained single-linkage...') if self._verbose else None
+        session_bool = np.asarray(session_bool)
+        labels, self.linkage_edges, self.linkage_distances = session_constrained_single_linkage(
+            d=d_conj,
+            session_idx=np.argmax(session_bool, axis=1),
+            d_cutoff=d_cutoff,
+        )
+
+        ## Set clusters with too few ROIs to -1
+        u, inv, c = np.unique(labels, return_inverse=True, return_counts=True)
+        labels = np.where(c[inv] < max(min_cluster_size, 2), -1, labels)
+        labels = helpers.squeeze_integers(labels)
+        print(f'Found {int((np.unique(labels) > -1).sum())} clusters using {len(self.linkage_distances)} merges.') if self._verbose else None
+
+        self.labels = labels
+        return self.labels
+
     def fit_sequentialHungarian(
         self,
         d_conj: scipy.sparse.csr_matrix,
         session_bool: np.ndarray,
         thresh_cost: float = 0.95,
+        method_matching: str = 'dense',
+        n_workers: int = 1,
     ) -> np.ndarray:
         """
         Applies CaImAn's method for clustering. 
@@ -633,6 +955,22 @@ class Clusterer(util.ROICaT_Module):
             thresh_cost (float): 
                 Threshold below which ROI pairs are considered potential matches. 
                 (Default is *0.95*)
+            method_matching (str):
+                How each session is matched to the union of previous sessions: \n
+                * ``'dense'``: Hungarian algorithm on the dense *(n_rois_session,
+                  n_rois_union)* cost matrix. Missing ROI pairs have cost 1.
+                * ``'sparse'``: Splits the bipartite graph of candidate pairs
+                  (distances below ``thresh_cost``) into connected components
+                  and solves each component independently. Dense matrices only
+                  cover a single component, so this scales to many sessions.
+                  All non-candidate pairs are treated as equally unmatched, so
+                  results can differ slightly from ``'dense'``, where stored
+                  distances above ``thresh_cost`` still influence the
+                  assignment. \n
+                (Default is ``'dense'``)
+            n_workers (int):
+                Number of threads used to solve components when
+                ``method_matching='sparse'``. (Default is *1*)
 
         Returns:
             (np.ndarray): 
@@ -642,7 +980,8 @@ class Clusterer(util.ROICaT_Module):
         ## Store parameter (but not data) args as attributes
         self.params['fit_sequentialHungarian'] = self._locals_to_params(
             locals_dict=locals(),
-            keys=['thresh_cost',],)
+            keys=['thresh_cost', 'method_matching', 'n_workers',],)
+        assert method_matching in ['dense', 'sparse'], f"method_matching must be 'dense' or 'sparse'. Got {method_matching}."
 
         print(f"Clustering with CaImAn's sequential Hungarian algorithm method...") if self._verbose else None
         def find_matches(D_s):
@@ -682,31 +1021,45 @@ class Clusterer(util.ROICaT_Module):
             idx_sess = np.arange(n_roi_cum[i_sesh], n_roi_cum[i_sesh+1])
             
             d_sub = d_conj[idx_sess][:, idx_union]
-            D = np.ones((len(idx_sess), len(idx_union)))*np.logical_not((d_sub != 0).toarray())*1 + d_sub.toarray()
-            D = [D]
-            
-            matches, costs = find_matches(D)
-            matches = matches[0]
-            costs = costs[0]
+            if method_matching == 'sparse':
+                ## Only candidate pairs. Stored zeros count as missing, as in the dense cost matrix.
+                d_sub = d_sub.tocoo()
+                mask = (d_sub.data != 0) & (d_sub.data < thresh_cost)
+                idx_rows, idx_cols, costs = linear_sum_assignment_sparse(
+                    rows=d_sub.row[mask],
+                    cols=d_sub.col[mask],
+                    costs=d_sub.data[mask],
+                    shape=d_sub.shape,
+                    cost_missing=max(1.0, float(thresh_cost)),
+                    n_workers=n_workers,
+                )
+                matches = (idx_rows, idx_cols)
+            else:
+                D = np.ones((len(idx_sess), len(idx_union)))*np.logical_not((d_sub != 0).toarray())*1 + d_sub.toarray()
+                D = [D]
+                
+                matches, costs = find_matches(D)
+                matches = matches[0]
+                costs = costs[0]
 
             # store indices
             idx_tp = np.where(np.array(costs) < thresh_cost)[0]
             if len(idx_tp) > 0:
                 matched_ROIs1 = matches[0][idx_tp]     # ground truth
                 matched_ROIs2 = matches[1][idx_tp]     # algorithm - comp
-                non_matched1 = np.setdiff1d(list(range(D[0].shape[0])), matches[0][idx_tp])
-                non_matched2 = np.setdiff1d(list(range(D[0].shape[1])), matches[1][idx_tp])
+                non_matched1 = np.setdiff1d(list(range(d_sub.shape[0])), matches[0][idx_tp])
+                non_matched2 = np.setdiff1d(list(range(d_sub.shape[1])), matches[1][idx_tp])
                 TP = np.sum(np.array(costs) < thresh_cost) * 1.
             else:
                 TP = 0.
                 matched_ROIs1 = []
                 matched_ROIs2 = []
-                non_matched1 = list(range(D[0].shape[0]))
-                non_matched2 = list(range(D[0].shape[1]))
+                non_matched1 = list(range(d_sub.shape[0]))
+                non_matched2 = list(range(d_sub.shape[1]))
 
             # compute precision and recall
-            FN = D[0].shape[0] - TP
-            FP = D[0].shape[1] - TP
+            FN = d_sub.shape[0] - TP
+            FP = d_sub.shape[1] - TP
             TN = 0
 
             performance = dict()
@@ -747,6 +1100,7 @@ class Clusterer(util.ROICaT_Module):
         sig_SF_kwargs: Dict[str, float] = {'mu':0.5, 'b':0.5},
         sig_NN_kwargs: Dict[str, float] = {'mu':0.5, 'b':0.5},
         sig_SWT_kwargs: Dict[str, float] = {'mu':0.5, 'b':0.5},
+        tolerance_activation: Optional[float] = None,
     ) -> Tuple[scipy.sparse.csr_matrix, scipy.sparse.csr_matrix, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         """
         Makes a distance matrix from the three similarity matrices.
@@ -790,6 +1144,15 @@ class Clusterer(util.ROICaT_Module):
                 scattering wavelet transform similarity matrix. See
                 helpers.generalised_logistic_function for details. (Default is
                 {'mu':0.5, 'b':0.5})
+            tolerance_activation (Optional[float]): 
+                If ``None``, the activations and p-norm are computed exactly.
+                If a float, a faster approximation is used: each activation
+                (sigmoid and power) is read from a lookup table and the
+                p-norm is fused into the same float32 pass (see
+                ``self._conjunctive_similarity_lookup``). The tables are fine
+                enough that the error of each activated similarity is below
+                this value. Tables are cached per parameter set. (Default is
+                ``None``)
 
         Returns:
             (Tuple): Tuple containing:
@@ -820,28 +1183,48 @@ class Clusterer(util.ROICaT_Module):
                 'sig_SF_kwargs',
                 'sig_NN_kwargs',
                 'sig_SWT_kwargs',
+                'tolerance_activation',
             ],
         )
         
         p_norm = 1e-9 if p_norm == 0 else p_norm
 
-        sSF_data = self._activation_function(s_sf.data, sig_SF_kwargs, power_SF) if s_sf is not None else None
-        sNN_data = self._activation_function(s_NN.data, sig_NN_kwargs, power_NN) if s_NN is not None else None
-        sSWT_data = self._activation_function(s_SWT.data, sig_SWT_kwargs, power_SWT) if s_SWT is not None else None
+        if tolerance_activation is None:
+            sSF_data = self._activation_function(s_sf.data, sig_SF_kwargs, power_SF) if s_sf is not None else None
+            sNN_data = self._activation_function(s_NN.data, sig_NN_kwargs, power_NN) if s_NN is not None else None
+            sSWT_data = self._activation_function(s_SWT.data, sig_SWT_kwargs, power_SWT) if s_SWT is not None else None
 
-        s_list = [s for s in [sSF_data, sNN_data, sSWT_data] if s is not None]
-        
-        sConj_data = self._pNorm(
-            s_list=s_list,
-            p=p_norm,
-        )
+            s_list = [s for s in [sSF_data, sNN_data, sSWT_data] if s is not None]
+            
+            sConj_data = self._pNorm(
+                s_list=s_list,
+                p=p_norm,
+            )
+        else:
+            (sSF_data, sNN_data, sSWT_data), sConj_data = self._conjunctive_similarity_lookup(
+                s_list=[s.data if s is not None else None for s in [s_sf, s_NN, s_SWT]],
+                sig_kwargs_list=[sig_SF_kwargs, sig_NN_kwargs, sig_SWT_kwargs],
+                power_list=[power_SF, power_NN, power_SWT],
+                p=p_norm,
+                tolerance=tolerance_activation,
+            )
         # sConj_data = sConj_data * s_sesh.data if s_sesh is not None else sConj_data
         # sConj_data = sConj_data * np.logical_not(s_sesh.data) if s_sesh is not None else sConj_data
 
         ## make sConj
-        sConj = s_sf.copy() if s_sf is not None else s_NN.copy() if s_NN is not None else s_SWT.copy()
-        sConj.data = sConj_data.numpy() 
-        sConj = sConj.multiply(s_sesh) if s_sesh is not None else sConj
+        s_ref = s_sf if s_sf is not None else s_NN if s_NN is not None else s_SWT
+        if (s_sesh is not None) and helpers.check_same_sparsity_pattern(s_ref, s_sesh):
+            ## Shared structure (e.g. views from ROI_graph.s_graph): mask the
+            ##  data directly instead of a general sparse-sparse multiply.
+            sConj = scipy.sparse.csr_matrix(
+                (sConj_data.numpy() * s_sesh.data, s_ref.indices.copy(), s_ref.indptr.copy()),
+                shape=s_ref.shape,
+            )
+            sConj.eliminate_zeros()
+        else:
+            sConj = s_ref.copy()
+            sConj.data = sConj_data.numpy() 
+            sConj = sConj.multiply(s_sesh) if s_sesh is not None else sConj
         # sConj.eliminate_zeros()
 
         ## make dConj
@@ -908,6 +1291,93 @@ class Clusterer(util.ROICaT_Module):
         return (torch.mean(torch.stack(s_list_noNones, axis=0)**p, dim=0))**(1/p)
         # return np.linalg.norm(np.stack(s_list_noNones, axis=0), ord=p, axis=0)
 
+    def _conjunctive_similarity_lookup(
+        self,
+        s_list: List[Optional[np.ndarray]],
+        sig_kwargs_list: List[Optional[Dict[str, float]]],
+        power_list: List[Optional[float]],
+        p: float,
+        tolerance: float,
+    ) -> Tuple[List[Optional[torch.Tensor]], torch.Tensor]:
+        """
+        Approximates ``self._activation_function`` for each similarity and
+        ``self._pNorm`` of the results in one float32 pass. Each activation
+        and its ``p``-th power are read from lookup tables over the range of
+        the input (see ``make_activation_lookup_table``), so the p-norm only
+        needs a sum and one power. The p-norm can amplify the error of small
+        activations, so a first-order bound of the output error is computed
+        for each element and elements above ``tolerance`` are recomputed
+        exactly.
+
+        Args:
+            s_list (List[Optional[np.ndarray]]): 
+                Similarity values of each modality. ``None`` entries are
+                skipped.
+            sig_kwargs_list (List[Optional[Dict[str, float]]]): 
+                Sigmoid keyword arguments of each modality.
+            power_list (List[Optional[float]]): 
+                Power of each modality.
+            p (float): 
+                p-norm to use.
+            tolerance (float): 
+                Maximum absolute error of each activated similarity and of the
+                p-norm.
+
+        Returns:
+            (Tuple): Tuple containing:
+                s_activated (List[Optional[torch.Tensor]]): 
+                    Activated similarities of each modality. ``None`` where
+                    the input is ``None``.
+                s_conj (torch.Tensor): 
+                    p-norm of the activated similarities.
+        """
+        mods = [ii for ii, s in enumerate(s_list) if s is not None]
+        s_list = [np.asarray(s, dtype=np.float32) if s is not None else None for s in s_list]
+        n = len(s_list[mods[0]])
+        ## Half of the tolerance goes to the tables, which leaves room for
+        ##  the p-norm when the activations are balanced
+        tol_table = tolerance / 2
+
+        s_activated = [None] * len(s_list)
+        s_sum, d_sum = np.zeros(n, dtype=np.float32), np.zeros(n, dtype=np.float32)
+        buf_idx, buf_val = np.empty(n, dtype=np.float32), np.empty(n, dtype=np.float32)
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            for ii in mods:
+                s = s_list[ii]
+                x_min, x_max = float(s.min()), float(s.max())
+                table_act, table_pow, table_deriv, scale = make_activation_lookup_table(
+                    sig_kwargs=tuple(sorted(sig_kwargs_list[ii].items())) if sig_kwargs_list[ii] is not None else None,
+                    power=power_list[ii],
+                    p=p,
+                    x_min=x_min,
+                    x_max=x_max,
+                    tolerance=tol_table,
+                )
+                ## Nearest-node lookup
+                np.multiply(s, np.float32(scale), out=buf_idx)
+                np.add(buf_idx, np.float32(0.5 - x_min * scale), out=buf_idx)
+                idx = buf_idx.astype(np.int32)
+                s_activated[ii] = np.take(table_act, idx)
+                s_sum += np.take(table_pow, idx, out=buf_val)
+                d_sum += np.take(table_deriv, idx, out=buf_val)
+
+            s_conj = s_sum * np.float32(1 / len(mods))
+            np.power(s_conj, np.float32(1 / p), out=s_conj)
+            ## First-order error bound: tol_table * sum_i(dM/da_i), with
+            ##  dM/da_i = a_i**(p-1) * M / S
+            d_sum *= s_conj
+            d_sum /= s_sum
+            d_sum *= np.float32(tol_table)
+            idx_exact = np.nonzero(~(d_sum <= tolerance))[0]
+
+        if len(idx_exact) > 0:
+            s_exact = [self._activation_function(s_list[ii][idx_exact], sig_kwargs_list[ii], power_list[ii]) for ii in mods]
+            s_conj[idx_exact] = self._pNorm(s_list=s_exact, p=p).numpy()
+            for ii, s in zip(mods, s_exact):
+                s_activated[ii][idx_exact] = s.numpy()
+
+        return [torch.as_tensor(s) if s is not None else None for s in s_activated], torch.as_tensor(s_conj)
+
     # def plot_sigmoids(self):
     #     fig, axs = plt.subplots(nrows=1, ncols=3, figsize=(16,4))
     #     axs[0].plot(np.linspace(-0,2,1001), self.sig_sf(np.linspace(-5,5,1001)))
@@ -1100,14 +1570,19 @@ class Clusterer(util.ROICaT_Module):
         dens_all = counts  ## distances of all pairs of ROIs
         # dens_all = counts / counts[-1]  ## distances of all pairs of ROIs
 
-        d_intra = d_conj.multiply(self.s_sesh_inv)
-        d_intra.eliminate_zeros()
-        if len(d_intra.data) == 0:
+        if (getattr(self, '_mask_sesh_inv_data', None) is not None) and helpers.check_same_sparsity_pattern(d_conj, self.s_sf):
+            d_intra_data = d_conj.data[self._mask_sesh_inv_data]
+            d_intra_data = d_intra_data[d_intra_data != 0]
+        else:
+            d_intra = d_conj.multiply(self.s_sesh_inv)
+            d_intra.eliminate_zeros()
+            d_intra_data = d_intra.data
+        if len(d_intra_data) == 0:
             return None, None, None, None, None, None
-        counts, _ = torch.histogram(torch.as_tensor(d_intra.data, dtype=torch.float32), edges)
+        counts, _ = torch.histogram(torch.as_tensor(d_intra_data, dtype=torch.float32), edges)
         # dens_diff = fn_smooth(counts / counts.sum())  ## distances of known differents
         # dens_diff = counts / counts.sum()  ## distances of known differents
-        dens_diff = counts * (len(d_all.data) / len(d_intra.data))
+        dens_diff = counts * (len(d_all.data) / len(d_intra_data))
         # dens_diff = counts / counts[-1]  ## distances of known differents
 
         dens_same = dens_all - dens_diff  ## estimate the 'same' distribution as the different between all distances (includes different and same) and intra-session distances (known different)
@@ -1125,30 +1600,157 @@ class Clusterer(util.ROICaT_Module):
         dens_same_crop = dens_same.clone()
         dens_same_crop[idx_crossover:] = 0
         return dens_same_crop, dens_same, dens_diff, dens_all, edges, d_crossover
-    def _objectiveFn_distSameMagnitude(
-        self, 
-        trial: object,
-    ) -> float:
+
+    def _optimize_multiprocessing(
+        self,
+        n_workers: int,
+        storage: Optional[str],
+        n_startup_trials: int,
+        max_trials: int,
+        callbacks: List[Callable],
+        params_enqueue: List[Dict[str, float]] = [],
+        interval_poll: float = 0.5,
+    ) -> object:
         """
-        Computes the magnitude of the 'same' distribution for Optuna
-        hyperparameter optimization.
+        Runs the Optuna search in worker processes that share one storage.
+        The similarity matrices are copied once into shared memory. Each
+        worker loads the study with its own TPE sampler and runs
+        ``self._objectiveFn_distSameMagnitude``. This process polls the
+        storage and passes each completed trial to ``callbacks`` in order of
+        completion. When the convergence checker stops, the study is flagged
+        through the ``'stop'`` user attribute and the workers stop after
+        their current trial.
 
-        The 'same' distribution refers to the distribution of distances between
-        pairs of ROIs that are estimated to be identical. As the parameters for
-        building the conjunctive distance matrix are optimized, the 'same' and
-        'different' distributions should separate from each other. The less the
-        two overlap, the larger the effective magnitude of the 'same'
-        distribution.
+        Args:
+            n_workers (int):
+                Number of worker processes.
+            storage (Optional[str]):
+                Journal file path or database URL. If ``None``, a temporary
+                journal file is used.
+            n_startup_trials (int):
+                Number of random trials of each worker's sampler.
+            max_trials (int):
+                Maximum number of trials over all workers. As with
+                ``optuna.study.MaxTrialsCallback``, workers that start a trial
+                at the same time can exceed it by up to ``n_workers - 1``.
+            callbacks (List[Callable]):
+                Functions called as ``fn(study, trial)`` for each completed
+                trial.
+            params_enqueue (List[Dict[str, float]]):
+                Parameters of trials to run first. (Default is ``[]``)
+            interval_poll (float):
+                Seconds between polls of the storage. (Default is ``0.5``)
+
+        Returns:
+            (optuna.study.Study):
+                study (optuna.study.Study):
+                    The study. If ``storage`` is ``None``, an in-memory copy.
+        """
+        import optuna
+
+        dir_temp = tempfile.mkdtemp() if storage is None else None
+        storage_str = os.path.join(dir_temp, 'journal.log') if storage is None else storage
+        study_name = f'findParameters_{os.getpid()}_{time.time_ns()}'
+        study = optuna.create_study(
+            study_name=study_name,
+            storage=_make_optuna_storage(storage_str),
+            direction='minimize',
+        )
+        [study.enqueue_trial(params) for params in params_enqueue]
+
+        ## Arrays needed by the objective. Arrays shared between matrices
+        ##  (e.g. the index of an ROI_graph.s_graph) are stored once.
+        arrays = {}
+        for name in ['s_sf', 's_NN_z', 's_SWT_z', 's_sesh_inv']:
+            s = getattr(self, name)
+            arrays.update({f'{name}_data': s.data, f'{name}_indices': s.indices, f'{name}_indptr': s.indptr})
+        if getattr(self, '_mask_sesh_inv_data', None) is not None:
+            arrays['_mask_sesh_inv_data'] = self._mask_sesh_inv_data
+        if getattr(self, '_idx_findParameters', None) is not None:
+            arrays['_idx_findParameters'] = self._idx_findParameters
+        attrs = {
+            'n_bins': self.n_bins,
+            'smooth_window': self.smooth_window,
+            'bounds_findParameters': self.bounds_findParameters,
+            '_tolerance_activation': getattr(self, '_tolerance_activation', None),
+            'shapes': {name: getattr(self, name).shape for name in ['s_sf', 's_NN_z', 's_SWT_z', 's_sesh_inv']},
+        }
+
+        shms, specs_shm, name_by_id = [], {}, {}
+        numbers_seen, stop_flagged = set(), False
+        try:
+            for name, arr in arrays.items():
+                if id(arr) in name_by_id:
+                    specs_shm[name] = specs_shm[name_by_id[id(arr)]]
+                    continue
+                arr = np.ascontiguousarray(arr)
+                shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+                shms.append(shm)
+                specs_shm[name] = (shm.name, arr.shape, arr.dtype.str)
+                name_by_id[id(arrays[name])] = name
+
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_init_findParameters_worker,
+                initargs=(specs_shm, attrs),
+            ) as executor:
+                futures = [executor.submit(
+                    _run_findParameters_worker,
+                    storage_str,
+                    study_name,
+                    None if self._seed is None else self._seed + 1 + ii,
+                    n_startup_trials,
+                    max_trials,
+                ) for ii in range(n_workers)]
+                while True:
+                    done = all([f.done() for f in futures])
+                    trials_new = sorted(
+                        [t for t in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)) if t.number not in numbers_seen],
+                        key=lambda t: t.datetime_complete,
+                    )
+                    for trial in trials_new:
+                        numbers_seen.add(trial.number)
+                        [fn(study, trial) for fn in callbacks]
+                    if self.checker.stopped and not stop_flagged:
+                        study.set_user_attr('stop', True)
+                        stop_flagged = True
+                    if done:
+                        break
+                    time.sleep(interval_poll)
+                [f.result() for f in futures]  ## Raise errors from the workers
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+        if dir_temp is not None:
+            storage_memory = optuna.storages.InMemoryStorage()
+            optuna.copy_study(from_study_name=study_name, from_storage=study._storage, to_storage=storage_memory)
+            study = optuna.load_study(study_name=study_name, storage=storage_memory)
+            import shutil
+            shutil.rmtree(dir_temp, ignore_errors=True)
+        return study
+
+    def _suggest_mixing_params(
+        self,
+        trial: object,
+    ) -> Dict[str, Any]:
+        """
+        Samples a set of mixing parameters for
+        ``self.make_conjunctive_distance_matrix`` from an Optuna trial, within
+        ``self.bounds_findParameters``.
 
         Args:
             trial (optuna.trial.Trial): 
                 The Optuna trial object.
 
         Returns:
-            (float): 
-                loss (float):
-                    The magnitude of the 'same' distribution. This output must
-                    be a scalar and is used to update the hyperparameters.
+            (Dict[str, Any]):
+                kwargs_mixing (Dict[str, Any]):
+                    Keyword arguments for
+                    ``self.make_conjunctive_distance_matrix`` (excluding the
+                    similarity matrices).
         """
         # power_SF = trial.suggest_float('power_SF', *self.bounds_findParameters['power_SF'], log=False)
         power_SF = 1
@@ -1173,19 +1775,51 @@ class Clusterer(util.ROICaT_Module):
         }
         # sig_SWT_kwargs = None
 
+        return {
+            'power_SF': power_SF,
+            'power_NN': power_NN,
+            'power_SWT': power_SWT,
+            'p_norm': p_norm,
+            'sig_SF_kwargs': sig_SF_kwargs,
+            'sig_NN_kwargs': sig_NN_kwargs,
+            'sig_SWT_kwargs': sig_SWT_kwargs,
+        }
+
+    def _objectiveFn_distSameMagnitude(
+        self, 
+        trial: object,
+    ) -> float:
+        """
+        Computes the magnitude of the 'same' distribution for Optuna
+        hyperparameter optimization.
+
+        The 'same' distribution refers to the distribution of distances between
+        pairs of ROIs that are estimated to be identical. As the parameters for
+        building the conjunctive distance matrix are optimized, the 'same' and
+        'different' distributions should separate from each other. The less the
+        two overlap, the larger the effective magnitude of the 'same'
+        distribution.
+
+        Args:
+            trial (optuna.trial.Trial): 
+                The Optuna trial object.
+
+        Returns:
+            (float): 
+                loss (float):
+                    The magnitude of the 'same' distribution. This output must
+                    be a scalar and is used to update the hyperparameters.
+        """
+        kwargs_mixing = self._suggest_mixing_params(trial)
+        if getattr(self, '_idx_findParameters', None) is not None:
+            return float(self._objectiveFn_distSameMagnitude_batch([kwargs_mixing], idx_data=self._idx_findParameters)[0])
         dConj, sConj, sSF_data, sNN_data, sSWT_data, sConj_data = self.make_conjunctive_distance_matrix(
             s_sf=self.s_sf,
             s_NN=self.s_NN_z,
             s_SWT=self.s_SWT_z,
             s_sesh=None,
-            power_SF=power_SF,
-            power_NN=power_NN,
-            power_SWT=power_SWT,
-            p_norm=p_norm,
-        #     sig_sf_kwargs={'mu':1.0, 'b':0.5},
-            sig_SF_kwargs=sig_SF_kwargs,
-            sig_NN_kwargs=sig_NN_kwargs,
-            sig_SWT_kwargs=sig_SWT_kwargs,
+            tolerance_activation=getattr(self, '_tolerance_activation', None),
+            **kwargs_mixing,
         )
         
         dens_same_crop, dens_same, dens_diff, dens_all, edges, d_crossover = self._separate_diffSame_distributions(dConj)
@@ -1196,6 +1830,170 @@ class Clusterer(util.ROICaT_Module):
         loss = (dens_same * dens_diff).sum().item()
         
         return loss  # Output must be a scalar. Used to update the hyperparameters
+
+    def _make_stratified_edge_subsample(
+        self,
+        n_samples: int,
+        seed: Optional[int] = None,
+    ) -> Optional[np.ndarray]:
+        """
+        Draws a random subsample of graph edges (positions in the ``.data``
+        arrays of the similarity matrices) that keeps the proportion of
+        intra-session and inter-session edges.
+
+        Args:
+            n_samples (int):
+                Number of edges to draw.
+            seed (Optional[int]):
+                Seed for the random number generator. (Default is ``None``)
+
+        Returns:
+            (Optional[np.ndarray]):
+                idx (Optional[np.ndarray]):
+                    Sorted positions of the sampled edges. ``None`` if
+                    ``n_samples`` covers all edges or if the similarity
+                    matrices do not share one sparsity pattern.
+        """
+        mask_intra = getattr(self, '_mask_sesh_inv_data', None)
+        if mask_intra is None:
+            warnings.warn('Subsampling edges requires s_sf and s_sesh to share one sparsity pattern. Using all edges.')
+            return None
+        nnz = len(mask_intra)
+        if n_samples >= nnz:
+            return None
+
+        idx_intra, idx_inter = np.nonzero(mask_intra)[0], np.nonzero(np.logical_not(mask_intra))[0]
+        n_intra = int(round(n_samples * len(idx_intra) / nnz))
+        rng = np.random.default_rng(seed)
+        idx = np.concatenate([
+            rng.choice(idx_intra, size=n_intra, replace=False),
+            rng.choice(idx_inter, size=n_samples - n_intra, replace=False),
+        ])
+        return np.sort(idx)
+
+    def _objectiveFn_distSameMagnitude_batch(
+        self,
+        kwargs_mixing_list: List[Dict[str, Any]],
+        idx_data: Optional[np.ndarray] = None,
+        batch_size_data: int = 2**22,
+    ) -> np.ndarray:
+        """
+        Computes the same loss as ``self._objectiveFn_distSameMagnitude`` for
+        many sets of mixing parameters at once. All candidates are evaluated in
+        one tensorized pass over the ``.data`` arrays of ``self.s_sf``,
+        ``self.s_NN_z``, and ``self.s_SWT_z``: activations, p-norm, and the
+        'all' and 'intra-session' histograms are computed for every candidate
+        without building any scipy matrices. Requires the similarity matrices
+        to share one sparsity pattern (as produced by ``ROI_graph``);
+        otherwise each candidate is evaluated with the sequential objective.
+
+        Args:
+            kwargs_mixing_list (List[Dict[str, Any]]):
+                Mixing parameters for each candidate, as returned by
+                ``self._suggest_mixing_params``. Whether the sigmoid and power
+                of each modality are ``None`` must be the same for all
+                candidates.
+            idx_data (Optional[np.ndarray]):
+                If not ``None``, only these positions of the ``.data`` arrays
+                (a subsample of the graph edges) are used. The 'all' histogram
+                is rescaled to the full number of edges so that losses are
+                comparable to the full-data loss. (Default is ``None``)
+            batch_size_data (int):
+                Number of graph entries x candidates processed at once. Lower
+                values use less memory. (Default is ``2**22``)
+
+        Returns:
+            (np.ndarray):
+                losses (np.ndarray):
+                    Loss for each candidate. Shape: *(n_candidates,)*.
+        """
+        n_cand = len(kwargs_mixing_list)
+        s_all = [self.s_sf, self.s_NN_z, self.s_SWT_z]
+        shared = (getattr(self, '_mask_sesh_inv_data', None) is not None) and all([helpers.check_same_sparsity_pattern(self.s_sf, s) for s in s_all if s is not None])
+        if not shared:
+            assert idx_data is None, 'idx_data requires the similarity matrices to share one sparsity pattern.'
+            losses = []
+            for kwargs in kwargs_mixing_list:
+                dConj = self.make_conjunctive_distance_matrix(s_sf=self.s_sf, s_NN=self.s_NN_z, s_SWT=self.s_SWT_z, s_sesh=None, tolerance_activation=getattr(self, '_tolerance_activation', None), **kwargs)[0]
+                dens_same_crop, dens_same, dens_diff = self._separate_diffSame_distributions(dConj)[:3]
+                losses.append(0 if dens_same_crop is None else (dens_same * dens_diff).sum().item())
+            return np.array(losses, dtype=np.float64)
+
+        ## Stack the parameters of each modality into (n_cand, 1) tensors
+        def stack_params(name_sig, name_power):
+            sigs, powers = [k[name_sig] for k in kwargs_mixing_list], [k[name_power] for k in kwargs_mixing_list]
+            assert len(set([sig is None for sig in sigs])) == 1, f'{name_sig} must be None for all candidates or for none of them.'
+            assert len(set([p is None for p in powers])) == 1, f'{name_power} must be None for all candidates or for none of them.'
+            ## Parameters shared by all candidates are applied once, as scalars
+            sig = None if sigs[0] is None else {key: (vals[0] if len(set(vals)) == 1 else torch.as_tensor(vals, dtype=torch.float32)[:, None]) for key in sigs[0].keys() for vals in [[sig[key] for sig in sigs]]}
+            power = None if powers[0] is None else powers[0] if len(set(powers)) == 1 else torch.as_tensor(powers, dtype=torch.float32)[:, None]
+            return sig, power
+        params_mod = [stack_params(*names) for names in [('sig_SF_kwargs', 'power_SF'), ('sig_NN_kwargs', 'power_NN'), ('sig_SWT_kwargs', 'power_SWT')]]
+        p_norm = np.array([1e-9 if k['p_norm'] == 0 else k['p_norm'] for k in kwargs_mixing_list], dtype=np.float64)
+        p_norm, p_norm_inv = torch.as_tensor(p_norm, dtype=torch.float32)[:, None], torch.as_tensor(1 / p_norm, dtype=torch.float32)[:, None]
+
+        edges = torch.linspace(0,1, self.n_bins+1, dtype=torch.float32)
+        counts_all = torch.zeros((n_cand, self.n_bins), dtype=torch.float64)
+        counts_intra = torch.zeros((n_cand, self.n_bins), dtype=torch.float64)
+        n_intra = torch.zeros((n_cand,), dtype=torch.int64)
+        offsets = (torch.arange(n_cand, dtype=torch.int64) * self.n_bins)[:, None]
+
+        def bin_rows(d):
+            ## Same binning as torch.histogram with explicit edges: values
+            ##  outside [0, 1] and NaNs are dropped, 1.0 goes in the last bin.
+            ##  The bin is found arithmetically, and values close to an edge
+            ##  are corrected against the float32 edges.
+            valid = (d >= edges[0]) & (d <= edges[-1])  ## also drops NaNs
+            x = d * self.n_bins
+            idx = torch.clamp(x.type(torch.int64), 0, self.n_bins - 1)
+            near = (x - torch.round(x)).abs() < 1e-3
+            idx_near, d_near = idx[near], d[near]
+            idx_near -= (d_near < torch.take(edges, idx_near)).type(torch.int64)
+            idx_near += ((d_near >= torch.take(edges, idx_near + 1)) & (idx_near + 1 < self.n_bins)).type(torch.int64)
+            idx[near] = idx_near
+            return idx + offsets, valid
+
+        def count_rows(idx, valid):
+            return torch.zeros(n_cand * self.n_bins, dtype=torch.float64).index_add_(0, idx.reshape(-1), valid.reshape(-1).type(torch.float64)).reshape(n_cand, self.n_bins)
+
+        nnz = self.s_sf.nnz
+        n_data = nnz if idx_data is None else len(idx_data)
+        step = max(int(batch_size_data // n_cand), 1)
+        for i_start in range(0, n_data, step):
+            sl = slice(i_start, min(i_start + step, n_data)) if idx_data is None else idx_data[i_start:i_start + step]
+            ## Activations and p-norm, as in self.make_conjunctive_distance_matrix.
+            ##  The p-norm terms are accumulated instead of stacked.
+            sum_pow, n_mod = 0, 0
+            for s, (sig, power) in zip(s_all, params_mod):
+                if s is None:
+                    continue
+                x = torch.as_tensor(s.data[sl], dtype=torch.float32)[None, :]
+                x = helpers.generalised_logistic_function(x, **sig) if sig is not None else x
+                x = torch.clamp(x, min=0)
+                x = x ** power if power is not None else x
+                sum_pow = sum_pow + x ** p_norm
+                n_mod += 1
+            d = 1 - (sum_pow / n_mod) ** p_norm_inv
+
+            mask_intra = torch.as_tensor(self._mask_sesh_inv_data[sl])[None, :] & (d != 0)
+            idx, valid = bin_rows(d)
+            counts_all += count_rows(idx, valid)
+            counts_intra += count_rows(idx, valid & mask_intra)
+            n_intra += mask_intra.sum(1)
+
+        ## Same steps as self._separate_diffSame_distributions, for all
+        ##  candidates at once
+        counts_all = counts_all * (nnz / n_data)  ## rescale a subsample to the full number of edges
+        counts_all, counts_intra = counts_all.type(torch.float32), counts_intra.type(torch.float32)
+        dens_diff = counts_intra * (nnz / torch.clamp(n_intra, min=1).type(torch.float32))[:, None]
+        dens_same = torch.maximum(counts_all - dens_diff, torch.as_tensor([0], dtype=torch.float32))
+        dens_same = self._fn_smooth(dens_same[:, None, :])[:, 0, :]
+        dens_deriv = dens_diff - dens_same
+        dens_deriv[torch.arange(self.n_bins)[None, :] >= dens_diff.argmax(dim=1)[:, None]] = 0
+        has_crossover = (dens_deriv < 0).any(dim=1) & (n_intra > 0)
+        losses = (dens_same * dens_diff).sum(dim=1)
+        losses[torch.logical_not(has_crossover)] = 0
+        return losses.numpy().astype(np.float64)
     
 
     def compute_quality_metrics(
@@ -1245,20 +2043,19 @@ class Clusterer(util.ROICaT_Module):
             labels=labels,
         )
 
-        import sklearn
-        ## Warn that current version is memory intensive and might be improved when sklearn 1.3 is released
-        # warnings.warn("Current version of silhouette samples calculation is memory intensive and will be improved when sklearn 1.3 is released.")
-        import sparse
-        d_dense = sparse.COO(dist_mat.copy().tocsr()).astype(np.float16)
-        d_dense.fill_value = (dist_mat.data.max() - dist_mat.data.min()).astype(np.float16) * 10
-        d_dense = d_dense.todense()
-        np.fill_diagonal(d_dense, 0)
+        ## Missing edges are treated as a large distance, while stored zeros
+        ##  are zero distances. Values are rounded to float16, as in the
+        ##  previous dense (sparse.COO -> float16) implementation.
+        fill_value = float((dist_mat.data.max() - dist_mat.data.min()).astype(np.float16) * 10)
+        d = dist_mat.tocsr().copy()
+        d.sum_duplicates()
+        d.data = d.data.astype(np.float16).astype(np.float32)
         ## Number of labels must be at least 2
         if len(np.unique(labels)) < 2:
             warnings.warn(f"Silhouette samples calculation requires at least 2 labels. Returning None. Found {len(np.unique(labels))} labels.")
             rs_sil = None
         else:
-            rs_sil = sklearn.metrics.silhouette_samples(X=d_dense, labels=labels, metric='precomputed')
+            rs_sil = silhouette_samples_sparse(d=d, labels=labels, fill_value=fill_value)
 
         def to_list_of_floats(x):
             return [float(i) for i in x]
@@ -1284,6 +2081,90 @@ class Clusterer(util.ROICaT_Module):
         return self.quality_metrics
         
 
+def _make_optuna_storage(storage: str) -> object:
+    """
+    Makes an Optuna storage that several processes can share: a database URL
+    (contains ``'://'``) is used as-is, and anything else is a journal file
+    path.
+    """
+    import optuna
+    if '://' in storage:
+        return storage
+    return optuna.storages.JournalStorage(optuna.storages.journal.JournalFileBackend(storage))
+
+
+## Clusterer attached by each findParameters worker process. See
+##  _init_findParameters_worker.
+_findParameters_worker_data = {}
+
+def _init_findParameters_worker(
+    specs_shm: Dict[str, Tuple[str, Tuple[int, ...], str]],
+    attrs: Dict[str, Any],
+) -> None:
+    """
+    Initializer for the findParameters worker processes. Attaches to the
+    shared memory blocks and builds a Clusterer holding only what
+    ``Clusterer._objectiveFn_distSameMagnitude`` needs.
+    """
+    torch.set_num_threads(1)
+    arrays, shms = {}, {}
+    for name, (name_shm, shape, dtype) in specs_shm.items():
+        ## The parent unlinks the shared memory when the pool is done
+        if name_shm not in shms:
+            shms[name_shm] = shared_memory.SharedMemory(name=name_shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shms[name_shm].buf)
+
+    clusterer = Clusterer.__new__(Clusterer)
+    clusterer.params = {}
+    clusterer._verbose = False
+    for name, shape in attrs['shapes'].items():
+        setattr(clusterer, name, scipy.sparse.csr_matrix((arrays[f'{name}_data'], arrays[f'{name}_indices'], arrays[f'{name}_indptr']), shape=shape))
+    clusterer._mask_sesh_inv_data = arrays.get('_mask_sesh_inv_data', None)
+    clusterer._idx_findParameters = arrays.get('_idx_findParameters', None)
+    clusterer.n_bins = attrs['n_bins']
+    clusterer.smooth_window = attrs['smooth_window']
+    clusterer.bounds_findParameters = attrs['bounds_findParameters']
+    clusterer._tolerance_activation = attrs['_tolerance_activation']
+    _findParameters_worker_data['shms'] = list(shms.values())
+    _findParameters_worker_data['clusterer'] = clusterer
+
+def _run_findParameters_worker(
+    storage: str,
+    study_name: str,
+    seed: Optional[int],
+    n_startup_trials: int,
+    max_trials: int,
+) -> int:
+    """
+    Runs trials of a shared study inside a worker process until the study
+    has ``max_trials`` trials or is flagged with the ``'stop'`` user
+    attribute. Returns the number of trials run by this worker.
+    """
+    import optuna
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    study = optuna.load_study(
+        study_name=study_name,
+        storage=_make_optuna_storage(storage),
+        sampler=optuna.samplers.TPESampler(
+            n_startup_trials=n_startup_trials,
+            seed=seed,
+            constant_liar=True,  ## Spread out trials that are running in other workers
+        ),
+    )
+    n_trials = [0]
+    def callback(study, trial):
+        n_trials[0] += 1
+        if study.user_attrs.get('stop', False):
+            study.stop()
+    study.optimize(
+        func=_findParameters_worker_data['clusterer']._objectiveFn_distSameMagnitude,
+        n_trials=max_trials,
+        callbacks=[optuna.study.MaxTrialsCallback(max_trials, states=None), callback],
+        show_progress_bar=False,
+    )
+    return n_trials[0]
+
+
 def attach_fully_connected_node(
     d: object,
     dist_fullyConnectedNode: Optional[float] = None,
@@ -1313,10 +2194,516 @@ def attach_fully_connected_node(
     if dist_fullyConnectedNode is None:
         dist_fullyConnectedNode = (d.max() - d.min()) * 1000
     
-    d2 = d.copy()
-    d2 = scipy.sparse.vstack((d2, np.ones((n_nodes,d2.shape[1]), dtype=d.dtype)*dist_fullyConnectedNode))
-    d2 = scipy.sparse.hstack((d2, np.ones((d2.shape[0],n_nodes), dtype=d.dtype)*dist_fullyConnectedNode))
-    return d2.tocsr()
+    ## Build the CSR arrays directly: each existing row gets ``n_nodes``
+    ##  entries appended at the new columns, and each new row is full. This
+    ##  avoids densifying the new row/column and a generic vstack/hstack.
+    d = d.tocsr()
+    n_rows, n_cols = d.shape
+    n_perRow = np.diff(d.indptr)
+    indptr = np.concatenate((
+        [0],
+        np.cumsum(np.concatenate((n_perRow + n_nodes, np.full(n_nodes, n_cols + n_nodes)))),
+    )).astype(np.int64)
+    n_head = indptr[n_rows]  ## number of entries in the existing rows
+    
+    ## Positions of the existing entries are shifted by ``n_nodes`` per preceding row
+    idx_orig = np.arange(d.nnz, dtype=np.int64) + n_nodes * np.repeat(np.arange(n_rows, dtype=np.int64), n_perRow)
+    isOrig = np.zeros(n_head, dtype=np.bool_)
+    isOrig[idx_orig] = True
+
+    data = np.full(indptr[-1], dist_fullyConnectedNode, dtype=d.dtype)
+    data[idx_orig] = d.data
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    indices[idx_orig] = d.indices
+    indices[:n_head][~isOrig] = np.tile(np.arange(n_cols, n_cols + n_nodes, dtype=np.int64), n_rows)
+    indices[n_head:] = np.tile(np.arange(n_cols + n_nodes, dtype=np.int64), n_nodes)
+
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=(n_rows + n_nodes, n_cols + n_nodes))
+
+
+@functools.lru_cache(maxsize=64)
+def make_activation_lookup_table(
+    sig_kwargs: Optional[Tuple[Tuple[str, float], ...]],
+    power: Optional[float],
+    p: float,
+    x_min: float,
+    x_max: float,
+    tolerance: float,
+    n_max: int = 2**22,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float]:
+    """
+    Makes lookup tables of the activation used in
+    ``Clusterer._activation_function`` (sigmoid, clamp at 0, then power) and of
+    its ``p``-th power, on an evenly spaced grid over ``[x_min, x_max]``. The
+    grid is refined until the activation changes by less than ``tolerance``
+    between any node and the midpoint next to it, which bounds the error of a
+    nearest-node lookup. Results are cached per set of arguments.
+
+    Args:
+        sig_kwargs (Optional[Tuple[Tuple[str, float], ...]]): 
+            Sorted items of the sigmoid keyword arguments (hashable form of the
+            dict). If ``None``, no sigmoid is applied.
+        power (Optional[float]): 
+            Power applied after the sigmoid. If ``None``, no power is applied.
+        p (float): 
+            Exponent of the second table (the p-norm exponent).
+        x_min (float): 
+            Smallest input value.
+        x_max (float): 
+            Largest input value.
+        tolerance (float): 
+            Maximum absolute error of the activation table.
+        n_max (int): 
+            Maximum number of grid steps. A warning is raised if
+            ``tolerance`` is not reached. (Default is ``2**22``)
+
+    Returns:
+        (Tuple): Tuple containing:
+            table_act (np.ndarray): 
+                Activation at each node. Shape: *(n_steps + 1,)*
+            table_pow (np.ndarray): 
+                ``table_act ** p``. Shape: *(n_steps + 1,)*
+            table_deriv (np.ndarray): 
+                Upper bound of ``a ** (p - 1)`` for activations ``a`` within
+                ``tolerance`` of ``table_act``. Used to bound the error of the
+                p-norm. Shape: *(n_steps + 1,)*
+            scale (float): 
+                Nodes per unit input. The node of ``x`` is ``round((x - x_min)
+                * scale)``.
+    """
+    sig_kwargs = dict(sig_kwargs) if sig_kwargs is not None else None
+    def fn_act(x):
+        x = helpers.generalised_logistic_function(x, **sig_kwargs) if sig_kwargs is not None else x
+        x = np.maximum(x, 0)
+        return x ** power if power is not None else x
+
+    span = x_max - x_min
+    if span <= 0:
+        n_steps = 1
+    else:
+        ## Initial guess from the largest slope, then refine until the
+        ##  node-to-midpoint change is below the tolerance
+        x_probe = np.linspace(x_min, x_max, 4097)
+        slope = np.nanmax(np.abs(np.diff(fn_act(x_probe)))) * 4096 / span
+        n_steps = int(min(max(np.ceil(span * slope / tolerance), 16), n_max))
+        while True:
+            f = fn_act(np.linspace(x_min, x_max, 2*n_steps + 1))
+            err = max(np.nanmax(np.abs(f[1::2] - f[:-1:2])), np.nanmax(np.abs(f[1::2] - f[2::2])))
+            if err <= tolerance:
+                break
+            if n_steps >= n_max:
+                warnings.warn(f'Activation lookup table reached n_max={n_max} steps with error {err} > tolerance={tolerance}.')
+                break
+            n_steps = min(n_steps * 2, n_max)
+
+    table_act = fn_act(np.linspace(x_min, x_max, n_steps + 1))
+    ## Bound of a**(p-1) within the table error. Infinite where the
+    ##  activation may reach 0 and p < 1.
+    a_bound = table_act - tolerance if p < 1 else table_act + tolerance
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        table_pow = table_act ** p
+        table_deriv = np.where(a_bound > 0, np.abs(a_bound) ** (p - 1), np.inf if p < 1 else 0)
+    tables = [t.astype(np.float32) for t in [table_act, table_pow, table_deriv]]
+    for t in tables:
+        t.flags.writeable = False
+    return (*tables, (n_steps / span if span > 0 else 0.0))
+
+
+def find_session_violations(
+    labels: np.ndarray,
+    session_bool: np.ndarray,
+) -> np.ndarray:
+    """
+    Finds the labels of clusters that contain more than one ROI from the same
+    session. Uses a single count over (label, session) pairs instead of one
+    pass per cluster.
+
+    Args:
+        labels (np.ndarray): 
+            Cluster labels. Shape: *(n_rois,)*
+        session_bool (np.ndarray): 
+            Boolean array indicating which ROIs belong to which session.
+            Shape: *(n_rois, n_sessions)*
+
+    Returns:
+        (np.ndarray): 
+            violations_labels (np.ndarray):
+                Sorted unique labels (including ``-1`` if it violates) of
+                clusters with multiple ROIs from one session.
+    """
+    labels = np.asarray(labels)
+    session_bool = scipy.sparse.csr_matrix(np.asarray(session_bool, dtype=np.float32))
+    l_u, l_idx = np.unique(labels, return_inverse=True)
+    ## (n_clusters, n_sessions) counts of ROIs
+    oneHot = scipy.sparse.csr_matrix((np.ones(len(labels), dtype=np.float32), (l_idx.reshape(-1), np.arange(len(labels)))), shape=(len(l_u), len(labels)))
+    counts = (oneHot @ session_bool).tocoo()
+    return l_u[np.unique(counts.row[counts.data > 1.5])]
+
+
+def disconnect_represented_sessions(
+    d: scipy.sparse.spmatrix,
+    labels: np.ndarray,
+    session_bool: np.ndarray,
+) -> scipy.sparse.csr_matrix:
+    """
+    Removes edges between ROIs in a cluster and ROIs outside of the cluster
+    that are from sessions already represented in the cluster. Edges within a
+    cluster and edges of unclustered ROIs (label ``-1``) to ROIs of
+    unrepresented sessions are kept. Zero-valued entries are removed. Runs in
+    one masked pass over the COO triples of ``d``.
+
+    Args:
+        d (scipy.sparse.spmatrix): 
+            Sparse distance graph. Shape: *(n_rois, n_rois)*
+        labels (np.ndarray): 
+            Cluster labels. ``-1`` is unclustered. Shape: *(n_rois,)*
+        session_bool (np.ndarray): 
+            Boolean array indicating which ROIs belong to which session. Each
+            ROI belongs to one session. Shape: *(n_rois, n_sessions)*
+
+    Returns:
+        (scipy.sparse.csr_matrix): 
+            d_out (scipy.sparse.csr_matrix):
+                Graph with the forbidden edges removed.
+    """
+    labels = np.asarray(labels)
+    session_bool = np.asarray(session_bool, dtype=np.bool_)
+    l_u, l_idx = np.unique(labels, return_inverse=True)
+    l_idx = l_idx.reshape(-1)
+    ## (n_clusters, n_sessions) sessions represented in each cluster. -1 represents nothing.
+    represented = (scipy.sparse.csr_matrix((np.ones(len(labels), dtype=np.float32), (l_idx, np.arange(len(labels)))), shape=(len(l_u), len(labels))) @ session_bool.astype(np.float32)) > 0
+    represented = np.asarray(represented, dtype=np.bool_)
+    represented[l_u == -1] = False
+
+    ## Session of each ROI. ROIs without a session are never disconnected.
+    idx_sesh, hasSesh = np.argmax(session_bool, axis=1), session_bool.any(axis=1)
+
+    d = d.tocoo()
+    r, c = d.row, d.col
+    r_l, c_l = l_idx[r], l_idx[c]
+    remove = (r_l != c_l) & (
+        (represented[r_l, idx_sesh[c]] & hasSesh[c]) |
+        (represented[c_l, idx_sesh[r]] & hasSesh[r])
+    )
+    keep = ~remove & (d.data != 0)
+    return scipy.sparse.csr_matrix((d.data[keep], (r[keep], c[keep])), shape=d.shape)
+
+
+def session_constrained_single_linkage(
+    d: scipy.sparse.spmatrix,
+    session_idx: np.ndarray,
+    d_cutoff: Optional[float] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Single-linkage clustering of a sparse distance graph under the constraint
+    that no cluster contains more than one node from the same session. Builds a
+    minimum spanning forest with Kruskal's algorithm and a union-find
+    structure: edges are visited in order of increasing distance, and an edge
+    is only merged if the two components have no session in common (tracked as
+    one bitset of sessions per component). The result never contains
+    violating clusters, so no correction passes are needed. Runtime is
+    dominated by sorting the edges, O(nnz log nnz).
+
+    Args:
+        d (scipy.sparse.spmatrix): 
+            Sparse distance graph. Shape: *(n_nodes, n_nodes)*. Only stored
+            entries are considered edges. Both triangles may be stored; the
+            smallest distance of each pair is used.
+        session_idx (np.ndarray): 
+            Session index of each node. Shape: *(n_nodes,)*
+        d_cutoff (Optional[float]): 
+            Only edges with distances below this value are merged. If ``None``,
+            all stored edges are used. (Default is ``None``)
+
+    Returns:
+        (Tuple): tuple containing:
+            labels (np.ndarray): 
+                Component ID of each node (the index of the component's root
+                node). Shape: *(n_nodes,)*
+            edges_merged (np.ndarray): 
+                Node pairs of the merged edges, in merge order. Shape:
+                *(n_merges, 2)*
+            d_merged (np.ndarray): 
+                Distances of the merged edges. Shape: *(n_merges,)*
+    """
+    n = d.shape[0]
+    session_idx = np.asarray(session_idx, dtype=np.int64)
+    assert session_idx.shape == (n,), f"session_idx must have shape ({n},). Got {session_idx.shape}."
+
+    d = d.tocoo()
+    lo, hi, v = np.minimum(d.row, d.col).astype(np.int64), np.maximum(d.row, d.col).astype(np.int64), np.asarray(d.data, dtype=np.float64)
+    ## Drop self-edges, edges within a session, and edges that are too long
+    mask = (lo != hi) & (session_idx[lo] != session_idx[hi]) & np.isfinite(v)
+    mask = mask & (v < d_cutoff) if d_cutoff is not None else mask
+    lo, hi, v = lo[mask], hi[mask], v[mask]
+
+    ## Sort by distance (ties broken by node pair) and keep the shortest copy of each pair
+    key = lo * n + hi
+    order = np.lexsort((key, v))
+    _, idx_first = np.unique(key[order], return_index=True)
+    order = order[np.sort(idx_first)]
+    lo, hi, v = lo[order], hi[order], v[order]
+
+    ## Kruskal with union-find (path halving, union by size). Python lists and
+    ##  ints are much faster than numpy scalars for this element-wise loop.
+    parent = list(range(n))
+    size = [1] * n
+    sessions = [1 << s for s in session_idx.tolist()]  ## arbitrary precision bitsets
+    idx_merged = []
+    for k, (a, b) in enumerate(zip(lo.tolist(), hi.tolist())):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        if (a == b) or (sessions[a] & sessions[b]):
+            continue
+        if size[a] < size[b]:
+            a, b = b, a
+        parent[b] = a
+        size[a] += size[b]
+        sessions[a] |= sessions[b]
+        idx_merged.append(k)
+
+    ## Resolve all nodes to their roots
+    labels = np.array(parent, dtype=np.int64)
+    while True:
+        labels_next = labels[labels]
+        if np.array_equal(labels_next, labels):
+            break
+        labels = labels_next
+
+    idx_merged = np.array(idx_merged, dtype=np.int64)
+    return labels, np.stack([lo[idx_merged], hi[idx_merged]], axis=1), v[idx_merged]
+
+
+def linear_sum_assignment_sparse(
+    rows: np.ndarray,
+    cols: np.ndarray,
+    costs: np.ndarray,
+    shape: Tuple[int, int],
+    cost_missing: float = 1.0,
+    n_workers: int = 1,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Solves a rectangular assignment problem where only a sparse set of
+    candidate pairs can be matched and all other pairs cost
+    ``cost_missing``. The bipartite graph of candidate pairs is split into
+    connected components and ``scipy.optimize.linear_sum_assignment`` is run
+    on a small dense matrix for each component. Because every non-candidate
+    pair has the same cost, this gives the same optimum as solving the full
+    dense problem.
+
+    Args:
+        rows (np.ndarray): 
+            Row index of each candidate pair. Shape: *(n_candidates,)*
+        cols (np.ndarray): 
+            Column index of each candidate pair. Shape: *(n_candidates,)*
+        costs (np.ndarray): 
+            Cost of each candidate pair. Must be less than ``cost_missing``.
+            Shape: *(n_candidates,)*
+        shape (Tuple[int, int]): 
+            Shape of the full cost matrix, *(n_rows, n_cols)*.
+        cost_missing (float): 
+            Cost of all pairs that are not candidates. (Default is *1.0*)
+        n_workers (int): 
+            Number of threads used to solve components. ``-1`` uses all
+            cores. ``linear_sum_assignment`` releases the GIL. (Default is
+            *1*)
+
+    Returns:
+        (Tuple): tuple containing:
+            rows_matched (np.ndarray): 
+                Row indices of matched candidate pairs, sorted.
+            cols_matched (np.ndarray): 
+                Column indices of matched candidate pairs.
+            costs_matched (np.ndarray): 
+                Costs of matched candidate pairs.
+    """
+    rows, cols, costs = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64), np.asarray(costs, dtype=np.float64)
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    assert np.all(costs < cost_missing), 'All candidate costs must be less than cost_missing.'
+
+    ## Connected components of the bipartite graph (rows are nodes [0, n_rows), columns are nodes [n_rows, n_rows + n_cols))
+    n_rows, n_cols = shape
+    graph = scipy.sparse.coo_matrix((np.ones(len(rows), dtype=np.bool_), (rows, cols + n_rows)), shape=(n_rows + n_cols, n_rows + n_cols))
+    _, labels_comp = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    comp_edge = labels_comp[rows]
+
+    ## Components with a single row or a single column: the cheapest edge wins
+    n_rows_comp = np.bincount(labels_comp[:n_rows][np.bincount(rows, minlength=n_rows) > 0], minlength=len(labels_comp))
+    n_cols_comp = np.bincount(labels_comp[n_rows:][np.bincount(cols, minlength=n_cols) > 0], minlength=len(labels_comp))
+    isTrivial = np.minimum(n_rows_comp, n_cols_comp)[comp_edge] == 1
+    order = np.flatnonzero(isTrivial)[np.lexsort((costs[isTrivial], comp_edge[isTrivial]))]
+    order = order[np.concatenate([[True], np.diff(comp_edge[order]) != 0])] if len(order) > 0 else order
+    out = [(rows[order], cols[order], costs[order])]
+
+    ## Other components: Hungarian algorithm on a dense matrix per component
+    order = np.flatnonzero(~isTrivial)
+    order = order[np.argsort(comp_edge[order], kind='stable')]
+    idx_split = np.flatnonzero(np.diff(comp_edge[order])) + 1
+    comps = [(rows[idx], cols[idx], costs[idx]) for idx in np.split(order, idx_split)] if len(order) > 0 else []
+
+    def solve(r, c, v):
+        r_u, r_i = np.unique(r, return_inverse=True)
+        c_u, c_i = np.unique(c, return_inverse=True)
+        D = np.full((len(r_u), len(c_u)), cost_missing, dtype=np.float64)
+        D[r_i.reshape(-1), c_i.reshape(-1)] = v
+        ri, ci = scipy.optimize.linear_sum_assignment(D)
+        keep = D[ri, ci] < cost_missing
+        return r_u[ri[keep]], c_u[ci[keep]], D[ri[keep], ci[keep]]
+
+    if (n_workers == 1) or (len(comps) == 0):
+        out += [solve(*comp) for comp in comps]
+    else:
+        out += helpers.map_parallel(solve, [list(x) for x in zip(*comps)], method='multithreading', n_workers=n_workers, prog_bar=False)
+
+    r_m, c_m, v_m = (np.concatenate(x) for x in zip(*out))
+    order = np.argsort(r_m, kind='stable')
+    return r_m[order], c_m[order], v_m[order]
+
+
+def _cancel_negative_cycles_labels(
+    cols_assigned: np.ndarray,
+    rows: np.ndarray,
+    cols: np.ndarray,
+    vals: np.ndarray,
+    n_true: np.ndarray,
+    n_test: np.ndarray,
+    s_true: np.ndarray,
+    s_test: np.ndarray,
+    tol: float = 1e-12,
+) -> np.ndarray:
+    """
+    Improves an assignment of true labels to test labels until its total
+    correlation is the exact maximum. Used by ``score_labels``.
+
+    The assignment is written as a flow. Overlapping pairs are direct arcs
+    valued by their correlation. All other pairs are routed true label ->
+    true set size -> test set size -> test label and valued ``-s_a*s_b`` on
+    the size-to-size arc. This is the exact correlation of non-overlapping
+    pairs and a lower bound for overlapping pairs, so the flow problem has the
+    same optimum as the dense one while staying sparse. Negative cycles of the
+    residual graph are found with Bellman-Ford and canceled until there are
+    none left, which proves optimality.
+
+    Args:
+        cols_assigned (np.ndarray):
+            Test label assigned to each true label. Shape: *(n_true_labels,)*
+        rows (np.ndarray):
+            True label of each overlapping pair.
+        cols (np.ndarray):
+            Test label of each overlapping pair.
+        vals (np.ndarray):
+            Correlation of each overlapping pair.
+        n_true (np.ndarray):
+            Size of each true set. Shape: *(n_true_labels,)*
+        n_test (np.ndarray):
+            Size of each test set, padded with empty sets. Shape:
+            *(n_test_labels,)*
+        s_true (np.ndarray):
+            ``sqrt(n / (N - n))`` of each true set.
+        s_test (np.ndarray):
+            ``sqrt(n / (N - n))`` of each test set.
+        tol (float):
+            Minimum decrease of a path cost that counts as an improvement.
+            (Default is *1e-12*)
+
+    Returns:
+        (np.ndarray):
+            cols_assigned (np.ndarray):
+                Optimal test label assigned to each true label.
+    """
+    na, nb, n_e = len(n_true), len(n_test), len(rows)
+    sizes_true, group_true = np.unique(n_true, return_inverse=True)
+    sizes_test, group_test = np.unique(n_test, return_inverse=True)
+    group_true, group_test = group_true.reshape(-1), group_test.reshape(-1)
+    n_g, n_h = len(sizes_true), len(sizes_test)
+    s_g, s_h = np.zeros(n_g), np.zeros(n_h)
+    s_g[group_true], s_h[group_test] = s_true, s_test
+
+    ## Nodes: [true labels, true set sizes, test set sizes, test labels, sink]
+    ## Arcs: [direct pairs, true label -> size, size -> size, size -> test label, test label -> sink]
+    o_g, o_h, o_b = na, na + n_g, na + n_g + n_h
+    n_nodes = o_b + nb + 1
+    g_z, h_z = np.divmod(np.arange(n_g * n_h), n_h)
+    i_y, i_z = n_e, n_e + na
+    i_w, i_t = i_z + n_g * n_h, i_z + n_g * n_h + nb
+    arc_u = np.concatenate([rows, np.arange(na), o_g + g_z, o_h + group_test, o_b + np.arange(nb)])
+    arc_v = np.concatenate([o_b + cols, o_g + group_true, o_h + h_z, o_b + np.arange(nb), np.full(nb, n_nodes - 1)])
+    arc_cost = np.concatenate([-vals, np.zeros(na), (s_g[:, None] * s_h[None, :]).reshape(-1), np.zeros(nb * 2)])
+    arc_cap = np.concatenate([np.ones(n_e + na), np.full(n_g * n_h, na), np.ones(nb * 2)]).astype(np.int64)
+
+    ## Flow of the initial assignment
+    flow = np.zeros(len(arc_u), dtype=np.int64)
+    id_direct = scipy.sparse.csr_matrix((np.arange(1, n_e + 1), (rows, cols)), shape=(na, nb))
+    idx_direct = np.asarray(id_direct[np.arange(na), cols_assigned]).reshape(-1) - 1
+    flow[idx_direct[idx_direct >= 0]] = 1
+    routed = np.flatnonzero(idx_direct < 0)
+    flow[i_y + routed] = 1
+    np.add.at(flow, i_z + group_true[routed] * n_h + group_test[cols_assigned[routed]], 1)
+    flow[i_w + cols_assigned[routed]] = 1
+    flow[i_t + cols_assigned] = 1
+
+    n_canceled = 0
+    while True:
+        ## Residual graph
+        res_arc = np.concatenate([np.flatnonzero(flow < arc_cap), np.flatnonzero(flow > 0)])
+        res_dir = np.where(np.arange(len(res_arc)) < (flow < arc_cap).sum(), 1, -1)
+        res_u = np.where(res_dir > 0, arc_u[res_arc], arc_v[res_arc])
+        res_v = np.where(res_dir > 0, arc_v[res_arc], arc_u[res_arc])
+        res_cost = arc_cost[res_arc] * res_dir
+
+        ## Bellman-Ford from a virtual source connected to all nodes. A cycle
+        ##  in the predecessor graph is a negative cycle.
+        dist, pred = np.zeros(n_nodes), np.full(n_nodes, -1, dtype=np.int64)
+        cycle = None
+        for i_iter in range(n_nodes + 1):
+            cand = dist[res_u] + res_cost
+            best = np.full(n_nodes, np.inf)
+            np.minimum.at(best, res_v, cand)
+            isImproved = best < dist - tol
+            if not isImproved.any():
+                break
+            isArg = isImproved[res_v] & (cand == best[res_v])
+            pred[res_v[isArg]] = np.flatnonzero(isArg)
+            dist[isImproved] = best[isImproved]
+            if (i_iter % 8 == 7) or (i_iter == n_nodes):
+                ### Pointer doubling lands every node on a root or on a cycle
+                node_pred = np.where(pred >= 0, res_u[np.maximum(pred, 0)], np.arange(n_nodes))
+                node_end = node_pred.copy()
+                for _ in range(int(np.ceil(np.log2(n_nodes))) + 1):
+                    node_end = node_end[node_end]
+                node_end = node_end[node_pred[node_end] != node_end]
+                if len(node_end) > 0:
+                    cycle, node = [pred[node_end[0]]], node_pred[node_end[0]]
+                    while node != node_end[0]:
+                        cycle.append(pred[node])
+                        node = node_pred[node]
+                    break
+        if cycle is None:
+            break
+        flow[res_arc[cycle]] += res_dir[cycle]
+        n_canceled += 1
+
+    if n_canceled == 0:
+        return cols_assigned
+
+    ## Direct pairs, then routed pairs: the k-th true label routed to a test
+    ##  set size gets the k-th test label routed from that size.
+    cols_assigned = np.full(na, -1, dtype=np.int64)
+    isMatched = flow[:n_e] > 0
+    cols_assigned[rows[isMatched]] = cols[isMatched]
+    rows_routed = np.flatnonzero(flow[i_y:i_z] > 0)
+    rows_routed = rows_routed[np.argsort(group_true[rows_routed], kind='stable')]
+    h_routed = np.concatenate([np.repeat(np.arange(n_h), flow[i_z:i_w].reshape(n_g, n_h)[g]) for g in range(n_g)])
+    cols_routed = np.flatnonzero(flow[i_w:i_t] > 0)
+    cols_routed = cols_routed[np.argsort(group_test[cols_routed], kind='stable')]
+    cols_assigned[rows_routed[np.argsort(h_routed, kind='stable')]] = cols_routed
+    return cols_assigned
 
 
 def score_labels(
@@ -1332,7 +2719,13 @@ def score_labels(
     The score is not symmetric if the number of true and test labels are not the
     same. I.e., switching ``labels_test`` and ``labels_true`` can lead to
     different scores. This is because we are scoring how well each true set is
-    matched by an optimally assigned test set.
+    matched by an optimally assigned test set. The correlations between label
+    indicator vectors are computed from a sparse contingency table. The
+    assignment is first solved with a sparse hungarian algorithm over the
+    overlapping pairs and then made exact by canceling negative cycles of a
+    sparse flow network (see ``_cancel_negative_cycles_labels``), so memory
+    scales with the number of samples rather than with the number of labels
+    squared.
     
     RH 2022
     
@@ -1384,32 +2777,86 @@ def score_labels(
         labels_test = labels_test[labels_true > -1].copy()
         labels_true = labels_true[labels_true > -1].copy()
 
-    ## convert labels to boolean
-    bool_test = np.stack([labels_test==l for l in np.unique(labels_test)], axis=0).astype(np.float32)
-    bool_true = np.stack([labels_true==l for l in np.unique(labels_true)], axis=0).astype(np.float32)
-
-    if bool_test.shape[0] < bool_true.shape[0]:
-        bool_test = np.concatenate((bool_test, np.zeros((bool_true.shape[0] - bool_test.shape[0], bool_true.shape[1]))))
-
-    ## compute cross-correlation matrix, and crop to 
-    na = bool_true.shape[0]
-    cc = np.corrcoef(x=bool_true, y=bool_test)[:na][:,na:]  ## corrcoef returns the concatenated cross-corr matrix (self corr mat along diagonal). The indexing at the end is to extract just the cross-corr mat
-    cc[np.isnan(cc)] = 0
-
-    ## find hungarian assignment matching indices
-    hi = scipy.optimize.linear_sum_assignment(
-        cost_matrix=cc,
-        maximize=True,
+    ## Sparse contingency table of true (rows) and test (columns) labels
+    _, idx_true, n_true = np.unique(np.asarray(labels_true), return_inverse=True, return_counts=True)
+    _, idx_test, n_test = np.unique(np.asarray(labels_test), return_inverse=True, return_counts=True)
+    idx_true, idx_test = idx_true.reshape(-1), idx_test.reshape(-1)
+    n_samples, na, nb = len(idx_true), len(n_true), len(n_test)
+    ct = scipy.sparse.coo_matrix((np.ones(n_samples), (idx_true, idx_test)), shape=(na, nb)).tocsr()
+    ct.sum_duplicates()
+
+    ## Correlation of two indicator vectors from counts:
+    ##  (N*n_ab - n_a*n_b) / sqrt(n_a*(N-n_a) * n_b*(N-n_b)). It is 0 if
+    ##  either vector is constant. For non-overlapping sets (n_ab == 0) it
+    ##  factorizes into -s_a*s_b, with s = sqrt(n / (N-n)).
+    def fn_s(n):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where((n > 0) & (n < n_samples), np.sqrt(n / (n_samples - n)), 0.0)
+    s_true, s_test = fn_s(n_true), fn_s(n_test)
+    def fn_corr(a, b, n_ab):
+        n_a, n_b = n_true[a].astype(np.float64), n_test[b].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cc = (n_samples * n_ab - n_a * n_b) / np.sqrt(n_a * (n_samples - n_a) * n_b * (n_samples - n_b))
+        cc[~np.isfinite(cc)] = 0
+        return np.clip(cc, -1, 1)
+
+    ## Initial assignment: sparse hungarian (maximize correlation) over the
+    ##  overlapping pairs. Each true label can instead take a private
+    ##  placeholder valued as matching the smallest remaining test label
+    ##  (-s_a*s_out). Costs are shifted to be positive, which does not change
+    ##  the assignment since each true label takes exactly one edge.
+    ct_coo = ct.tocoo()
+    rows, cols, vals = ct_coo.row.astype(np.int64), ct_coo.col.astype(np.int64), fn_corr(ct_coo.row, ct_coo.col, ct_coo.data)
+    s_out = 0.0 if nb < na else s_test.min()
+    graph = scipy.sparse.csr_matrix((
+        np.concatenate([2 - vals, 2 + s_true * s_out]),
+        (np.concatenate([rows, np.arange(na)]), np.concatenate([cols, nb + np.arange(na)])),
+    ), shape=(na, nb + na))
+    ri, ci = scipy.sparse.csgraph.min_weight_full_bipartite_matching(graph)
+    matched_rows, matched_cols = ri[ci < nb].astype(np.int64), ci[ci < nb].astype(np.int64)
+
+    ## Remaining true labels get the remaining test labels (padded with empty
+    ##  sets of correlation 0 if there are fewer test than true labels).
+    ##  Their correlations are -s_a*s_b, so the best assignment pairs the
+    ##  largest s_a with the smallest s_b.
+    nb_pad = max(nb, na)
+    cols_assigned = np.full(na, -1, dtype=np.int64)
+    cols_assigned[matched_rows] = matched_cols
+    rows_left = np.flatnonzero(cols_assigned == -1)
+    isFree = np.ones(nb_pad, dtype=np.bool_)
+    isFree[matched_cols] = False
+    cols_free = np.flatnonzero(isFree)
+    s_test_pad = np.concatenate([s_test, np.zeros(nb_pad - nb)])
+    rows_left = rows_left[np.argsort(-s_true[rows_left], kind='stable')]
+    cols_free = cols_free[np.argsort(s_test_pad[cols_free], kind='stable')][:len(rows_left)]
+    cols_assigned[rows_left] = cols_free
+
+    ## The placeholders ignore that the remaining test labels differ in size.
+    ##  Make the assignment exact.
+    n_test_pad = np.concatenate([n_test, np.zeros(nb_pad - nb, dtype=n_test.dtype)])
+    cols_assigned = _cancel_negative_cycles_labels(
+        cols_assigned=cols_assigned,
+        rows=rows,
+        cols=cols,
+        vals=vals,
+        n_true=n_true,
+        n_test=n_test_pad,
+        s_true=s_true,
+        s_test=s_test_pad,
     )
 
+    hi = (np.arange(na), cols_assigned)
+
     ## extract correlation scores of matches
-    cc_matched = cc[hi[0], hi[1]]
+    cc_matched = np.zeros(na, dtype=np.float64)
+    isReal = cols_assigned < nb
+    cc_matched[isReal] = fn_corr(hi[0][isReal], cols_assigned[isReal], np.asarray(ct[hi[0][isReal], cols_assigned[isReal]]).reshape(-1))
 
     ## compute score
-    score_weighted_partial = np.sum(cc_matched * bool_true.sum(axis=1)[hi[0]]) / bool_true[hi[0]].sum()
+    score_weighted_partial = np.sum(cc_matched * n_true[hi[0]]) / n_true[hi[0]].sum()
     score_unweighted_partial = np.mean(cc_matched)
     ## compute perfect score
-    score_weighted_perfect = np.sum(bool_true.sum(axis=1)[hi[0]] * (cc_matched > thresh_perfect)) / bool_true[hi[0]].sum()
+    score_weighted_perfect = np.sum(n_true[hi[0]] * (cc_matched > thresh_perfect)) / n_true[hi[0]].sum()
     score_unweighted_perfect = np.mean(cc_matched > thresh_perfect)
     
     ## compute adjusted rand score
@@ -1460,21 +2907,92 @@ def cluster_quality_metrics(
             cs_sil (np.ndarray):
                 Cluster silhouette score. (shape: *(n_clusters,)*)
     """
-    import sparse
-    
-    labels_unique, cs_mean, cs_max, cs_min = helpers.compute_cluster_similarity_matrices(sim, labels, verbose=True)
+    labels_unique, cs_mean, cs_max, cs_min = helpers.compute_cluster_similarity_matrices(sim, labels, verbose=True, return_sparse=True)
     fn_sil_score = lambda intra, inter: (intra - inter) / np.maximum(intra, inter)
 
-    eye_inv = 1 - sparse.eye(cs_max.shape[0])
-
     cs_intra_means = cs_mean.diagonal()
-    cs_inter_maxOfMaxs = (eye_inv * cs_max).max(0)
+    ## Max over other clusters. Similarities are non-negative, so the implicit
+    ##  zeros of the sparse matrix do not change the max.
+    cs_max_offDiag = cs_max.tocoo(copy=True)
+    cs_max_offDiag.data[cs_max_offDiag.row == cs_max_offDiag.col] = 0
+    cs_inter_maxOfMaxs = cs_max_offDiag.tocsc().max(axis=0).toarray().reshape(-1)
     cs_sil = fn_sil_score(cs_intra_means, cs_inter_maxOfMaxs)
     cs_intra_mins = cs_min.diagonal()
     cs_intra_maxs = cs_max.diagonal()
     
     return labels_unique, cs_intra_means, cs_intra_mins, cs_intra_maxs, cs_sil
 
+def silhouette_samples_sparse(
+    d: scipy.sparse.csr_matrix,
+    labels: np.ndarray,
+    fill_value: float,
+) -> np.ndarray:
+    """
+    Computes the silhouette score of each sample from a sparse distance
+    matrix. Distances that are not stored in ``d`` are treated as
+    ``fill_value`` analytically, so the result equals
+    ``sklearn.metrics.silhouette_samples(X=d_dense, labels=labels,
+    metric='precomputed')`` on the densified matrix (with a zero diagonal),
+    without allocating it. Per-sample intra-cluster and nearest-other-cluster
+    mean distances are computed from the stored entries, so time and memory
+    are O(nnz log nnz + n_samples).
+
+    Args:
+        d (scipy.sparse.csr_matrix):
+            Sparse distance matrix. Shape: *(n_samples, n_samples)*. Stored
+            entries (including stored zeros) are used as is. The diagonal is
+            ignored.
+        labels (np.ndarray):
+            Cluster labels. Shape: *(n_samples,)*. All labels, including
+            ``-1``, are treated as clusters.
+        fill_value (float):
+            Distance used for all entries that are not stored in ``d``.
+
+    Returns:
+        (np.ndarray): 
+            sil (np.ndarray):
+                Silhouette score of each sample. Samples in clusters of size 1
+                have a score of 0. Shape: *(n_samples,)*
+    """
+    n = d.shape[0]
+    labels = np.asarray(labels)
+    assert labels.shape == (n,), f"labels must have shape ({n},). Got {labels.shape}."
+    _, lab, freqs = np.unique(labels, return_inverse=True, return_counts=True)
+    lab = lab.reshape(-1).astype(np.int64)
+    n_labels = len(freqs)
+    if not 1 < n_labels < n:
+        raise ValueError(f"Number of labels is {n_labels}. Valid values are 2 to n_samples - 1 (inclusive)")
+
+    d = d.tocoo()
+    mask = d.row != d.col
+    rows, cols, vals = d.row[mask].astype(np.int64), d.col[mask].astype(np.int64), d.data[mask].astype(np.float64)
+
+    ## Sum and count of stored distances for each (sample, cluster) pair
+    key = rows * n_labels + lab[cols]
+    key_u, inv = np.unique(key, return_inverse=True)
+    seg_sum = np.bincount(inv.reshape(-1), weights=vals, minlength=len(key_u))
+    seg_count = np.bincount(inv.reshape(-1), minlength=len(key_u))
+    seg_row, seg_lab = key_u // n_labels, key_u % n_labels
+    isIntra = seg_lab == lab[seg_row]
+    ## Add the missing distances (the diagonal is 0 and not missing)
+    seg_sum = seg_sum + fill_value * (freqs[seg_lab] - seg_count - isIntra)
+
+    ## Intra-cluster distance: all fill_value if no stored entries
+    intra = fill_value * (freqs[lab] - 1).astype(np.float64)
+    intra[seg_row[isIntra]] = seg_sum[isIntra]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intra = intra / (freqs[lab] - 1)
+
+    ## Nearest other cluster: fill_value if any other cluster has no stored entries
+    n_other_stored = np.bincount(seg_row[~isIntra], minlength=n)
+    inter = np.where(n_other_stored < n_labels - 1, fill_value, np.inf)
+    np.minimum.at(inter, seg_row[~isIntra], seg_sum[~isIntra] / freqs[seg_lab[~isIntra]])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sil = (inter - intra) / np.maximum(intra, inter)
+    ## nan values are for clusters of size 1, and should be 0
+    return np.nan_to_num(sil)
+
 def make_label_variants(
     labels: np.ndarray, 
     n_roi_bySession: np.ndarray,
@@ -1,4 +1,7 @@
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
 from typing import Tuple, Union, List, Optional, Dict, Any, Callable
 
 import scipy.sparse
@@ -36,10 +39,21 @@ class ROI_graph(util.ROICaT_Module):
             The width of the block. (Default is ``100``)
         overlapping_width_Multiplier (float):
             The multiplier for the overlapping width. (Default is ``0.0``)
+        method_spatialFootprints (str):
+            The method used to compute the pairwise spatial footprint
+            similarity (s_sf) within each block. Either \n
+            * ``'sparse_overlap'``: Computes the Manhattan distance exactly from
+              the co-occurrence of pixels between pairs of ROIs, only for
+              pairs that overlap. Cost scales with the number of overlapping
+              pixel pairs. 
+            * ``'nearest_neighbors'``: Uses sklearn.neighbors.NearestNeighbors
+              to compute all pairwise Manhattan distances in the block. \n
+            (Default is ``'sparse_overlap'``)
         algorithm_nearestNeigbors_spatialFootprints (str):
             The algorithm to use for the nearest neighbors computation. See
-            sklearn.neighbors.NearestNeighbors for more information. (Default is
-            ``'brute'``)
+            sklearn.neighbors.NearestNeighbors for more information. Only used
+            if ``method_spatialFootprints`` is ``'nearest_neighbors'``.
+            (Default is ``'brute'``)
         verbose (bool):
             If set to ``True``, outputs will be verbose. (Default is ``True``)
         **kwargs_nearestNeigbors_spatialFootprints (dict):
@@ -64,6 +78,7 @@ class ROI_graph(util.ROICaT_Module):
         block_height: int = 100,
         block_width: int = 100,
         overlapping_width_Multiplier: float = 0.0,
+        method_spatialFootprints: str = 'sparse_overlap',
         algorithm_nearestNeigbors_spatialFootprints: str = 'brute',
         verbose: bool = True,
         kwargs_nearestNeigbors_spatialFootprints: dict = {},
@@ -84,12 +99,15 @@ class ROI_graph(util.ROICaT_Module):
                 'block_height',
                 'block_width',
                 'overlapping_width_Multiplier',
+                'method_spatialFootprints',
                 'algorithm_nearestNeigbors_spatialFootprints',
                 'verbose',
                 'kwargs_nearestNeigbors_spatialFootprints',
             ],
         )
 
+        assert method_spatialFootprints in ['sparse_overlap', 'nearest_neighbors'], f"method_spatialFootprints must be one of ['sparse_overlap', 'nearest_neighbors']. Found: {method_spatialFootprints}"
+        self._method_sf = method_spatialFootprints
         self._algo_sf = algorithm_nearestNeigbors_spatialFootprints
         self._kwargs_sf = kwargs_nearestNeigbors_spatialFootprints
 
@@ -109,13 +127,8 @@ class ROI_graph(util.ROICaT_Module):
             overlapping_width_Multiplier=overlapping_width_Multiplier,
             clamp_blocks_to_frame=True,
         )
-
-        self.idxPixels_block = []
-        for block in self.blocks:
-            idx_tmp = np.zeros((self._frame_height, self._frame_width), dtype=np.bool_)
-            idx_tmp[block[0][0]:block[0][1], block[1][0]:block[1][1]] = True
-            idx_tmp = np.where(idx_tmp.reshape(-1))[0]
-            self.idxPixels_block.append(idx_tmp)
+        ## Block rectangles as an array: [[y_start, y_end, x_start, x_end], ...]
+        self._blocks_rect = np.array([[b[0][0], b[0][1], b[1][0], b[1][1]] for b in self.blocks], dtype=np.int64).reshape(-1, 4)
 
     def compute_similarity_blockwise(
         self,
@@ -124,10 +137,14 @@ class ROI_graph(util.ROICaT_Module):
         features_SWT: torch.Tensor,
         ROI_session_bool: torch.Tensor,
         spatialFootprint_maskPower: float = 1.0,
+        method_parallel: str = 'serial',
+        n_processes: Optional[int] = None,
     ) -> None:
         """
         Computes the similarity graph between ROIs and updates the instance
-        attributes: ``s_sf``, ``s_NN``, ``s_SWT``, ``s_sesh``.
+        attributes: ``s_sf``, ``s_NN``, ``s_SWT``, ``s_sesh``, ``bboxes_ROI``
+        (bounding box of each ROI), and ``timings_blocks`` (per-block durations
+        and ROI counts).
 
         Args:
             spatialFootprints (scipy.sparse.csr_matrix): 
@@ -149,6 +166,21 @@ class ROI_graph(util.ROICaT_Module):
                 more binary looking, and high values (e.g., 2.0) to make the
                 pairwise similarities highly dependent on the relative
                 intensities of the pixels in each mask. (Default is ``1.0``)
+            method_parallel (str):
+                How to schedule the blocks. Either \n
+                * ``'serial'``: Blocks are computed one after another in this
+                  process. \n
+                * ``'multiprocessing'``: Blocks are computed in a pool of
+                  worker processes. The concatenated spatial footprints,
+                  features, and session array are placed in shared memory so
+                  that each worker only receives the ROI indices of its block.
+                  \n
+                (Default is ``'serial'``)
+            n_processes (Optional[int]):
+                Number of worker processes to use if ``method_parallel ==
+                'multiprocessing'``. If ``None``, ``n_workers`` (or the number
+                of cpu cores if ``n_workers == -1``) is used. (Default is
+                ``None``)
 
         Returns:
             (tuple): tuple containing:
@@ -164,7 +196,8 @@ class ROI_graph(util.ROICaT_Module):
         ## Store parameter (but not data) args as attributes
         self.params['compute_similarity_blockwise'] = self._locals_to_params(
             locals_dict=locals(),
-            keys=['spatialFootprint_maskPower',],)
+            keys=['spatialFootprint_maskPower', 'method_parallel', 'n_processes'],)
+        assert method_parallel in ['serial', 'multiprocessing'], f"method_parallel must be one of ['serial', 'multiprocessing'], got {method_parallel}"
 
         self._n_sessions = ROI_session_bool.shape[1]
         self._sf_maskPower = spatialFootprint_maskPower
@@ -177,82 +210,162 @@ class ROI_graph(util.ROICaT_Module):
 
         self.s_SWT = scipy.sparse.csr_matrix((n_roi, n_roi))
 
+        ## Find the ROIs in each block. Blocks are dispatched largest-first so
+        ##  that the slowest blocks do not end up at the tail of the schedule.
+        self.bboxes_ROI = get_ROI_bounding_boxes(self.sf_cat, frame_width=self._frame_width)
+        idxROI_blocks = find_ROIs_in_blocks(
+            sf=self.sf_cat,
+            blocks_rect=self._blocks_rect,
+            frame_height=self._frame_height,
+            frame_width=self._frame_width,
+            bboxes=self.bboxes_ROI,
+        )
+        order_blocks = np.argsort([-len(idx) for idx in idxROI_blocks], kind='stable')
+        results = {}
+
         print('Computing pairwise similarity between ROIs...') if self._verbose else None
-        for ii, block in tqdm(enumerate(self.blocks), total=len(self.blocks), mininterval=10):
-            idxROI_block = np.where(self.sf_cat[:, self.idxPixels_block[ii]].sum(1) > 0)[0]
-            
-            ## Compute pairwise similarity matrix
-            s_sf, s_NN, s_SWT, s_sesh = self._helper_compute_ROI_similarity_graph(
-                spatialFootprints=self.sf_cat[idxROI_block].power(self._sf_maskPower),
-                features_NN=features_NN[idxROI_block],
-                features_SWT=features_SWT[idxROI_block],
-                ROI_session_bool=ROI_session_bool[idxROI_block],
+        if method_parallel == 'serial':
+            for ii in tqdm(order_blocks, total=len(self.blocks), mininterval=10):
+                tic = time.time()
+                idxROI_block = idxROI_blocks[ii]
+                ## Compute pairwise similarity matrix
+                out = self._helper_compute_ROI_similarity_graph(
+                    spatialFootprints=self.sf_cat[idxROI_block].power(self._sf_maskPower),
+                    features_NN=features_NN[idxROI_block],
+                    features_SWT=features_SWT[idxROI_block],
+                    ROI_session_bool=ROI_session_bool[idxROI_block],
+                )
+                results[ii] = (*out, time.time() - tic)
+        elif method_parallel == 'multiprocessing':
+            results = self._compute_blocks_multiprocessing(
+                idxROI_block_all=idxROI_blocks,
+                order_blocks=order_blocks,
+                features_NN=features_NN,
+                features_SWT=features_SWT,
+                ROI_session_bool=ROI_session_bool,
+                n_processes=n_processes,
             )
-            if s_sf is None: # If there are no ROIs in this block, s_block will be None, so we should skip the rest of the loop
+
+        ## Per-block wall times (seconds) and ROI counts, in block order
+        self.timings_blocks = {
+            'duration': np.array([results[ii][4] for ii in range(len(self.blocks))]),
+            'n_roi': np.array([len(idx) for idx in idxROI_blocks]),
+        }
+        print(f'Block timings: total={self.timings_blocks["duration"].sum():.2f}s, max={self.timings_blocks["duration"].max():.2f}s (block {int(np.argmax(self.timings_blocks["duration"]))}, {self.timings_blocks["n_roi"][np.argmax(self.timings_blocks["duration"])]} ROIs)') if self._verbose and len(self.blocks) > 0 else None
+
+        ## Collect in block order so that the merge is deterministic
+        for ii in range(len(self.blocks)):
+            s_sf, s_NN, s_SWT, s_sesh, _ = results[ii]
+            if s_sf is None: # If there are no ROIs in this block, s_block will be None, so we should skip it
                 continue
             s_sf_all.append(s_sf)
             s_NN_all.append(s_NN)
             s_SWT_all.append(s_SWT)
             s_sesh_all.append(s_sesh)
-            idxROI_block_all.append(idxROI_block)
-
-            assert [len(s_NN.data)==len(s_sf.data), len(s_SWT.data)==len(s_sf.data), len(s_sesh.data)==len(s_sf.data)], 'The number of data elements in the similarity matrices should be the same.'
-        # return s_sf_all, s_NN_all, s_SWT_all, s_sesh_all, idxROI_block_all
+            idxROI_block_all.append(idxROI_blocks[ii])
 
         print('Joining blocks into full similarity matrices...') if self._verbose else None
-        # self.s_sf = helpers.merge_sparse_arrays(s_sf_all, idxROI_block_all, (n_roi, n_roi), remove_redundant=True).tocsr()
-        # self.s_NN = helpers.merge_sparse_arrays(s_NN_all, idxROI_block_all, (n_roi, n_roi), remove_redundant=True).tocsr()
-        # self.s_SWT = helpers.merge_sparse_arrays(s_SWT_all, idxROI_block_all, (n_roi, n_roi), remove_redundant=True).tocsr()
-        # self.s_sesh = helpers.merge_sparse_arrays(s_sesh_all, idxROI_block_all, (n_roi, n_roi), remove_redundant=True).tocsr()
-
-        def merge_sparse_arrays(s_list, idx_list, shape, shift_val=None):
-            def csr_to_coo_idxd(s_csr, idx, shift_val, shape):
-                s_csr.data[s_csr.data < 0] = 1e-10
-                s_coo = s_csr.tocoo()
-                return scipy.sparse.coo_matrix(
-                    (s_coo.data + shift_val, (idx[s_coo.row], idx[s_coo.col])),
-                    shape=shape
-                )
-            if shift_val == None:
-                shift_val = min([s.min() for s in s_list]) + 1
-            
-            s_flat = scipy.sparse.vstack([
-                csr_to_coo_idxd(s, idx, shift_val, shape).reshape(1,-1).tocsr() for s, idx in zip(s_list, idx_list)
-            ]).tocsr()  ## for each block, expand the shape of the sparse similarity matrix to be (n_roi, n_roi) and then stack them all together
-            
-            s_flat = sparse.COO(s_flat).max(0)[None,:].to_scipy_sparse().tocsr()  ## It is MUCH faster to do this with sparse.COO than with scipy.sparse
-            
-            s_merged = s_flat.reshape(shape)
-            s_merged.data = s_merged.data - shift_val
-            return s_merged  ## the max operation is why it's so slow
-
-        print('Joining s_sf...') if self._verbose else None
-        self.s_sf = merge_sparse_arrays(s_sf_all, idxROI_block_all, (n_roi, n_roi)).tocsr()
-        print('Joining s_NN...') if self._verbose else None
-        self.s_NN = merge_sparse_arrays(s_NN_all, idxROI_block_all, (n_roi, n_roi)).tocsr()
-        print('Joining s_SWT...') if self._verbose else None
-        self.s_SWT = merge_sparse_arrays(s_SWT_all, idxROI_block_all, (n_roi, n_roi)).tocsr()
-        print('Joining s_sesh...') if self._verbose else None
-        self.s_sesh = merge_sparse_arrays(s_sesh_all, idxROI_block_all, (n_roi, n_roi)).tocsr()
-
-        ## Old method for joining sparse arrays
-        # self.s_sf = scipy.sparse.lil_matrix((n_roi, n_roi))
-        # self.s_NN = scipy.sparse.lil_matrix((n_roi, n_roi))
-        # self.s_SWT = scipy.sparse.lil_matrix((n_roi, n_roi))
-        # self.s_sesh = scipy.sparse.lil_matrix((n_roi, n_roi))
-        # for ssf, snn, sswt, ss, idxROI_block in zip(s_sf_all, s_NN_all, s_SWT_all, s_sesh_all, idxROI_block_all):
-        #     idx = np.meshgrid(idxROI_block, idxROI_block)
-        #     self.s_sf[idx[0], idx[1]] = ssf
-        #     self.s_NN[idx[0], idx[1]] = snn
-        #     self.s_SWT[idx[0], idx[1]] = sswt
-        #     self.s_sesh[idx[0], idx[1]] = ss
-        # self.s_sf = self.s_sf.tocsr()
-        # self.s_NN = self.s_NN.tocsr()
-        # self.s_SWT = self.s_SWT.tocsr()
-        # self.s_sesh = self.s_sesh.tocsr()
+        ## Merge all four matrices at once. Overlapping entries from different
+        ##  blocks are max-reduced, and the outputs share one index structure.
+        self.s_sf, self.s_NN, self.s_SWT, self.s_sesh = helpers.merge_sparse_arrays_max(
+            s_lists=[list(s_block) for s_block in zip(s_sf_all, s_NN_all, s_SWT_all, s_sesh_all)],
+            idx_list=idxROI_block_all,
+            shape_full=(n_roi, n_roi),
+        )
+        for s in [self.s_sf, self.s_NN, self.s_SWT]:
+            s.data[s.data < 0] = 0  ## Negative similarities are rectified to 0
+
+        ## Store the index once and expose each modality as a view onto it
+        self.s_graph = SimilarityGraph_multiChannel.from_csr({
+            's_sf': self.s_sf,
+            's_NN': self.s_NN,
+            's_SWT': self.s_SWT,
+            's_sesh': self.s_sesh,
+        })
+        self.s_sf, self.s_NN, self.s_SWT, self.s_sesh = (self.s_graph.to_csr(name) for name in ['s_sf', 's_NN', 's_SWT', 's_sesh'])
 
         return self.s_sf, self.s_NN, self.s_SWT, self.s_sesh
 
+    def _compute_blocks_multiprocessing(
+        self,
+        idxROI_block_all: List[np.ndarray],
+        order_blocks: np.ndarray,
+        features_NN: torch.Tensor,
+        features_SWT: torch.Tensor,
+        ROI_session_bool: Union[torch.Tensor, np.ndarray],
+        n_processes: Optional[int] = None,
+    ) -> Dict[int, tuple]:
+        """
+        Computes the per-block similarity graphs in a pool of worker processes.
+        The large shared inputs are copied once into shared memory and each
+        task only receives the ROI indices of its block.
+
+        Args:
+            idxROI_block_all (List[np.ndarray]):
+                ROI indices for each block.
+            order_blocks (np.ndarray):
+                Order in which to submit the blocks.
+            features_NN (torch.Tensor):
+                NN features of all ROIs.
+            features_SWT (torch.Tensor):
+                SWT features of all ROIs.
+            ROI_session_bool (Union[torch.Tensor, np.ndarray]):
+                Session membership of all ROIs.
+            n_processes (Optional[int]):
+                Number of worker processes. (Default is ``None``)
+
+        Returns:
+            (Dict[int, tuple]):
+                results (Dict[int, tuple]):
+                    Maps block index to ``(s_sf, s_NN, s_SWT, s_sesh,
+                    duration)``.
+        """
+        if n_processes is None:
+            n_processes = mp.cpu_count() if self._n_workers == -1 else self._n_workers
+        n_processes = max(1, min(int(n_processes), len(order_blocks)))
+
+        arrays = {
+            'sf_data': self.sf_cat.data,
+            'sf_indices': self.sf_cat.indices,
+            'sf_indptr': self.sf_cat.indptr,
+            'features_NN': features_NN.detach().cpu().numpy() if isinstance(features_NN, torch.Tensor) else np.asarray(features_NN),
+            'features_SWT': features_SWT.detach().cpu().numpy() if isinstance(features_SWT, torch.Tensor) else np.asarray(features_SWT),
+            'session_bool': ROI_session_bool.cpu().numpy() if isinstance(ROI_session_bool, torch.Tensor) else np.asarray(ROI_session_bool),
+        }
+        ## Each process already runs one block, so inner libraries get 1 thread
+        kwargs_similarity = {
+            'spatialFootprint_maskPower': self._sf_maskPower,
+            'method_spatialFootprints': self._method_sf,
+            'algorithm_nearestNeigbors_spatialFootprints': self._algo_sf,
+            'kwargs_nearestNeigbors_spatialFootprints': self._kwargs_sf,
+            'n_workers': 1,
+        }
+
+        shms, specs_shm = [], {}
+        results = {}
+        try:
+            for name, arr in arrays.items():
+                arr = np.ascontiguousarray(arr)
+                shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+                shms.append(shm)
+                specs_shm[name] = (shm.name, arr.shape, arr.dtype.str)
+
+            with ProcessPoolExecutor(
+                max_workers=n_processes,
+                initializer=_init_block_worker,
+                initargs=(specs_shm, self.sf_cat.shape, kwargs_similarity),
+            ) as executor:
+                futures = [executor.submit(_compute_block_worker, int(ii), idxROI_block_all[ii]) for ii in order_blocks]
+                for future in tqdm(as_completed(futures), total=len(futures), mininterval=10):
+                    ii, s_sf, s_NN, s_SWT, s_sesh, duration = future.result()
+                    results[ii] = (s_sf, s_NN, s_SWT, s_sesh, duration)
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        return results
+
     def _helper_compute_ROI_similarity_graph(
         self,
         spatialFootprints: scipy.sparse.csr_matrix,
@@ -292,63 +405,18 @@ class ROI_graph(util.ROICaT_Module):
                 s_sesh (torch.Tensor): 
                     Pairwise similarity matrix based on session information.
         """
-        ## if there are no ROIs in the block
-        if spatialFootprints.shape[0] == 0:
-            return None, None, None, None
-
-        sf = spatialFootprints.power(self._sf_maskPower)
-        sf = sf.multiply( 0.5 / sf.sum(1))
-        sf = scipy.sparse.csr_matrix(sf)
-
-        d_sf = sklearn.neighbors.NearestNeighbors(
-            algorithm=self._algo_sf,
-            n_neighbors=sf.shape[0],
-            metric='manhattan',
-            p=1,
-            n_jobs=self._n_workers,
-            **self._kwargs_sf
-        ).fit(sf).kneighbors_graph(
-            sf,
-            n_neighbors=sf.shape[0],
-            mode='distance'
+        return compute_ROI_similarity_graph(
+            spatialFootprints=spatialFootprints,
+            features_NN=features_NN,
+            features_SWT=features_SWT,
+            ROI_session_bool=ROI_session_bool,
+            spatialFootprint_maskPower=self._sf_maskPower,
+            method_spatialFootprints=self._method_sf,
+            algorithm_nearestNeigbors_spatialFootprints=self._algo_sf,
+            kwargs_nearestNeigbors_spatialFootprints=self._kwargs_sf,
+            n_workers=self._n_workers,
         )
 
-        s_sf = d_sf.copy()
-        s_sf.data = 1 - s_sf.data
-        s_sf.data[s_sf.data < 1e-5] = 0  ## Likely due to numerical errors, some values are < 0 and very small. Rectify to fix.
-        s_sf[range(s_sf.shape[0]), range(s_sf.shape[0])] = 0
-        s_sf.eliminate_zeros()
-        
-        features_NN_normd = torch.nn.functional.normalize(features_NN, dim=1)
-        s_NN = torch.matmul(features_NN_normd, features_NN_normd.T) ## cosine similarity. ranges [0,1]
-        s_NN[s_NN>(1-1e-5)] = 1.0
-        # s_NN[s_NN < 0] = 0
-        s_NN[range(s_NN.shape[0]), range(s_NN.shape[0])] = 0
-        
-        features_SWT_normd = torch.nn.functional.normalize(features_SWT, dim=1)
-        s_SWT = torch.matmul(features_SWT_normd, features_SWT_normd.T) ## cosine similarity. Normalized to [0,1]
-        # s_SWT[s_SWT>(1-1e-5)] = 1.0
-        s_SWT[s_SWT < 0] = 0
-        s_SWT[range(s_SWT.shape[0]), range(s_SWT.shape[0])] = 0
-
-        session_bool = torch.as_tensor(ROI_session_bool, device='cpu', dtype=torch.float32)
-        s_sesh = torch.logical_not((session_bool @ session_bool.T).type(torch.bool))
-
-        # s_sf = s_sf.multiply(s_sesh.numpy())
-        # s_sf.eliminate_zeros()
-        # # s_NN = s_NN * s_sesh
-        # # s_SWT = s_SWT * s_sesh
-
-        s_sf = s_sf.maximum(s_sf.T)
-        s_NN = torch.maximum(s_NN, s_NN.T)  # force symmetry
-        s_SWT = torch.maximum(s_SWT, s_SWT.T)  # force symmetry
-        
-        s_NN  = helpers.sparse_mask(s_NN,  s_sf, do_safety_steps=True)
-        s_SWT = helpers.sparse_mask(s_SWT, s_sf, do_safety_steps=True)
-        s_sesh = helpers.sparse_mask(s_sesh, s_sf, do_safety_steps=True)
-
-        return s_sf, s_NN, s_SWT, s_sesh
-
     def make_normalized_similarities(
         self,
         centers_of_mass: Union[np.ndarray, List[np.ndarray]],
@@ -358,6 +426,8 @@ class ROI_graph(util.ROICaT_Module):
         k_min: int = 200,
         algo_NN: str = 'kd_tree',
         device: str = 'cpu',
+        streaming: bool = False,
+        batch_size_streaming: int = 1000,
         verbose: bool = True,
     ) -> None:
         """
@@ -400,6 +470,16 @@ class ROI_graph(util.ROICaT_Module):
             device (str): 
                 The device to use for the similarity computations. The output
                 will still be on CPU. (Default is ``'cpu'``)
+            streaming (bool):
+                If ``True``, the k-range neighbors are found and scored in
+                chunks of ``batch_size_streaming`` ROIs, and only the per-ROI
+                mean and standard deviation are kept. Peak memory scales with
+                *(batch_size_streaming, k_max)* instead of *(n_ROIs total,
+                k_max)*. Results are identical to the non-streaming path.
+                (Default is ``False``)
+            batch_size_streaming (int):
+                Number of ROIs per chunk when ``streaming`` is ``True``.
+                (Default is ``1000``)
             verbose (bool): 
                 If ``True``, print progress updates. (Default is ``True``)
 
@@ -423,6 +503,8 @@ class ROI_graph(util.ROICaT_Module):
                 'k_min',
                 'algo_NN',
                 'device',
+                'streaming',
+                'batch_size_streaming',
             ],
         )
 
@@ -434,38 +516,67 @@ class ROI_graph(util.ROICaT_Module):
         ## first get the indices of 'different' ROIs for each ROI.
         ##  'different here means they are more than the k-th nearest
         ##  neighbor based on centroid distance.
-        idx_diff, _ = get_idx_in_kRange(
-            X=coms,
-            k_max=k_max,
-            k_min=k_min,
-            algo_kNN=algo_NN,
-            n_workers=self._n_workers,
-        )
-
-        ## calculate similarity scores for each ROI against the 
+        ## Then calculate similarity scores for each ROI against the
         ##  'different' ROIs. Note that symmetry is lost here.
+        if streaming:
+            (mus_NN_diff, stds_NN_diff), (mus_SWT_diff, stds_SWT_diff) = get_kRange_similarity_stats(
+                X=coms,
+                features=[
+                    features_NN.to(device) if features_NN is not None else None,
+                    features_SWT.to(device) if features_SWT is not None else None,
+                ],
+                k_max=k_max,
+                k_min=k_min,
+                algo_kNN=algo_NN,
+                n_workers=self._n_workers,
+                batch_size=batch_size_streaming,
+                verbose=verbose,
+            )
+        else:
+            idx_diff, _ = get_idx_in_kRange(
+                X=coms,
+                k_max=k_max,
+                k_min=k_min,
+                algo_kNN=algo_NN,
+                n_workers=self._n_workers,
+            )
+            fn_stats = lambda features: cosine_similarity_customIdx(features.to(device), idx_diff, return_stats=True, verbose=verbose) if features is not None else (None, None)
+            mus_NN_diff, stds_NN_diff = fn_stats(features_NN)
+            mus_SWT_diff, stds_SWT_diff = fn_stats(features_SWT)
+
+        def z_score_rows(s_csr, mus, stds):
+            ## Row ids of each stored entry, taken from the CSR row pointer
+            rows = np.repeat(np.arange(s_csr.shape[0]), np.diff(s_csr.indptr))
+            data = (s_csr.data - mus[rows]) / stds[rows]
+            data[np.isnan(data)] = 0
+            return data
+
         print('Normalizing Neural Network similarity scores...') if verbose else None
         if features_NN is not None:
-            s_NN_diff = cosine_similarity_customIdx(features_NN.to(device), idx_diff)
-            mus_NN_diff = s_NN_diff.mean(1).to('cpu').numpy()
-            stds_NN_diff = s_NN_diff.std(1).to('cpu').numpy()
-            
-            self.s_NN_z = self.s_NN.copy().tocoo()
-            self.s_NN_z.data = ((self.s_NN_z.data - mus_NN_diff[self.s_NN_z.row]) / stds_NN_diff[self.s_NN_z.row])
-            self.s_NN_z = self.s_NN_z.tocsr()
-            self.s_NN_z.data[np.isnan(self.s_NN_z.data)] = 0
+            mus_NN_diff, stds_NN_diff = mus_NN_diff.to('cpu').numpy(), stds_NN_diff.to('cpu').numpy()
+            self.s_NN_z = self._add_channel_like(self.s_NN, 's_NN_z', z_score_rows(self.s_NN, mus_NN_diff, stds_NN_diff))
         
         print('Normalizing SWT similarity scores...') if verbose else None
         if features_SWT is not None:
-            s_SWT_diff = cosine_similarity_customIdx(features_SWT.to(device), idx_diff)
-            mus_SWT_diff = s_SWT_diff.mean(1).to('cpu').numpy()
-            stds_SWT_diff = s_SWT_diff.std(1).to('cpu').numpy()
-
-            self.s_SWT_z = self.s_SWT.copy().tocoo()
-            self.s_SWT_z.data = ((self.s_SWT_z.data - mus_SWT_diff[self.s_SWT_z.row]) / stds_SWT_diff[self.s_SWT_z.row])
-            self.s_SWT_z = self.s_SWT_z.tocsr()
-            self.s_SWT_z.data[np.isnan(self.s_SWT_z.data)] = 0
-            
+            mus_SWT_diff, stds_SWT_diff = mus_SWT_diff.to('cpu').numpy(), stds_SWT_diff.to('cpu').numpy()
+            self.s_SWT_z = self._add_channel_like(self.s_SWT, 's_SWT_z', z_score_rows(self.s_SWT, mus_SWT_diff, stds_SWT_diff))
+
+    def _add_channel_like(
+        self,
+        s_ref: scipy.sparse.csr_matrix,
+        name: str,
+        data: np.ndarray,
+    ) -> scipy.sparse.csr_matrix:
+        """
+        Makes a sparse matrix with the structure of ``s_ref`` and the given
+        data. If ``s_ref`` is a view onto ``self.s_graph``, the data is stored
+        as a new channel there and a view is returned.
+        """
+        s_graph = getattr(self, 's_graph', None)
+        if (s_graph is not None) and (not s_graph.upper_triangle) and helpers.check_same_sparsity_pattern(s_ref, s_graph.to_csr(next(iter(s_graph.channels)))):
+            s_graph.set_channel(name, data)
+            return s_graph.to_csr(name)
+        return scipy.sparse.csr_matrix((data, s_ref.indices.copy(), s_ref.indptr.copy()), shape=s_ref.shape)
 
 ###########################
 ####### block stuff #######
@@ -583,6 +694,327 @@ class ROI_graph(util.ROICaT_Module):
         return fig
 
 
+class SimilarityGraph_multiChannel:
+    """
+    Compact container for several sparse similarity matrices that share one
+    sparsity pattern (e.g. ``s_sf``, ``s_NN``, ``s_SWT``, ``s_sesh`` from
+    ``ROI_graph``). The CSR ``indptr`` and ``indices`` arrays are stored once,
+    and each modality ('channel') only stores its own ``data`` array.
+    Optionally only the upper triangle (including the diagonal) is stored,
+    which halves memory for symmetric graphs.
+
+    Because all channels share one index, the structure must never be changed
+    in place. Matrices returned by ``to_csr`` have read-only ``indptr`` and
+    ``indices``, so in-place structural methods (``eliminate_zeros``,
+    ``sort_indices`` or ``sum_duplicates`` on unsorted indices, etc.) raise a
+    ``ValueError`` instead of silently corrupting the other channels. Call
+    ``.copy()`` on a returned matrix before changing its structure. The
+    matrices passed to ``from_csr`` share their index with the container and
+    should not be changed in place either.
+
+    Args:
+        indptr (np.ndarray):
+            CSR row pointer array. Shape: *(n_rows + 1,)*.
+        indices (np.ndarray):
+            CSR column index array. Shape: *(nnz,)*.
+        shape (Tuple[int, int]):
+            Shape of the matrices.
+        channels (Optional[Dict[str, np.ndarray]]):
+            Data array for each channel. Each has shape *(nnz,)*. (Default is
+            ``None``)
+        upper_triangle (bool):
+            Whether the index only describes the upper triangle of symmetric
+            matrices. (Default is ``False``)
+
+    Attributes:
+        indptr (np.ndarray):
+            Shared CSR row pointer array.
+        indices (np.ndarray):
+            Shared CSR column index array.
+        shape (Tuple[int, int]):
+            Shape of the matrices.
+        channels (Dict[str, np.ndarray]):
+            Data array for each channel.
+        upper_triangle (bool):
+            Whether only the upper triangle is stored.
+    """
+    def __init__(
+        self,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        shape: Tuple[int, int],
+        channels: Optional[Dict[str, np.ndarray]] = None,
+        upper_triangle: bool = False,
+    ):
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.shape = tuple(int(n) for n in shape)
+        self.upper_triangle = upper_triangle
+        self.channels = {}
+        for name, data in ({} if channels is None else channels).items():
+            self.set_channel(name, data)
+
+    @classmethod
+    def from_csr(
+        cls,
+        matrices: Dict[str, scipy.sparse.csr_matrix],
+        dtype: Optional[Union[np.dtype, str]] = None,
+        upper_triangle: bool = False,
+    ) -> 'SimilarityGraph_multiChannel':
+        """
+        Builds the container from sparse matrices that have the same sparsity
+        pattern.
+
+        Args:
+            matrices (Dict[str, scipy.sparse.csr_matrix]):
+                Matrices to store, keyed by channel name. Must all have the
+                same ``indptr`` and ``indices``.
+            dtype (Optional[Union[np.dtype, str]]):
+                If not ``None``, the data of non-boolean channels is cast to
+                this dtype (e.g. ``np.float16``). (Default is ``None``)
+            upper_triangle (bool):
+                If ``True``, only entries with ``col >= row`` are stored. Only
+                valid for symmetric matrices. (Default is ``False``)
+
+        Returns:
+            (SimilarityGraph_multiChannel):
+                graph (SimilarityGraph_multiChannel):
+                    The container.
+        """
+        assert len(matrices) > 0, 'At least one matrix must be provided.'
+        matrices = {name: scipy.sparse.csr_matrix(m) for name, m in matrices.items()}
+        ref = next(iter(matrices.values()))
+        for name, m in matrices.items():
+            assert helpers.check_same_sparsity_pattern(ref, m), f'Matrix {name} does not have the same sparsity pattern as the first matrix.'
+
+        indptr, indices = ref.indptr, ref.indices
+        mask = None
+        if upper_triangle:
+            rows = np.repeat(np.arange(ref.shape[0], dtype=indices.dtype), np.diff(indptr))
+            mask = indices >= rows
+            indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[mask], minlength=ref.shape[0])))).astype(indptr.dtype)
+            indices = indices[mask]
+
+        channels = {}
+        for name, m in matrices.items():
+            data = m.data if mask is None else m.data[mask]
+            if (dtype is not None) and (data.dtype != np.bool_):
+                data = data.astype(dtype, copy=False)
+            channels[name] = data
+        return cls(indptr=indptr, indices=indices, shape=ref.shape, channels=channels, upper_triangle=upper_triangle)
+
+    def set_channel(
+        self,
+        name: str,
+        data: np.ndarray,
+    ) -> None:
+        """
+        Adds or replaces a channel.
+
+        Args:
+            name (str):
+                Name of the channel.
+            data (np.ndarray):
+                Data array aligned with ``indices``. Shape: *(nnz,)*.
+        """
+        data = np.asarray(data)
+        assert data.shape == self.indices.shape, f'Data for channel {name} has shape {data.shape}, but the index has {self.indices.shape[0]} entries.'
+        self.channels[name] = data
+
+    def to_csr(
+        self,
+        name: str,
+    ) -> scipy.sparse.csr_matrix:
+        """
+        Returns a channel as a scipy CSR matrix. If the full matrix is stored,
+        the output is a zero-copy view: its ``indptr``, ``indices``, and
+        ``data`` share memory with the container. The ``indptr`` and
+        ``indices`` of the view are read-only (see the class docstring);
+        ``data`` is writable. If only the upper triangle is stored, a new
+        symmetric matrix is built. float16 channels are returned as float32
+        copies because scipy.sparse does not support float16.
+
+        Args:
+            name (str):
+                Name of the channel.
+
+        Returns:
+            (scipy.sparse.csr_matrix):
+                s (scipy.sparse.csr_matrix):
+                    The channel as a sparse matrix.
+        """
+        data = self.channels[name]
+        ## scipy.sparse does not support float16
+        data = data.astype(np.float32) if data.dtype == np.float16 else data
+        if not self.upper_triangle:
+            indices, indptr = self.indices.view(), self.indptr.view()
+            indices.flags.writeable, indptr.flags.writeable = False, False
+            return scipy.sparse.csr_matrix((data, indices, indptr), shape=self.shape, copy=False)
+        ## Mirror the strictly upper entries into the lower triangle
+        rows = np.repeat(np.arange(self.shape[0], dtype=self.indices.dtype), np.diff(self.indptr))
+        off = self.indices != rows
+        s = scipy.sparse.coo_matrix(
+            (np.concatenate((data, data[off])), (np.concatenate((rows, self.indices[off])), np.concatenate((self.indices, rows[off])))),
+            shape=self.shape,
+        ).tocsr()
+        s.sort_indices()
+        return s
+
+    def __getitem__(self, name: str) -> scipy.sparse.csr_matrix:
+        return self.to_csr(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.channels
+
+    @property
+    def nnz(self) -> int:
+        """Number of stored entries per channel."""
+        return int(self.indices.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        """Total bytes used by the index and all channels."""
+        return int(self.indptr.nbytes + self.indices.nbytes + sum(d.nbytes for d in self.channels.values()))
+
+    def __repr__(self) -> str:
+        return f"SimilarityGraph_multiChannel(shape={self.shape}, nnz={self.nnz}, channels={[(k, str(v.dtype)) for k, v in self.channels.items()]}, upper_triangle={self.upper_triangle})"
+
+
+def get_ROI_bounding_boxes(
+    sf: scipy.sparse.csr_matrix,
+    frame_width: int,
+) -> np.ndarray:
+    """
+    Computes the bounding box of the positive pixels of each ROI.
+
+    Args:
+        sf (scipy.sparse.csr_matrix):
+            Flattened spatial footprints. Shape: *(n_ROIs, frame_height *
+            frame_width)*.
+        frame_width (int):
+            Width of the field of view. Used to unravel the pixel indices.
+
+    Returns:
+        (np.ndarray): 
+            bboxes (np.ndarray):
+                Inclusive bounding boxes ``[y_min, y_max, x_min, x_max]`` for
+                each ROI. Shape: *(n_ROIs, 4)*. ROIs without any positive pixels
+                get ``[0, -1, 0, -1]`` (empty).
+    """
+    sf = scipy.sparse.csr_matrix(sf)
+    n_roi = sf.shape[0]
+    ## Only positive pixels count as part of an ROI
+    mask_pos = sf.data > 0
+    rows = np.repeat(np.arange(n_roi, dtype=np.int64), np.diff(sf.indptr))[mask_pos]
+    y, x = np.divmod(sf.indices[mask_pos].astype(np.int64), frame_width)
+
+    bboxes = np.tile(np.array([0, -1, 0, -1], dtype=np.int64), (n_roi, 1))
+    if rows.size == 0:
+        return bboxes
+    ## rows is sorted (CSR order), so each ROI is a contiguous segment
+    starts = np.concatenate(([0], np.nonzero(np.diff(rows))[0] + 1))
+    roi_present = rows[starts]
+    bboxes[roi_present, 0] = np.minimum.reduceat(y, starts)
+    bboxes[roi_present, 1] = np.maximum.reduceat(y, starts)
+    bboxes[roi_present, 2] = np.minimum.reduceat(x, starts)
+    bboxes[roi_present, 3] = np.maximum.reduceat(x, starts)
+    return bboxes
+
+
+def find_ROIs_in_blocks(
+    sf: scipy.sparse.csr_matrix,
+    blocks_rect: np.ndarray,
+    frame_height: int,
+    frame_width: int,
+    bboxes: Optional[np.ndarray] = None,
+) -> List[np.ndarray]:
+    """
+    Finds which ROIs have at least one positive pixel inside each block. ROI
+    bounding boxes are registered in a coarse grid over the field of view,
+    so each block only considers the ROIs in the grid cells it covers. ROIs
+    whose bounding box partially overlaps a block are confirmed by checking
+    their pixels.
+
+    Args:
+        sf (scipy.sparse.csr_matrix):
+            Flattened spatial footprints. Shape: *(n_ROIs, frame_height *
+            frame_width)*.
+        blocks_rect (np.ndarray):
+            Half-open block rectangles ``[y_start, y_end, x_start, x_end]``.
+            Shape: *(n_blocks, 4)*.
+        frame_height (int):
+            Height of the field of view.
+        frame_width (int):
+            Width of the field of view.
+        bboxes (Optional[np.ndarray]):
+            Precomputed output of ``get_ROI_bounding_boxes``. If ``None``, it
+            is computed here. (Default is ``None``)
+
+    Returns:
+        (List[np.ndarray]): 
+            idxROI_blocks (List[np.ndarray]):
+                Sorted ROI indices for each block.
+    """
+    sf = scipy.sparse.csr_matrix(sf)
+    blocks_rect = np.asarray(blocks_rect, dtype=np.int64).reshape(-1, 4)
+    bboxes = get_ROI_bounding_boxes(sf, frame_width=frame_width) if bboxes is None else bboxes
+    idx_valid = np.nonzero(bboxes[:, 1] >= bboxes[:, 0])[0]
+
+    if len(blocks_rect) == 0:
+        return []
+
+    ## Grid cells are the size of the smallest block
+    cell_h = max(int((blocks_rect[:, 1] - blocks_rect[:, 0]).min()), 1)
+    cell_w = max(int((blocks_rect[:, 3] - blocks_rect[:, 2]).min()), 1)
+    n_cells_y = max(int(np.ceil(frame_height / cell_h)), 1)
+    n_cells_x = max(int(np.ceil(frame_width / cell_w)), 1)
+
+    ## Register each ROI in every grid cell that its bounding box touches
+    bb = bboxes[idx_valid]
+    cy0, cy1 = np.clip(bb[:, 0] // cell_h, 0, n_cells_y - 1), np.clip(bb[:, 1] // cell_h, 0, n_cells_y - 1)
+    cx0, cx1 = np.clip(bb[:, 2] // cell_w, 0, n_cells_x - 1), np.clip(bb[:, 3] // cell_w, 0, n_cells_x - 1)
+    n_y, n_x = cy1 - cy0 + 1, cx1 - cx0 + 1
+    n_cells_roi = n_y * n_x
+    roi_rep = np.repeat(np.arange(len(idx_valid), dtype=np.int64), n_cells_roi)
+    offsets = np.arange(n_cells_roi.sum(), dtype=np.int64) - np.repeat(np.cumsum(n_cells_roi) - n_cells_roi, n_cells_roi)
+    cell_y = cy0[roi_rep] + offsets // n_x[roi_rep]
+    cell_x = cx0[roi_rep] + offsets % n_x[roi_rep]
+    cell_id = cell_y * n_cells_x + cell_x
+    order = np.argsort(cell_id, kind='stable')
+    cell_rois = roi_rep[order]
+    cell_indptr = np.concatenate(([0], np.cumsum(np.bincount(cell_id, minlength=n_cells_y * n_cells_x))))
+
+    ## Pixel coordinates of the positive pixels, in CSR order
+    sf_pos = sf.copy()
+    sf_pos.data = (sf_pos.data > 0).astype(np.int8)
+    sf_pos.eliminate_zeros()
+    pix_y, pix_x = np.divmod(sf_pos.indices.astype(np.int64), frame_width)
+
+    idxROI_blocks = []
+    for y0, y1, x0, x1 in blocks_rect:
+        if (y1 <= y0) or (x1 <= x0):
+            idxROI_blocks.append(np.zeros((0,), dtype=np.int64))
+            continue
+        ## Gather candidate ROIs from the grid cells covering the block
+        gy0, gy1 = y0 // cell_h, min((y1 - 1) // cell_h, n_cells_y - 1)
+        gx0, gx1 = x0 // cell_w, min((x1 - 1) // cell_w, n_cells_x - 1)
+        cand = np.unique(np.concatenate([cell_rois[cell_indptr[gy * n_cells_x + gx0]:cell_indptr[gy * n_cells_x + gx1 + 1]] for gy in range(gy0, gy1 + 1)]))
+        b_c = bb[cand]
+        overlap = (b_c[:, 0] < y1) & (b_c[:, 1] >= y0) & (b_c[:, 2] < x1) & (b_c[:, 3] >= x0)
+        inside = (b_c[:, 0] >= y0) & (b_c[:, 1] < y1) & (b_c[:, 2] >= x0) & (b_c[:, 3] < x1)
+        ## Partially overlapping bounding boxes need a pixel-level check
+        idx_check = idx_valid[cand[overlap & ~inside]]
+        if len(idx_check) > 0:
+            lengths = sf_pos.indptr[idx_check + 1] - sf_pos.indptr[idx_check]
+            seg = np.repeat(np.arange(len(idx_check)), lengths)
+            idx_pix = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(sf_pos.indptr[idx_check], lengths)
+            py, px = pix_y[idx_pix], pix_x[idx_pix]
+            hit = np.bincount(seg, weights=((py >= y0) & (py < y1) & (px >= x0) & (px < x1)), minlength=len(idx_check)) > 0
+            idx_check = idx_check[hit]
+        idxROI_blocks.append(np.sort(np.concatenate([idx_valid[cand[inside]], idx_check]).astype(np.int64)))
+    return idxROI_blocks
+
+
 def get_idx_in_kRange(
     X: np.ndarray,
     k_max: int = 3000,
@@ -647,29 +1079,380 @@ def get_idx_in_kRange(
     idx_diff = np.array(idx_nz.data).reshape(2, d.shape[0], k_max)[:, mesh_j[:, k_min:], idx_topk[:, k_min:]][1]  ## put it all together. Get kRange  between k_min and k_max
     return idx_diff, d
 
+def compute_ROI_similarity_graph(
+    spatialFootprints: scipy.sparse.csr_matrix,
+    features_NN: torch.Tensor,
+    features_SWT: torch.Tensor,
+    ROI_session_bool: np.ndarray,
+    spatialFootprint_maskPower: float = 1.0,
+    method_spatialFootprints: str = 'sparse_overlap',
+    algorithm_nearestNeigbors_spatialFootprints: str = 'brute',
+    kwargs_nearestNeigbors_spatialFootprints: dict = {},
+    n_workers: int = -1,
+) -> Tuple[scipy.sparse.csr_matrix, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Computes the similarity matrix between ROIs within a single block based on
+    the conjunction of the similarity matrices for different modes (like the NN
+    embedding, the SWT embedding, and the spatial footprint overlap). Used by
+    ``ROI_graph._helper_compute_ROI_similarity_graph`` and by the
+    multiprocessing workers of ``ROI_graph.compute_similarity_blockwise``.
+    RH 2022
+
+    Args:
+        spatialFootprints (scipy.sparse.csr_matrix): 
+            The spatial footprints of the ROIs in the block. Shape: *(n_ROIs,
+            FOV height * FOV width)*.
+        features_NN (torch.Tensor): 
+            The output latent embeddings of the NN model. Shape: *(n_ROIs,
+            n_features)*.
+        features_SWT (torch.Tensor): 
+            The output latent embeddings of the SWT model. Shape: *(n_ROIs,
+            n_features)*.
+        ROI_session_bool (np.ndarray): 
+            The boolean matrix indicating which ROIs belong to which session.
+            Shape: *(n_ROIs, n_sessions)*.
+        spatialFootprint_maskPower (float):
+            The power to raise the spatial footprints to. (Default is ``1.0``)
+        method_spatialFootprints (str):
+            See ``ROI_graph``. (Default is ``'sparse_overlap'``)
+        algorithm_nearestNeigbors_spatialFootprints (str):
+            See ``ROI_graph``. (Default is ``'brute'``)
+        kwargs_nearestNeigbors_spatialFootprints (dict):
+            See ``ROI_graph``. (Default is ``{}``)
+        n_workers (int):
+            Number of workers used by sklearn.neighbors.NearestNeighbors.
+            (Default is ``-1``)
+
+    Returns:
+        (tuple): tuple containing:
+            s_sf (scipy.sparse.csr_matrix):
+                Pairwise similarity matrix based on spatial footprints.
+            s_NN (torch.Tensor): 
+                Pairwise similarity matrix based on Neural Network features.
+            s_SWT (torch.Tensor): 
+                Pairwise similarity matrix based on Scattering Wavelet
+                Transform.
+            s_sesh (torch.Tensor): 
+                Pairwise similarity matrix based on session information.
+    """
+    ## if there are no ROIs in the block
+    if spatialFootprints.shape[0] == 0:
+        return None, None, None, None
+
+    sf = spatialFootprints.power(spatialFootprint_maskPower)
+    sf = sf.multiply( 0.5 / sf.sum(1))
+    sf = scipy.sparse.csr_matrix(sf)
+
+    if method_spatialFootprints == 'sparse_overlap':
+        s_sf = similarity_manhattan_sparseOverlap(sf)
+    elif method_spatialFootprints == 'nearest_neighbors':
+        d_sf = sklearn.neighbors.NearestNeighbors(
+            algorithm=algorithm_nearestNeigbors_spatialFootprints,
+            n_neighbors=sf.shape[0],
+            metric='manhattan',
+            p=1,
+            n_jobs=n_workers,
+            **kwargs_nearestNeigbors_spatialFootprints
+        ).fit(sf).kneighbors_graph(
+            sf,
+            n_neighbors=sf.shape[0],
+            mode='distance'
+        )
+
+        s_sf = d_sf.copy()
+        s_sf.data = 1 - s_sf.data
+    s_sf.data[s_sf.data < 1e-5] = 0  ## Likely due to numerical errors, some values are < 0 and very small. Rectify to fix.
+    s_sf[range(s_sf.shape[0]), range(s_sf.shape[0])] = 0
+    s_sf.eliminate_zeros()
+
+    features_NN_normd = torch.nn.functional.normalize(features_NN, dim=1)
+    s_NN = torch.matmul(features_NN_normd, features_NN_normd.T) ## cosine similarity. ranges [0,1]
+    s_NN[s_NN>(1-1e-5)] = 1.0
+    # s_NN[s_NN < 0] = 0
+    s_NN[range(s_NN.shape[0]), range(s_NN.shape[0])] = 0
+
+    features_SWT_normd = torch.nn.functional.normalize(features_SWT, dim=1)
+    s_SWT = torch.matmul(features_SWT_normd, features_SWT_normd.T) ## cosine similarity. Normalized to [0,1]
+    # s_SWT[s_SWT>(1-1e-5)] = 1.0
+    s_SWT[s_SWT < 0] = 0
+    s_SWT[range(s_SWT.shape[0]), range(s_SWT.shape[0])] = 0
+
+    session_bool = torch.as_tensor(ROI_session_bool, device='cpu', dtype=torch.float32)
+    s_sesh = torch.logical_not((session_bool @ session_bool.T).type(torch.bool))
+
+    # s_sf = s_sf.multiply(s_sesh.numpy())
+    # s_sf.eliminate_zeros()
+    # # s_NN = s_NN * s_sesh
+    # # s_SWT = s_SWT * s_sesh
+
+    s_sf = s_sf.maximum(s_sf.T)
+    s_NN = torch.maximum(s_NN, s_NN.T)  # force symmetry
+    s_SWT = torch.maximum(s_SWT, s_SWT.T)  # force symmetry
+
+    s_NN  = helpers.sparse_mask(s_NN,  s_sf, do_safety_steps=True)
+    s_SWT = helpers.sparse_mask(s_SWT, s_sf, do_safety_steps=True)
+    s_sesh = helpers.sparse_mask(s_sesh, s_sf, do_safety_steps=True)
+
+    return s_sf, s_NN, s_SWT, s_sesh
+
+
+## Arrays attached by each block worker process. See _init_block_worker.
+_block_worker_data = {}
+
+def _init_block_worker(
+    specs_shm: Dict[str, Tuple[str, Tuple[int, ...], str]],
+    shape_sf: Tuple[int, int],
+    kwargs_similarity: Dict[str, Any],
+) -> None:
+    """
+    Initializer for the block worker processes. Attaches to the shared memory
+    blocks holding the concatenated spatial footprints, the features and the
+    session boolean array, and stores views of them in
+    ``_block_worker_data``.
+    """
+    torch.set_num_threads(1)
+    arrays, shms = {}, []
+    for name, (name_shm, shape, dtype) in specs_shm.items():
+        ## Pool workers share the parent's resource tracker, and the parent
+        ##  unlinks the shared memory when the pool is done.
+        shm = shared_memory.SharedMemory(name=name_shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        shms.append(shm)
+    _block_worker_data['shms'] = shms
+    _block_worker_data['sf_cat'] = scipy.sparse.csr_matrix((arrays['sf_data'], arrays['sf_indices'], arrays['sf_indptr']), shape=shape_sf)
+    _block_worker_data['features_NN'] = torch.from_numpy(arrays['features_NN'])
+    _block_worker_data['features_SWT'] = torch.from_numpy(arrays['features_SWT'])
+    _block_worker_data['session_bool'] = arrays['session_bool']
+    _block_worker_data['kwargs_similarity'] = kwargs_similarity
+
+def _compute_block_worker(
+    idx_block: int,
+    idxROI_block: np.ndarray,
+) -> Tuple[int, Optional[scipy.sparse.csr_matrix], Any, Any, Any, float]:
+    """
+    Computes the similarity graph for one block inside a worker process.
+    Returns the block index, the four similarity matrices, and the duration in
+    seconds.
+    """
+    tic = time.time()
+    d = _block_worker_data
+    out = compute_ROI_similarity_graph(
+        spatialFootprints=d['sf_cat'][idxROI_block].power(d['kwargs_similarity']['spatialFootprint_maskPower']),
+        features_NN=d['features_NN'][idxROI_block],
+        features_SWT=d['features_SWT'][idxROI_block],
+        ROI_session_bool=d['session_bool'][idxROI_block],
+        **d['kwargs_similarity'],
+    )
+    return (idx_block, *out, time.time() - tic)
+
+def similarity_manhattan_sparseOverlap(
+    X: scipy.sparse.csr_matrix,
+) -> scipy.sparse.csr_matrix:
+    """
+    Computes ``1 - manhattan_distance`` between all pairs of rows of a sparse
+    non-negative matrix that share at least one nonzero column. Uses the
+    identity: ``|a - b|_1 = |a|_1 + |b|_1 - 2 * sum(min(a, b))``, where the
+    sum of minimums is only nonzero over co-occurring columns. The cost scales
+    with the number of co-occurring entries (the sum over columns of
+    n_nonzero**2) instead of with n_rows**2. Pairs with no co-occurring
+    columns are not stored.
+
+    Args:
+        X (scipy.sparse.csr_matrix):
+            Sparse non-negative matrix. For spatial footprints, shape is
+            *(n_ROIs, FOV height * FOV width)*.
+
+    Returns:
+        (scipy.sparse.csr_matrix):
+            s (scipy.sparse.csr_matrix):
+                Similarity matrix ``1 - |X[i] - X[j]|_1`` for overlapping pairs
+                *(i, j)*. Shape: *(n_rows, n_rows)*. The diagonal contains
+                ``1`` for every non-empty row.
+    """
+    X = scipy.sparse.csc_matrix(X, dtype=np.float64)
+    X.sum_duplicates()
+    X.eliminate_zeros()
+    n = X.shape[0]
+
+    ## For each nonzero entry (in column order), pair it with every entry in
+    ##  the same column.
+    counts = np.diff(X.indptr).astype(np.int64)  ## number of rows with a nonzero in each column
+    col_entry = np.repeat(np.arange(X.shape[1], dtype=np.int64), counts)  ## column of each entry
+    n_partners = counts[col_entry]  ## number of partners of each entry
+    n_pairs = int(n_partners.sum())
+    idx_left = np.repeat(np.arange(X.nnz, dtype=np.int64), n_partners)
+    offsets = np.repeat(np.cumsum(n_partners) - n_partners, n_partners)
+    idx_right = X.indptr[col_entry[idx_left]] + (np.arange(n_pairs, dtype=np.int64) - offsets)
+
+    ## Sum of minimums for each pair. Duplicate (row, col) pairs are summed by tocsr()
+    s_min = scipy.sparse.coo_matrix(
+        (np.minimum(X.data[idx_left], X.data[idx_right]), (X.indices[idx_left], X.indices[idx_right])),
+        shape=(n, n),
+    ).tocsr()
+    s_min.sort_indices()
+
+    norms = np.asarray(X.sum(axis=1)).reshape(-1)
+    rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(s_min.indptr))
+    s_min.data = 1 - (norms[rows] + norms[s_min.indices] - 2 * s_min.data)
+    return s_min
+
+def get_kRange_similarity_stats(
+    X: np.ndarray,
+    features: List[Optional[torch.Tensor]],
+    k_max: int = 3000,
+    k_min: int = 100,
+    algo_kNN: str = 'brute',
+    n_workers: int = -1,
+    batch_size: int = 1000,
+    verbose: bool = True,
+) -> List[Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]]:
+    """
+    Streaming version of ``get_idx_in_kRange`` followed by
+    ``cosine_similarity_customIdx(..., return_stats=True)``. The k-Nearest
+    Neighbors search is fit once and then queried in chunks of
+    ``batch_size`` rows. For each chunk, the neighbors between ``k_min`` and
+    ``k_max`` are selected exactly as in ``get_idx_in_kRange``, and only the
+    per-row mean and standard deviation of the cosine similarities are kept.
+    Each chunk contains complete rows, so the statistics are exact and no
+    more than one chunk of indices and similarities is held at a time.
+
+    Args:
+        X (np.ndarray):
+            Input data array where each row is a data point and each column is
+            a feature (e.g. ROI centroids). Shape: *(n, n_dims)*.
+        features (List[Optional[torch.Tensor]]):
+            List of feature tensors to score. Each should have shape *(n,
+            d)*. ``None`` entries are skipped.
+        k_max (int):
+            Maximum number of neighbors to find. (Default is ``3000``)
+        k_min (int):
+            Minimum number of neighbors to consider. (Default is ``100``)
+        algo_kNN (str):
+            Algorithm to use for nearest neighbors search. (Default is
+            ``'brute'``)
+        n_workers (int):
+            Number of worker processes to use. If ``-1``, use all available
+            cores. (Default is ``-1``)
+        batch_size (int):
+            Number of rows to process in each chunk. (Default is ``1000``)
+        verbose (bool):
+            Whether to show a progress bar. (Default is ``True``)
+
+    Returns:
+        (List[Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]]):
+            stats (List[Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]]):
+                One *(mus, stds)* tuple per entry in ``features``. Each has
+                shape *(n,)*. Entries are ``(None, None)`` where ``features``
+                is ``None``.
+    """
+    assert k_max > k_min, f"'k_max' must be greater than 'k_min'"
+    n = X.shape[0]
+
+    nn = sklearn.neighbors.NearestNeighbors(
+        algorithm=algo_kNN,
+        n_neighbors=k_max,
+        metric='euclidean',
+        p=2,
+        n_jobs=n_workers,
+    ).fit(X)
+
+    fs = [torch.nn.functional.normalize(f, dim=1) if f is not None else None for f in features]
+    stats = [(torch.empty(n, dtype=f.dtype, device=f.device), torch.empty(n, dtype=f.dtype, device=f.device)) if f is not None else (None, None) for f in fs]
+
+    for X_batch, (start, end) in tqdm(
+        helpers.make_batches(X, batch_size=batch_size, return_idx=True),
+        total=int(np.ceil(n / batch_size)),
+        disable=not verbose,
+    ):
+        d_batch, idx_batch = nn.kneighbors(X_batch, n_neighbors=k_max)
+        ## same selection as get_idx_in_kRange: partition at the k_min-th distance
+        idx_topk = np.argpartition(d_batch, kth=k_min, axis=1)
+        idx_diff = np.take_along_axis(idx_batch, idx_topk[:, k_min:], axis=1)
+
+        for f, (mus, stds) in zip(fs, stats):
+            if f is None:
+                continue
+            s_batch = torch.einsum('bd,bkd->bk', f[start:end], f[torch.as_tensor(idx_diff, dtype=torch.int64, device=f.device)])
+            mus[start:end] = s_batch.mean(1)
+            stds[start:end] = s_batch.std(1)
+
+    return stats
+
 def cosine_similarity_customIdx(
     features: torch.Tensor,
-    idx: np.ndarray
-) -> torch.Tensor:
+    idx: np.ndarray,
+    batch_size: Optional[int] = None,
+    max_memory_GB: float = 1.0,
+    return_stats: bool = False,
+    verbose: bool = True,
+) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
     """
-    Calculate cosine similarity using custom indices.
+    Calculate cosine similarity using custom indices. Rows are processed in
+    batches: for each batch, the indexed feature vectors are gathered into a
+    *(batch_size, k, d)* tensor and contracted against the batch's own feature
+    vectors in a single einsum.
 
     Args:
-        features (torch.Tensor): 
+        features (torch.Tensor):
             A tensor of feature vectors. Shape: *(n, d)*, where *n* is the
             number of data points and *d* is the dimensionality of the data.
-        idx (np.ndarray): 
-            Array of indices. Shape should match the first dimension of the
-            features tensor.
+        idx (np.ndarray):
+            Array of indices. Shape: *(n, k)*. Row ``ii`` contains the indices
+            of the feature vectors to compare against ``features[ii]``.
+        batch_size (Optional[int]):
+            Number of rows to process at once. If ``None``, the batch size is
+            derived from ``max_memory_GB``. (Default is ``None``)
+        max_memory_GB (float):
+            Approximate memory budget (in GB) for the gathered feature tensor of
+            each batch. Only used if ``batch_size`` is ``None``. (Default is
+            ``1.0``)
+        return_stats (bool):
+            If ``True``, only the per-row mean and standard deviation of the
+            similarities are returned, and the full *(n, k)* similarity tensor
+            is never materialized. (Default is ``False``)
+        verbose (bool):
+            Whether to show a progress bar. (Default is ``True``)
 
     Returns:
-        (torch.Tensor): 
-            result (torch.Tensor):
-                Cosine similarity tensor calculated using the provided indices.
-                Shape: *(n, d)*, where *n* is the number of data points and *d*
-                is the dimensionality of the data.
+        (Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]):
+            If ``return_stats`` is ``False``:
+                result (torch.Tensor):
+                    Cosine similarity tensor calculated using the provided
+                    indices. Shape: *(n, k)*.
+            If ``return_stats`` is ``True``, a tuple containing:
+                mus (torch.Tensor):
+                    Mean similarity of each row. Shape: *(n,)*.
+                stds (torch.Tensor):
+                    Standard deviation (unbiased) of the similarities of each
+                    row. Shape: *(n,)*.
     """
     f = torch.nn.functional.normalize(features, dim=1)
-    out = torch.stack([f[ii] @ f[idx[ii]].T for ii in tqdm(range(f.shape[0]))], dim=0)
-    return out
+    idx = torch.as_tensor(np.array(idx, dtype=np.int64), dtype=torch.int64, device=f.device)
+    n, k = idx.shape
+    assert n == f.shape[0], f"idx must have the same number of rows as features. Found {n} and {f.shape[0]}."
+
+    if batch_size is None:
+        bytes_per_row = max(k * (f.shape[1] + 1) * f.element_size(), 1)
+        batch_size = int(max(1, (max_memory_GB * 1e9) // bytes_per_row))
+    batch_size = int(min(max(batch_size, 1), max(n, 1)))
+
+    if return_stats:
+        mus = torch.empty(n, dtype=f.dtype, device=f.device)
+        stds = torch.empty(n, dtype=f.dtype, device=f.device)
+    else:
+        out = torch.empty((n, k), dtype=f.dtype, device=f.device)
+
+    for idx_batch, (start, end) in tqdm(
+        helpers.make_batches(idx, batch_size=batch_size, return_idx=True),
+        total=int(np.ceil(n / batch_size)),
+        disable=not verbose,
+    ):
+        s_batch = torch.einsum('bd,bkd->bk', f[start:end], f[idx_batch])
+        if return_stats:
+            mus[start:end] = s_batch.mean(1)
+            stds[start:end] = s_batch.std(1)
+        else:
+            out[start:end] = s_batch
+
+    return (mus, stds) if return_stats else out
 
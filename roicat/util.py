@@ -150,6 +150,7 @@ def get_default_parameters(
                         'max_iter': 100,  ## Maximum number of iterations for the RANSAC algorithm.
                         'confidence': 0.99,  ## Confidence level for the RANSAC algorithm. Larger values mean more points are considered inliers.
                     },
+                    'n_workers': -1,  ## Number of processes used to register pairs of images during the all-to-all / match search step. Only used for the CPU methods (ECC_cv2, PhaseCorrelation, SIFT, ORB). -1 uses all cores.
                 },
                 'fit_nonrigid': {
                     'template': 0.5,  ## Which session to use as a registration template. If input is float (ie 0.0, 0.5, 1.0, etc.), then it is the fractional position of the session to use; if input is int (ie 1, 2, 3), then it is the index of the session to use (0-indexed)
@@ -172,6 +173,7 @@ def get_default_parameters(
                 },
                 'transform_ROIs': {
                     'normalize': True,  ## If True, normalize the spatial footprints to have a sum of 1.
+                    'interpolation_method': 'griddata',  ## How the ROIs are warped. 'griddata' interpolates each ROI separately. 'linear' or 'cubic' warp all of a session's ROIs with one cached sparse operator (much faster for many ROIs; slightly different values at ROI edges).
                 },
             },
             'blurring': {
@@ -202,10 +204,12 @@ def get_default_parameters(
                     'n_workers': -1,  ## Number of CPU cores to use. -1 for all.
                     'block_height': 128,  ## size of a block
                     'block_width': 128,  ## size of a block
+                    'method_spatialFootprints': 'sparse_overlap',  ## method used to find the pairwise similarity for s_sf. ('sparse_overlap' only compares overlapping ROIs and is fast. 'nearest_neighbors' computes all pairs in each block.)
                     'algorithm_nearestNeigbors_spatialFootprints': 'brute',  ## algorithm used to find the pairwise similarity for s_sf. ('brute' is slow but exact. See docs for others.)
                 },
                 'compute_similarity': {
                     'spatialFootprint_maskPower': 1.0,  ##  An exponent to raise the spatial footprints to to care more or less about bright pixels
+                    'method_parallel': 'serial',  ## How to schedule the blocks. 'serial' or 'multiprocessing' (blocks run in worker processes, largest first, with inputs in shared memory)
                 },
                 'normalization': {
                     'k_max': 100,  ## Maximum number of nearest neighbors * n_sessions to consider for the normalizing distribution
@@ -234,6 +238,17 @@ def get_default_parameters(
                         'sig_SWT_kwargs_b': [0.1, 1.5],  ## Bounds for the sigmoid slope for s_SWT
                     },
                     'n_jobs_findParameters': -1,  ## Number of CPU cores to use (-1 is all cores)
+                    'method_parallel_findParameters': 'multithreading',  ## 'multithreading' or 'multiprocessing' (worker processes sharing one Optuna storage, with the similarity matrices in shared memory)
+                    'storage_findParameters': None,  ## Only for 'multiprocessing'. Path to an Optuna journal file or a database URL (e.g. 'sqlite:///study.db'). If None, a temporary journal file is used.
+                    'batch_size_findParameters': 1,  ## Number of candidate parameter sets evaluated together per optimization step. Values > 1 use a single vectorized pass per batch.
+                    'n_samples_findParameters': None,  ## If not None, evaluate the objective on a fixed stratified subsample of this many graph edges. Faster on large datasets.
+                    'n_verify_findParameters': 10,  ## Number of best trials re-scored on the full data when n_samples_findParameters is set.
+                    'tolerance_activation_findParameters': None,  ## If not None, approximate the activations and p-norm with lookup tables to this absolute tolerance during the search. Faster, but not exact.
+                    'path_cache_findParameters': None,  ## If not None, path to a JSON file caching the best trials of past searches by dataset fingerprint. Repeat runs on the same kind of dataset start from the cached trials.
+                    'kwargs_warmStart_findParameters': {
+                        'n_seeds': 10,  ## Number of cached trials to enqueue on a warm start
+                        'n_patience': 30,  ## Convergence patience on a warm start (if smaller than n_patience)
+                    },
                 },
                 'parameters_manual_mixing': {
                     'power_SF': 1.0,   ## s_sf**power_SF   (Higher values means clustering is more sensitive to spatial overlap of ROIs)
@@ -253,7 +268,7 @@ def get_default_parameters(
                     'convert_to_probability': False,  ## Whether or not to convert the similarity matrix and distance matrix to a probability matrix
                 },
                 'cluster_method': {
-                    'method': 'automatic',  ## 'automatic', 'hdbscan', or 'sequential_hungarian'. 'automatic': selects which clustering algorithm to use (generally if n_sessions >=8 then hdbscan, else sequential_hungarian)
+                    'method': 'automatic',  ## 'automatic', 'hdbscan', 'sequential_hungarian', or 'single_linkage'. 'automatic': selects which clustering algorithm to use (generally if n_sessions >=8 then hdbscan, else sequential_hungarian). 'single_linkage' is a fast session-constrained alternative to hdbscan for large datasets
                     'n_sessions_switch': 6, ## Number of sessions to switch from sequential_hungarian to hdbscan
                 },
                 'hdbscan': {
@@ -268,6 +283,12 @@ def get_default_parameters(
                 },
                 'sequential_hungarian': {
                     'thresh_cost': 0.6, ## Threshold for the cost matrix. Lower numbers result in more clusters.
+                    'method_matching': 'dense',  ## 'dense' or 'sparse'. 'sparse' solves each connected component of candidate matches separately, which scales to many sessions
+                    'n_workers': 1,  ## Number of threads used by method_matching='sparse'. -1 uses all cores
+                },
+                'single_linkage': {
+                    'd_cutoff': None,  ## Distance below which ROIs can be merged. If None, all edges of the pruned graph are used
+                    'min_cluster_size': 2,  ## Minimum number of ROIs that can be considered a 'cluster'
                 },
             },
             'results_saving': {
@@ -914,6 +935,31 @@ class RichFile_ROICaT(rf.RichFile):
         import hdbscan
 
         
+        from .tracking import similarity_graph
+
+        ## SPECTRUM CACHE
+        def save_spectrum_cache(
+            obj: helpers.SpectrumCache,
+            path: Union[str, Path],
+            **kwargs,
+        ) -> None:
+            """
+            Saves the settings of a SpectrumCache to the given path. The cached
+            spectra are not saved.
+            """
+            with open(path, 'w') as f:
+                json.dump({'max_bytes': obj.max_bytes}, f, **kwargs)
+
+        def load_spectrum_cache(
+            path: Union[str, Path],
+            **kwargs,
+        ) -> helpers.SpectrumCache:
+            """
+            Loads an empty SpectrumCache from the given path.
+            """
+            with open(path, 'r') as f:
+                return helpers.SpectrumCache(**json.load(f, **kwargs))
+
         ## PANDAS DATAFRAME
         import pandas as pd
         
@@ -959,6 +1005,7 @@ class RichFile_ROICaT(rf.RichFile):
             ("toeplitz_conv", helpers.Toeplitz_convolution2d),
             ("convergence_checker_optuna", helpers.Convergence_checker_optuna),
             ("image_alignment_checker", helpers.ImageAlignmentChecker),
+            ("similarity_graph_multichannel", similarity_graph.SimilarityGraph_multiChannel),
         ]]
         # roicat_module_tds = []
         
@@ -1081,6 +1128,15 @@ class RichFile_ROICaT(rf.RichFile):
                 "library":            "torch",
                 "versions_supported": [],
             },
+            {
+                "type_name":          "spectrum_cache",
+                "function_load":      load_spectrum_cache,
+                "function_save":      save_spectrum_cache,
+                "object_class":       helpers.SpectrumCache,
+                "suffix":             "json",
+                "library":            "roicat",
+                "versions_supported": [],
+            },
             {
                 "type_name":          "pandas_dataframe",
                 "function_load":      load_pandas_dataframe,
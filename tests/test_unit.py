@@ -17,6 +17,7 @@ import pytest
 
 import numpy as np
 import scipy.sparse
+import torch
 
 from roicat import helpers, util
 
@@ -166,3 +167,944 @@ def test_data_suite2p(dir_data_test, array_hasher):
     assert data.spatialFootprints[0].shape[1] == 512*705, 'ROICaT Error: data.spatialFootprints.shape[1] != 512*705'
     assert array_hasher(data.spatialFootprints[0].toarray()) == '6319b48421caeb23', 'ROICaT Error: data.spatialFootprints[0] != expected values. See code for expected values.'
     assert array_hasher(data.spatialFootprints[13].toarray()) == 'd5495d254954d56c', 'ROICaT Error: data.spatialFootprints[13] != expected values. See code for expected values.'
+
+
+######################################################################################################################################
+########################################################## TRACKING ##################################################################
+######################################################################################################################################
+
+def make_blob_footprints(rng, n_roi, hw):
+    """
+    Makes random blob-shaped spatial footprints. Returns a sparse array of
+    shape *(n_roi, hw[0] * hw[1])*.
+    """
+    yy, xx = np.mgrid[:hw[0], :hw[1]]
+    sf = []
+    for c in rng.uniform([0, 0], hw, size=(n_roi, 2)):
+        roi = np.exp(-((yy - c[0])**2 + (xx - c[1])**2) / (2 * rng.uniform(1.5, 3)**2)) * rng.uniform(0.5, 1, size=hw)
+        roi[roi < 0.1] = 0
+        sf.append(roi.reshape(-1))
+    return scipy.sparse.csr_matrix(np.stack(sf, axis=0).astype(np.float32))
+
+
+@pytest.fixture
+def similarities_clusterer():
+    """
+    Random similarity matrices for Clusterer (``s_sf``, ``s_NN_z``,
+    ``s_SWT_z``, ``s_sesh``) that share one sparsity pattern.
+    """
+    rng = np.random.default_rng(0)
+    s_base = scipy.sparse.random(200, 200, density=0.2, random_state=0, format='csr', dtype=np.float32)
+    def with_data(data):
+        s = s_base.copy()
+        s.data = data.astype(np.float32)
+        return s
+    return {
+        's_sf': with_data(rng.random(s_base.nnz) ** 3),
+        's_NN_z': with_data(np.clip(rng.normal(size=s_base.nnz), -4, 4)),
+        's_SWT_z': with_data(np.clip(rng.normal(size=s_base.nnz), -4, 4)),
+        's_sesh': with_data(rng.random(s_base.nnz) < 0.8),
+    }
+
+
+def test_cosine_similarity_customIdx():
+    """
+    Test that the batched cosine similarity engine matches a per-row loop, and
+    that the ``return_stats`` mode matches the mean and std of the full output.
+    """
+    import torch
+    from roicat.tracking import similarity_graph
+
+    rng = np.random.default_rng(0)
+    features = torch.as_tensor(rng.normal(size=(300, 16)), dtype=torch.float32)
+    idx = rng.integers(0, 300, size=(300, 50))
+
+    f = torch.nn.functional.normalize(features, dim=1)
+    s_true = torch.stack([f[ii] @ f[idx[ii]].T for ii in range(f.shape[0])], dim=0)
+
+    s_test = similarity_graph.cosine_similarity_customIdx(features, idx, batch_size=17, verbose=False)
+    assert torch.allclose(s_test, s_true, atol=1e-5), 'ROICaT Error: cosine_similarity_customIdx output does not match per-row computation.'
+
+    mus, stds = similarity_graph.cosine_similarity_customIdx(features, idx, max_memory_GB=1e-5, return_stats=True, verbose=False)
+    assert torch.allclose(mus, s_true.mean(1), atol=1e-5), 'ROICaT Error: cosine_similarity_customIdx means do not match.'
+    assert torch.allclose(stds, s_true.std(1), atol=1e-5), 'ROICaT Error: cosine_similarity_customIdx stds do not match.'
+
+
+def test_get_kRange_similarity_stats():
+    """
+    Test that the streaming k-range statistics used by
+    ROI_graph.make_normalized_similarities(streaming=True) equal the
+    statistics of the non-streaming path, for several chunk sizes.
+    """
+    from roicat.tracking import similarity_graph
+
+    rng = np.random.default_rng(0)
+    n = 250
+    coms = rng.uniform(0, 100, size=(n, 2))
+    features = [torch.as_tensor(rng.normal(size=(n, 16)), dtype=torch.float32), None, torch.as_tensor(rng.normal(size=(n, 5)), dtype=torch.float32)]
+
+    idx_diff, _ = similarity_graph.get_idx_in_kRange(X=coms, k_max=120, k_min=20, algo_kNN='kd_tree', n_workers=1)
+    expected = [similarity_graph.cosine_similarity_customIdx(f, idx_diff, return_stats=True, verbose=False) if f is not None else (None, None) for f in features]
+    for batch_size in [1, 7, 100, n, 1000]:
+        stats = similarity_graph.get_kRange_similarity_stats(X=coms, features=features, k_max=120, k_min=20, algo_kNN='kd_tree', n_workers=1, batch_size=batch_size, verbose=False)
+        assert stats[1] == (None, None)
+        for (mus, stds), (mus_true, stds_true) in zip(stats[::2], expected[::2]):
+            assert torch.equal(mus, mus_true) and torch.equal(stds, stds_true), f'ROICaT Error: streaming statistics differ with batch_size={batch_size}.'
+
+
+def test_similarity_spatialFootprints_sparseOverlap():
+    """
+    Test that the sparse overlap engine for s_sf gives the same sparsity
+    pattern and values as the dense nearest neighbors path.
+    """
+    from roicat.tracking import similarity_graph
+
+    rng = np.random.default_rng(0)
+    n = 120
+    sf = make_blob_footprints(rng, n_roi=n, hw=(40, 48))
+    kwargs = {
+        'spatialFootprints': sf,
+        'features_NN': torch.as_tensor(rng.normal(size=(n, 8)), dtype=torch.float32),
+        'features_SWT': torch.as_tensor(rng.normal(size=(n, 8)), dtype=torch.float32),
+        'ROI_session_bool': np.eye(3, dtype=bool)[rng.integers(0, 3, n)],
+        'spatialFootprint_maskPower': 0.8,
+        'n_workers': 1,
+    }
+    s_nn = similarity_graph.compute_ROI_similarity_graph(method_spatialFootprints='nearest_neighbors', **kwargs)[0].tocsr()
+    s_so = similarity_graph.compute_ROI_similarity_graph(method_spatialFootprints='sparse_overlap', **kwargs)[0].tocsr()
+    s_nn.sort_indices()
+    s_so.sort_indices()
+    assert s_so.nnz > n, 'ROICaT Error: test footprints do not overlap.'
+    assert np.array_equal(s_so.indptr, s_nn.indptr) and np.array_equal(s_so.indices, s_nn.indices), 'ROICaT Error: sparsity patterns do not match.'
+    np.testing.assert_allclose(s_so.data, s_nn.data, rtol=0, atol=1e-6)
+
+
+def test_merge_sparse_arrays_max():
+    """
+    Test that the single-pass merge of block similarity matrices matches the
+    previous element-wise max merge (stacking with sparse.COO), for
+    overlapping blocks, coordinates shared by several blocks, and explicitly
+    stored zeros.
+    """
+    import sparse
+
+    def merge_sparse_arrays_old(s_list, idx_list, shape):
+        def csr_to_coo_idxd(s_csr, idx, shift_val, shape):
+            s_coo = s_csr.tocoo()
+            return scipy.sparse.coo_matrix((s_coo.data + shift_val, (idx[s_coo.row], idx[s_coo.col])), shape=shape)
+        shift_val = min([s.min() for s in s_list]) + 1
+        s_flat = scipy.sparse.vstack([csr_to_coo_idxd(s, idx, shift_val, shape).reshape(1, -1).tocsr() for s, idx in zip(s_list, idx_list)]).tocsr()
+        s_flat = sparse.COO(s_flat).max(0)[None, :].to_scipy_sparse().tocsr()
+        s_merged = s_flat.reshape(shape).tocsr()
+        s_merged.data = s_merged.data - shift_val
+        return s_merged
+
+    rng = np.random.default_rng(0)
+    n = 100
+    ## Overlapping blocks. Many (row, col) pairs are shared by 2 or more blocks.
+    idx_list = [np.sort(rng.choice(n, size=40, replace=False)) for _ in range(6)] + [np.arange(20, 60)]
+    s_lists = []
+    for idx in idx_list:
+        a = scipy.sparse.random(len(idx), len(idx), density=0.3, random_state=rng, format='csr', dtype=np.float64)
+        a.data[rng.random(a.nnz) < 0.2] = 0  ## explicit zeros
+        b = a.copy()
+        b.data = rng.random(b.nnz)
+        s_lists.append([a, b])
+    assert sum((s[0].data == 0).sum() for s in s_lists) > 0
+
+    merged = helpers.merge_sparse_arrays_max(s_lists=s_lists, idx_list=idx_list, shape_full=(n, n))
+    for ii, m in enumerate(merged):
+        expected = merge_sparse_arrays_old([s[ii] for s in s_lists], idx_list, (n, n))
+        expected.sort_indices()
+        assert np.array_equal(m.indptr, expected.indptr) and np.array_equal(m.indices, expected.indices), 'ROICaT Error: merged sparsity pattern does not match.'
+        np.testing.assert_allclose(m.data, expected.data, rtol=0, atol=1e-12)
+    assert (merged[0].data == 0).sum() > 0, 'ROICaT Error: explicit zeros were dropped.'
+    assert np.array_equal(merged[0].indices, merged[1].indices) and not np.shares_memory(merged[0].indices, merged[1].indices)
+
+    ## Blocks with duplicate coordinates are summed first, as in scipy
+    a = scipy.sparse.coo_matrix((np.array([0.2, 0.3, 0.4]), (np.array([0, 0, 1]), np.array([1, 1, 0]))), shape=(2, 2))
+    m = helpers.merge_sparse_arrays_max(s_lists=[[a]], idx_list=[np.array([3, 5])], shape_full=(6, 6))[0]
+    assert m[3, 5] == 0.5 and m[5, 3] == 0.4 and m.nnz == 2
+
+
+def test_compute_similarity_blockwise_multiprocessing():
+    """
+    Test that computing the blocks in a process pool gives the same graphs as
+    computing them serially, and that the shared memory is freed when a
+    worker fails.
+    """
+    import os
+    from roicat.tracking import similarity_graph
+
+    rng = np.random.default_rng(0)
+    hw, n_sessions, n_per_session = (64, 80), 3, 40
+    spatialFootprints = [make_blob_footprints(rng, n_roi=n_per_session, hw=hw) for _ in range(n_sessions)]
+    n = n_sessions * n_per_session
+    kwargs = {
+        'spatialFootprints': spatialFootprints,
+        'features_NN': torch.as_tensor(rng.normal(size=(n, 8)), dtype=torch.float32),
+        'features_SWT': torch.as_tensor(rng.normal(size=(n, 8)), dtype=torch.float32),
+        'ROI_session_bool': torch.as_tensor(np.repeat(np.eye(n_sessions, dtype=bool), n_per_session, axis=0)),
+        'spatialFootprint_maskPower': 0.8,
+    }
+    def make_graph():
+        return similarity_graph.ROI_graph(n_workers=1, frame_height=hw[0], frame_width=hw[1], block_height=32, block_width=32, overlapping_width_Multiplier=0.5, verbose=False)
+
+    graph_serial = make_graph()
+    out_serial = graph_serial.compute_similarity_blockwise(method_parallel='serial', **kwargs)
+    graph_mp = make_graph()
+    out_mp = graph_mp.compute_similarity_blockwise(method_parallel='multiprocessing', n_processes=2, **kwargs)
+    assert out_serial[0].nnz > n, 'ROICaT Error: test footprints do not overlap.'
+    for a, b in zip(out_serial, out_mp):
+        assert np.array_equal(a.indptr, b.indptr) and np.array_equal(a.indices, b.indices), 'ROICaT Error: sparsity patterns do not match.'
+        assert np.array_equal(a.data, b.data), 'ROICaT Error: values do not match.'
+    assert np.array_equal(graph_serial.timings_blocks['n_roi'], graph_mp.timings_blocks['n_roi'])
+
+    ## A failing worker must not leave shared memory behind
+    if os.path.isdir('/dev/shm'):
+        shm_before = set(os.listdir('/dev/shm'))
+        with pytest.raises(Exception):
+            make_graph().compute_similarity_blockwise(method_parallel='multiprocessing', n_processes=2, **{**kwargs, 'features_NN': kwargs['features_NN'][:10]})
+        assert set(os.listdir('/dev/shm')) - shm_before == set(), 'ROICaT Error: shared memory was not unlinked.'
+
+
+def test_find_ROIs_in_blocks():
+    """
+    Test that the bounding box grid index assigns the same ROIs to each block
+    as checking the pixels of every ROI (``sf[:, pixels].sum(1) > 0``).
+    """
+    from roicat.tracking import similarity_graph
+
+    H, W = 20, 30
+    ims = []
+    def add_roi(pixels, values=None):
+        im = np.zeros((H, W), dtype=np.float32)
+        yy, xx = np.array(pixels).T
+        im[yy, xx] = 1 if values is None else values
+        ims.append(im.reshape(-1))
+    add_roi([(4, 9), (4, 10), (5, 9), (5, 10)])  ## straddles the x=10 block edge
+    add_roi([(9, 9), (9, 10), (10, 9), (10, 10)])  ## straddles the corner of four blocks
+    add_roi([(y, 5) for y in range(5, 16)] + [(5, x) for x in range(5, 16)])  ## L-shape: bounding box overlaps block [10:20, 10:20] without any pixel in it
+    add_roi([(2, 2), (2, 3), (15, 15)], values=[1, 1, 0])  ## stored zero in block [10:20, 10:20]
+    add_roi([(15, 25), (16, 26)])  ## inside a single block
+    add_roi([(0, 0)], values=[0])  ## empty ROI
+    sf = scipy.sparse.csr_matrix(np.stack(ims, axis=0))
+    sf = scipy.sparse.vstack([sf, make_blob_footprints(np.random.default_rng(0), n_roi=30, hw=(H, W))]).tocsr()
+
+    def find_ROIs_in_blocks_pixels(sf, blocks_rect):
+        idxROI_blocks = []
+        for y0, y1, x0, x1 in blocks_rect:
+            idx = np.zeros((H, W), dtype=np.bool_)
+            idx[y0:y1, x0:x1] = True
+            idxROI_blocks.append(np.where(np.asarray(sf[:, np.where(idx.reshape(-1))[0]].sum(1)).reshape(-1) > 0)[0])
+        return idxROI_blocks
+
+    blocks_grid = np.array([[y, y + 10, x, x + 10] for y in range(0, H, 10) for x in range(0, W, 10)])
+    blocks_overlap = similarity_graph.ROI_graph(frame_height=H, frame_width=W, block_height=8, block_width=12, overlapping_width_Multiplier=0.5, verbose=False)._blocks_rect
+    for blocks_rect in [blocks_grid, blocks_overlap]:
+        out = similarity_graph.find_ROIs_in_blocks(sf=sf, blocks_rect=blocks_rect, frame_height=H, frame_width=W)
+        expected = find_ROIs_in_blocks_pixels(sf, blocks_rect)
+        assert len(out) == len(expected)
+        for a, b in zip(out, expected):
+            assert np.array_equal(a, b), 'ROICaT Error: block membership does not match the pixel check.'
+
+    out = similarity_graph.find_ROIs_in_blocks(sf=sf, blocks_rect=blocks_grid, frame_height=H, frame_width=W)
+    assert 0 in out[0] and 0 in out[1]
+    assert all(1 in out[ii] for ii in [0, 1, 3, 4])
+    assert 2 not in out[4] and 3 not in out[4] and 5 not in np.concatenate(out)
+
+
+def test_SimilarityGraph_multiChannel():
+    """
+    Test that the shared-structure similarity container returns zero-copy
+    views of the input matrices, and that the upper-triangle mode
+    reconstructs the full symmetric matrices.
+    """
+    from roicat.tracking import similarity_graph
+
+    s = scipy.sparse.random(200, 200, density=0.05, random_state=0, dtype=np.float32)
+    s = (s + s.T).tocsr()
+    s.sort_indices()
+    ## Other channels with the same (symmetric) structure and symmetric values
+    rows = np.repeat(np.arange(s.shape[0]), np.diff(s.indptr))
+    s_b = scipy.sparse.csr_matrix((np.cos(rows * s.indices).astype(np.float32), s.indices, s.indptr), shape=s.shape)
+    s_sesh = scipy.sparse.csr_matrix((((rows + s.indices) % 3) == 0, s.indices, s.indptr), shape=s.shape)
+
+    graph = similarity_graph.SimilarityGraph_multiChannel.from_csr({'a': s, 'b': s_b, 'sesh': s_sesh})
+    view = graph.to_csr('b')
+    assert np.shares_memory(view.indices, graph.to_csr('a').indices), 'ROICaT Error: channels do not share the index.'
+    assert (view != s_b).nnz == 0, 'ROICaT Error: view does not match the input matrix.'
+
+    graph_upper = similarity_graph.SimilarityGraph_multiChannel.from_csr({'a': s, 'b': s_b, 'sesh': s_sesh}, dtype=np.float16, upper_triangle=True)
+    assert graph_upper.nbytes < graph.nbytes, 'ROICaT Error: upper triangle storage is not smaller.'
+    assert graph_upper.channels['b'].dtype == np.float16
+    assert np.allclose(graph_upper.to_csr('b').toarray(), s_b.toarray(), atol=1e-3), 'ROICaT Error: upper triangle reconstruction does not match.'
+    assert np.array_equal(graph_upper.to_csr('sesh').toarray(), s_sesh.toarray()), 'ROICaT Error: boolean channel reconstruction does not match.'
+
+    ## Structural in-place changes to a view must fail instead of corrupting the other channels
+    graph = similarity_graph.SimilarityGraph_multiChannel.from_csr({'a': s.copy(), 'b': s_b.copy()})
+    view = graph.to_csr('b')
+    view.data[::3] = 0
+    with pytest.raises(ValueError):
+        view.eliminate_zeros()
+    view_copy = view.copy()
+    view_copy.eliminate_zeros()
+    assert view_copy.nnz < s.nnz
+    assert np.array_equal(graph.to_csr('a').indices, s.indices) and graph.to_csr('a').nnz == s.nnz
+
+
+def test_mask_sparse_arrays_sharedPattern():
+    """
+    Test that pruning several matrices with one mask on ``.data`` gives the same
+    result as the sparse boolean fancy indexing used previously in
+    ``Clusterer.make_pruned_similarity_graphs``.
+    """
+    def prune_fancyIndex(s, graph_pruned):
+        s_pruned = scipy.sparse.csr_matrix(graph_pruned.shape, dtype=np.float32)
+        s_pruned[graph_pruned] = s[graph_pruned]
+        return s_pruned.tocsr()
+
+    rng = np.random.default_rng(0)
+    d = scipy.sparse.random(300, 300, density=0.03, random_state=0, dtype=np.float32).tocsr()
+    d.data[::7] = 0  ## explicitly stored zeros must be kept
+    s_b = scipy.sparse.csr_matrix((rng.random(d.nnz).astype(np.float32), d.indices, d.indptr), shape=d.shape)
+    s_sesh = scipy.sparse.csr_matrix((rng.random(d.nnz) > 0.5, d.indices, d.indptr), shape=d.shape)
+    mask = d.data < 0.6
+
+    graph_pruned = d.copy()
+    graph_pruned.data = mask.copy()
+    graph_pruned.eliminate_zeros()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = [prune_fancyIndex(s, graph_pruned) for s in [d, s_b, s_sesh]]
+    out = helpers.mask_sparse_arrays_sharedPattern(arrays=[d, s_b, s_sesh, None], mask=mask)
+
+    assert out[3] is None
+    for e, o in zip(expected, out[:3]):
+        o.sort_indices()
+        assert o.dtype == e.dtype
+        assert np.array_equal(o.indptr, e.indptr) and np.array_equal(o.indices, e.indices), 'ROICaT Error: pruned sparsity pattern does not match.'
+        assert np.array_equal(o.data, e.data), 'ROICaT Error: pruned values do not match.'
+    assert not np.shares_memory(out[0].indices, out[1].indices)
+
+
+def test_session_constrained_single_linkage():
+    """
+    Test that session-constrained single-linkage never merges two ROIs from the
+    same session, and that it recovers well separated clusters.
+    """
+    from roicat.tracking.clustering import session_constrained_single_linkage
+
+    rng = np.random.default_rng(0)
+    n_sessions, n_cells = 6, 40
+    session_idx = np.repeat(np.arange(n_sessions), n_cells)
+    cell_idx = np.concatenate([rng.permutation(n_cells) for _ in range(n_sessions)])
+    ## Short distances within a cell, long distances between cells, and one
+    ##  short edge between two ROIs of the same session that must be ignored.
+    n = len(session_idx)
+    i, j = np.triu_indices(n, k=1)
+    same = cell_idx[i] == cell_idx[j]
+    v = np.where(same, rng.uniform(0.0, 0.2, size=len(i)), rng.uniform(0.5, 1.0, size=len(i)))
+    keep = same | (rng.random(len(i)) < 0.05)
+    v, i, j = np.append(v[keep], 0.01), np.append(i[keep], 0), np.append(j[keep], 1)  ## ROIs 0 and 1 are in the same session
+    d = scipy.sparse.coo_matrix((v, (i, j)), shape=(n, n)).tocsr()
+    d = (d + d.T).tocsr()
+
+    labels, edges, dists = session_constrained_single_linkage(d=d, session_idx=session_idx, d_cutoff=0.4)
+    assert len(np.unique(np.stack([labels, session_idx], axis=1), axis=0)) == n, 'ROICaT Error: cluster contains multiple ROIs from one session.'
+    assert len(np.unique(labels)) == n_cells
+    assert np.all(np.diff(dists) >= 0) and np.all(dists < 0.4)
+    assert len(dists) == n - n_cells
+
+
+def test_compute_cluster_similarity_matrices():
+    """
+    Test the label-grouped cluster similarity matrices against a dense
+    brute-force computation and the previous sparse.COO implementation, and
+    that the sparse outputs match the dense ones.
+    """
+    import sparse
+
+    def old_cluster_similarity_matrices(ss, l_arr):
+        l_u = np.unique(l_arr)
+        l_bool = sparse.COO(np.stack([l_arr == u for u in l_u], axis=0))
+        samp_per_clust = l_bool.sum(1).todense()
+        n_clusters, n_samples = len(l_u), ss.shape[0]
+        ss = scipy.sparse.csr_matrix(ss.astype(np.float32)).tolil()
+        ss[range(n_samples), range(n_samples)] = 1
+        ss = sparse.COO(ss)
+        s_big_conj = ss[None,None,:,:] * l_bool[None,:,:,None] * l_bool[:,None,None,:]
+        s_big_diag = sparse.eye(n_samples) * l_bool[None,:,:,None] * l_bool[:,None,None,:]
+        norm_mat = samp_per_clust[:,None] * samp_per_clust[None,:]
+        norm_mat[range(n_clusters), range(n_clusters)] = samp_per_clust * (samp_per_clust - 1)
+        s_big_sum_raw = s_big_conj.sum(axis=(2,3)).todense()
+        s_big_sum_raw[range(n_clusters), range(n_clusters)] -= samp_per_clust
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cs_mean = s_big_sum_raw / norm_mat
+        val_max = s_big_conj.max() + 1
+        cs_min = s_big_conj.copy()
+        cs_min.data = val_max - cs_min.data
+        cs_min = cs_min.max(axis=(2,3))
+        cs_min.data = val_max - cs_min.data
+        cs_min.fill_value = 0.0
+        n_missing = samp_per_clust[:,None] * samp_per_clust[None,:] - (s_big_conj > 0).sum(axis=(2,3)).todense()
+        cs_min = cs_min.todense() * (n_missing == 0)
+        cs_max = (s_big_conj - s_big_diag).max(axis=(2,3)).todense()
+        return l_u, cs_mean, cs_max, cs_min
+
+    rng = np.random.default_rng(0)
+    n, n_clusters = 120, 25
+    s = scipy.sparse.random(n, n, density=0.1, random_state=0, dtype=np.float32)
+    s = ((s + s.T) / 2).tocsr()
+    labels = rng.integers(-1, n_clusters, n)
+    labels[0] = n_clusters  ## a cluster with a single sample
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        l_u, cs_mean, cs_max, cs_min = helpers.compute_cluster_similarity_matrices(s, labels, verbose=False)
+        _, cs_mean_sp, cs_max_sp, cs_min_sp = helpers.compute_cluster_similarity_matrices(s, labels, verbose=False, return_sparse=True)
+
+    s_dense = s.toarray()
+    np.fill_diagonal(s_dense, 1)
+    for ia, a in enumerate(l_u):
+        for ib, b in enumerate(l_u):
+            idx_b, idx_a = np.where(labels == b)[0], np.where(labels == a)[0]
+            block = s_dense[idx_b][:, idx_a]
+            if a == b:
+                vals = block[~np.eye(len(idx_a), dtype=bool)]
+                if len(vals) == 0:
+                    ## No non-self pairs: the mean is NaN, as in the previous implementation
+                    assert np.isnan(cs_mean[ia, ib]) and np.isnan(cs_mean_sp[ia, ib])
+                    continue
+                assert np.isclose(cs_mean[ia, ib], vals.mean(), rtol=1e-5)
+                assert np.isclose(cs_max[ia, ib], vals.max())
+            else:
+                assert np.isclose(cs_mean[ia, ib], block.mean(), rtol=1e-5)
+                assert np.isclose(cs_max[ia, ib], block.max())
+            assert np.isclose(cs_min[ia, ib], block.min())
+
+    assert np.array_equal(cs_mean_sp.toarray(), cs_mean, equal_nan=True)
+    assert np.array_equal(cs_max_sp.toarray(), cs_max)
+    assert np.array_equal(cs_min_sp.toarray(), cs_min)
+
+    ## Same as the previous implementation
+    _, cs_mean_old, cs_max_old, cs_min_old = old_cluster_similarity_matrices(s, labels)
+    np.testing.assert_allclose(cs_mean, cs_mean_old, rtol=1e-5, equal_nan=True)
+    np.testing.assert_allclose(cs_max, cs_max_old, rtol=1e-6)
+    np.testing.assert_allclose(cs_min, cs_min_old, rtol=1e-6, atol=1e-7)
+
+    ## The min is exact (to float32) for float64 inputs with a large range of values
+    s_big = s.astype(np.float64)
+    s_big.data[0] = 1e6
+    s_big.data[1:] = rng.uniform(1e-4, 1e-3, s_big.nnz - 1)
+    s_big.data[:] = s_big.data.astype(np.float32)
+    s_big = s_big.maximum(s_big.T).tocsr()
+    l_big = np.repeat(np.arange(n // 3), 3)
+    _, _, _, cs_min_big = helpers.compute_cluster_similarity_matrices(s_big, l_big, verbose=False)
+    s_big_dense = s_big.toarray()
+    np.fill_diagonal(s_big_dense, 1)
+    expected = np.array([[s_big_dense[l_big == ib][:, l_big == ia].min() for ib in range(n // 3)] for ia in range(n // 3)])
+    np.testing.assert_allclose(cs_min_big, expected, rtol=1e-6)
+    assert np.any((cs_min_big > 0) & (cs_min_big < 1e-3)), 'ROICaT Error: test does not cover small minimums'
+
+
+def test_silhouette_samples_sparse():
+    """
+    Test that the sparse silhouette equals sklearn's silhouette on the
+    densified distance matrix with missing entries set to the fill value.
+    """
+    import sklearn.metrics
+    from roicat.tracking.clustering import silhouette_samples_sparse
+
+    rng = np.random.default_rng(0)
+    n = 150
+    d = scipy.sparse.random(n, n, density=0.1, random_state=0, dtype=np.float32)
+    d = ((d + d.T) / 2).tocsr()
+    labels = rng.integers(-1, 40, n)
+    fill_value = 10.0
+
+    d_dense = np.full((n, n), fill_value)
+    d_coo = d.tocoo()
+    d_dense[d_coo.row, d_coo.col] = d_coo.data
+    np.fill_diagonal(d_dense, 0)
+    expected = sklearn.metrics.silhouette_samples(X=d_dense, labels=labels, metric='precomputed')
+
+    sil = silhouette_samples_sparse(d=d, labels=labels, fill_value=fill_value)
+    assert np.allclose(sil, expected, rtol=1e-10, atol=1e-12), 'ROICaT Error: sparse silhouette does not match sklearn.'
+
+
+def test_compute_quality_metrics_silhouette():
+    """
+    Test that Clusterer.compute_quality_metrics gives the same sample
+    silhouettes as the previous dense (sparse.COO -> float16 -> sklearn)
+    implementation, and that stored zeros are kept as zero distances.
+    """
+    import sparse
+    import sklearn.metrics
+    from roicat.tracking.clustering import Clusterer
+
+    rng = np.random.default_rng(0)
+    n = 150
+    s = scipy.sparse.random(n, n, density=0.1, random_state=0, format='csr', dtype=np.float32)
+    s = ((s + s.T) / 2).tocsr()
+    clusterer = Clusterer(s_sf=s, s_NN_z=s, s_SWT_z=s, s_sesh=s, verbose=False)
+    labels = rng.integers(-1, 40, n)
+
+    ## No stored zeros: same as the previous implementation
+    d = s.copy()
+    d.data = 1 - d.data
+    d_dense = sparse.COO(d.copy().tocsr()).astype(np.float16)
+    d_dense.fill_value = (d.data.max() - d.data.min()).astype(np.float16) * 10
+    d_dense = d_dense.todense()
+    np.fill_diagonal(d_dense, 0)
+    expected = sklearn.metrics.silhouette_samples(X=d_dense, labels=labels, metric='precomputed')
+    sil = clusterer.compute_quality_metrics(sim_mat=s, dist_mat=d, labels=labels)['sample_silhouette']
+    np.testing.assert_allclose(sil, expected, rtol=1e-6, atol=1e-6)
+
+    ## Stored zeros (sConj == 1) are zero distances, not missing edges
+    d.data[rng.random(d.nnz) < 0.2] = 0
+    fill_value = (d.data.max() - d.data.min()).astype(np.float16) * 10
+    d_dense = np.full((n, n), float(fill_value))
+    d_coo = d.tocoo()
+    d_dense[d_coo.row, d_coo.col] = d_coo.data.astype(np.float16)
+    np.fill_diagonal(d_dense, 0)
+    expected = sklearn.metrics.silhouette_samples(X=d_dense, labels=labels, metric='precomputed')
+    sil = clusterer.compute_quality_metrics(sim_mat=s, dist_mat=d, labels=labels)['sample_silhouette']
+    np.testing.assert_allclose(sil, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_linear_sum_assignment_sparse():
+    """
+    Test that solving each connected component of the candidate graph gives
+    the same optimal cost as the dense assignment problem where all
+    non-candidate pairs cost 1.
+    """
+    import scipy.optimize
+    from roicat.tracking.clustering import linear_sum_assignment_sparse
+
+    for seed in range(10):
+        rng = np.random.default_rng(seed)
+        n_rows, n_cols = rng.integers(5, 60, size=2)
+        c = scipy.sparse.random(n_rows, n_cols, density=0.08, random_state=seed).tocoo()
+        c.data = c.data * 0.9
+
+        D = np.ones((n_rows, n_cols))
+        D[c.row, c.col] = c.data
+        ri, ci = scipy.optimize.linear_sum_assignment(D)
+        isMatch = D[ri, ci] < 1
+
+        r, cc, v = linear_sum_assignment_sparse(rows=c.row, cols=c.col, costs=c.data, shape=(n_rows, n_cols), cost_missing=1.0)
+        assert len(np.unique(r)) == len(r) and len(np.unique(cc)) == len(cc), 'ROICaT Error: ROIs matched more than once.'
+        assert np.allclose(D[r, cc], v)
+        assert np.isclose((v - 1).sum(), (D[ri, ci][isMatch] - 1).sum()), 'ROICaT Error: assignment is not optimal.'
+
+
+def test_score_labels():
+    """
+    Test that the sparse contingency-table implementation of score_labels
+    finds the same optimal assignment as the dense correlation + hungarian
+    definition, over many random labelings with more true than test labels
+    and vice versa.
+    """
+    import scipy.optimize
+    from roicat.tracking.clustering import score_labels
+
+    def dense_cc(labels_test, labels_true):
+        bool_true = np.stack([labels_true == l for l in np.unique(labels_true)], axis=0).astype(np.float64)
+        bool_test = np.stack([labels_test == l for l in np.unique(labels_test)], axis=0).astype(np.float64)
+        if bool_test.shape[0] < bool_true.shape[0]:
+            bool_test = np.concatenate((bool_test, np.zeros((bool_true.shape[0] - bool_test.shape[0], bool_true.shape[1]))))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cc = np.corrcoef(bool_true, bool_test)[:len(bool_true)][:, len(bool_true):]
+        cc[np.isnan(cc)] = 0
+        return cc, bool_true.sum(1)
+
+    ## Mostly correct labels: the optimal assignment is unique, so all scores match
+    for seed in range(5):
+        rng = np.random.default_rng(seed)
+        n, n_clusters = 400, 120
+        labels_true = rng.integers(-1, n_clusters, n)
+        labels_test = labels_true.copy()
+        idx_noise = rng.random(n) < 0.3
+        labels_test[idx_noise] = rng.integers(-1, n_clusters + 40, idx_noise.sum())
+
+        cc, n_true = dense_cc(labels_test, labels_true)
+        hi = scipy.optimize.linear_sum_assignment(cc, maximize=True)
+        cc_matched, n_true = cc[hi[0], hi[1]], n_true[hi[0]]
+
+        out = score_labels(labels_test=labels_test, labels_true=labels_true)
+        assert np.isclose(out['score_unweighted_partial'], cc_matched.mean())
+        assert np.isclose(out['score_weighted_partial'], np.sum(cc_matched * n_true) / n_true.sum())
+        assert np.isclose(out['score_unweighted_perfect'], np.mean(cc_matched > 0.9999999999))
+
+    ## Random labelings: the total correlation must be the dense optimum. Ties
+    ##  can be broken differently, so the other scores are checked against the
+    ##  dense correlations of the returned assignment.
+    n_na_gt_nb, n_na_lt_nb = 0, 0
+    for seed in range(300):
+        rng = np.random.default_rng(seed)
+        n = rng.integers(2, 80)
+        labels_true = rng.integers(0, rng.integers(1, 30), n)
+        labels_test = rng.integers(0, rng.integers(1, 30), n)
+        if seed % 2:
+            labels_test = labels_true.copy()
+            idx_noise = rng.random(n) < rng.random()
+            labels_test[idx_noise] = rng.integers(0, 30, idx_noise.sum())
+
+        for l_test, l_true in [(labels_test, labels_true), (labels_true, labels_test)]:
+            cc, n_true = dense_cc(l_test, l_true)
+            na, nb = len(np.unique(l_true)), len(np.unique(l_test))
+            n_na_gt_nb, n_na_lt_nb = n_na_gt_nb + (na > nb), n_na_lt_nb + (na < nb)
+            hi_dense = scipy.optimize.linear_sum_assignment(cc, maximize=True)
+
+            out = score_labels(labels_test=l_test, labels_true=l_true)
+            hi = out['idx_hungarian']
+            assert len(np.unique(hi[1])) == na, 'ROICaT Error: assignment is not one-to-one'
+            cc_matched = cc[hi[0], hi[1]]
+            assert np.isclose(cc_matched.sum(), cc[hi_dense].sum(), rtol=0, atol=1e-9), f'ROICaT Error: assignment is not optimal for seed {seed}'
+            assert np.isclose(out['score_unweighted_partial'], cc[hi_dense].mean(), rtol=0, atol=1e-9)
+            assert np.isclose(out['score_weighted_partial'], np.sum(cc_matched * n_true[hi[0]]) / n_true.sum())
+            assert np.isclose(out['score_weighted_perfect'], np.sum(n_true[hi[0]] * (cc_matched > 0.9999999999)) / n_true.sum())
+    assert (n_na_gt_nb > 50) and (n_na_lt_nb > 50)
+
+
+def test_disconnect_represented_sessions():
+    """
+    Test the vectorized violation search and edge disconnection used in
+    Clusterer.fit against a per-cluster loop.
+    """
+    from roicat.tracking.clustering import find_session_violations, disconnect_represented_sessions
+
+    for seed in range(5):
+        rng = np.random.default_rng(seed)
+        n, n_sessions = 300, 6
+        session_bool = np.zeros((n, n_sessions), dtype=bool)
+        session_bool[np.arange(n), rng.integers(0, n_sessions, n)] = True
+        labels = rng.integers(-1, 80, n)
+        d = scipy.sparse.random(n, n, density=0.05, random_state=seed, format='csr', dtype=np.float32)
+
+        violations = [l for l in np.unique(labels) if (session_bool[labels == l].sum(0) > 1).any()]
+        assert np.array_equal(find_session_violations(labels=labels, session_bool=session_bool), violations)
+
+        D = d.toarray()
+        D_out = D.copy()
+        for l in np.unique(labels):
+            if l == -1:
+                continue
+            idx = np.where(labels == l)[0]
+            isOut = labels != l
+            isRepresented = session_bool[:, session_bool[idx].any(0)].any(1)
+            D_out[np.ix_(idx, isOut & isRepresented)] = 0
+            D_out[np.ix_(isOut & isRepresented, idx)] = 0
+
+        d_out = disconnect_represented_sessions(d=d, labels=labels, session_bool=session_bool)
+        assert np.array_equal(d_out.toarray(), D_out)
+        assert np.all(d_out.data != 0)
+
+
+def test_attach_fully_connected_node():
+    from roicat.tracking.clustering import attach_fully_connected_node
+
+    for n_nodes, fmt in [(1, 'csr'), (3, 'coo')]:
+        d = scipy.sparse.random(40, 40, density=0.1, format=fmt, dtype=np.float32, random_state=n_nodes)
+        D = np.full((40 + n_nodes, 40 + n_nodes), 7, dtype=np.float32)
+        D[:40, :40] = d.toarray()
+
+        d2 = attach_fully_connected_node(d, dist_fullyConnectedNode=7, n_nodes=n_nodes)
+        assert isinstance(d2, scipy.sparse.csr_matrix) and d2.dtype == d.dtype
+        assert d2.nnz == d.nnz + n_nodes * (2 * 40 + n_nodes)
+        assert np.array_equal(d2.toarray(), D)
+
+
+def test_conjunctive_distance_lookup_tolerance(similarities_clusterer):
+    """
+    Test that the lookup-table approximation in
+    Clusterer.make_conjunctive_distance_matrix stays within the tolerance.
+    """
+    from roicat.tracking.clustering import Clusterer
+
+    s_sf, s_NN, s_SWT = (similarities_clusterer[k] for k in ['s_sf', 's_NN_z', 's_SWT_z'])
+    clusterer = Clusterer(**similarities_clusterer, verbose=False)
+    for kwargs in [
+        {'power_SF': 1, 'power_NN': 0.7, 'power_SWT': 0.1, 'p_norm': -4.0, 'sig_SF_kwargs': None, 'sig_NN_kwargs': {'mu': 0.5, 'b': 1.4}, 'sig_SWT_kwargs': {'mu': 0.2, 'b': 0.1}},
+        {'power_SF': 1, 'power_NN': 1.9, 'power_SWT': 0.01, 'p_norm': -0.1, 'sig_SF_kwargs': None, 'sig_NN_kwargs': {'mu': 0.9, 'b': 0.1}, 'sig_SWT_kwargs': {'mu': 0.0, 'b': 1.5}},
+        {'power_SF': 0.5, 'power_NN': 1.0, 'power_SWT': None, 'p_norm': 2.0, 'sig_SF_kwargs': {'mu': 0.5, 'b': 0.5}, 'sig_NN_kwargs': {'mu': 0.5, 'b': 0.5}, 'sig_SWT_kwargs': None},
+    ]:
+        out_exact = clusterer.make_conjunctive_distance_matrix(s_sf=s_sf, s_NN=s_NN, s_SWT=s_SWT, s_sesh=None, **kwargs)
+        for tol in [1e-3, 1e-5]:
+            out = clusterer.make_conjunctive_distance_matrix(s_sf=s_sf, s_NN=s_NN, s_SWT=s_SWT, s_sesh=None, tolerance_activation=tol, **kwargs)
+            assert np.array_equal(out[0].indices, out_exact[0].indices) and np.array_equal(out[0].indptr, out_exact[0].indptr)
+            ## Exact path is float32, so allow for its rounding
+            assert np.abs(out[0].data - out_exact[0].data).max() <= tol + 1e-6
+            for a, b in zip(out[2:5], out_exact[2:5]):
+                assert float((a - b).abs().max()) <= tol + 1e-6
+
+
+def test_find_optimal_parameters_multiprocessing(tmp_path, similarities_clusterer):
+    """
+    Test that the multiprocessing search shares one journal storage between
+    workers and respects the trial limit.
+    """
+    from roicat.tracking.clustering import Clusterer
+
+    clusterer = Clusterer(**similarities_clusterer, verbose=False)
+    path_journal = str(tmp_path / 'journal.log')
+    kwargs_best = clusterer.find_optimal_parameters_for_pruning(
+        kwargs_findParameters={'n_patience': 10, 'tol_frac': 0.0, 'max_trials': 12, 'max_duration': 600, 'value_stop': None},
+        n_jobs_findParameters=2,
+        method_parallel_findParameters='multiprocessing',
+        storage_findParameters=path_journal,
+        seed=0,
+    )
+    assert Path(path_journal).exists()
+    ## Workers that start a trial at the same time can exceed max_trials by n_workers - 1
+    assert 0 < len(clusterer.study.trials) <= 12 + 1
+    assert clusterer.checker.num_trial == len([t for t in clusterer.study.trials if t.value is not None])
+    assert set(['power_NN', 'power_SWT', 'p_norm', 'sig_NN_kwargs', 'sig_SWT_kwargs']).issubset(kwargs_best.keys())
+
+
+def test_find_optimal_parameters_warmStart(tmp_path, monkeypatch, similarities_clusterer):
+    """
+    Test that the cache of past searches is written, that a repeat run
+    starts from the cached best trial, and that a failed write leaves no
+    temporary file.
+    """
+    from roicat.tracking import clustering
+    from roicat.tracking.clustering import Clusterer
+
+    s_all = similarities_clusterer
+    path_cache = str(tmp_path / 'cache.json')
+    kwargs = {
+        'kwargs_findParameters': {'n_patience': 10, 'tol_frac': 0.0, 'max_trials': 15, 'max_duration': 600, 'value_stop': None},
+        'n_jobs_findParameters': 1,
+        'path_cache_findParameters': path_cache,
+        'fingerprint_findParameters': {'n_sessions': 3},
+    }
+
+    clusterer = Clusterer(**s_all, verbose=False)
+    clusterer.find_optimal_parameters_for_pruning(seed=0, **kwargs)
+    params_best = clusterer.study.best_trial.params
+    assert Path(path_cache).exists()
+
+    clusterer = Clusterer(**s_all, verbose=False)
+    clusterer.find_optimal_parameters_for_pruning(seed=1, **kwargs)
+    assert clusterer.study.trials[0].params == params_best
+    assert clusterer.checker.n_patience == 10
+
+    ## A different fingerprint does not use the cached entry
+    clusterer = Clusterer(**s_all, verbose=False)
+    clusterer.find_optimal_parameters_for_pruning(seed=1, **{**kwargs, 'fingerprint_findParameters': {'n_sessions': 4}})
+    assert clusterer.study.trials[0].params != params_best
+
+    ## The multiprocessing search enqueues the cached trials once, on the study it optimizes
+    clusterer = Clusterer(**s_all, verbose=False)
+    clusterer.find_optimal_parameters_for_pruning(seed=1, **kwargs)
+    n_cached = len(clusterer._load_cache_findParameters(path=path_cache, n_seeds=10))
+    clusterer = Clusterer(**s_all, verbose=False)
+    clusterer.find_optimal_parameters_for_pruning(seed=1, **{**kwargs, 'n_jobs_findParameters': 2, 'method_parallel_findParameters': 'multiprocessing'})
+    assert len([t for t in clusterer.study.trials if 'fixed_params' in t.system_attrs]) == n_cached > 0
+
+    ## A failed write does not leave a temporary file next to the cache
+    cache_before = Path(path_cache).read_text()
+    def dump_fail(*args, **kwargs):
+        raise ValueError('dump failed')
+    monkeypatch.setattr(clustering.json, 'dump', dump_fail)
+    with pytest.raises(ValueError, match='dump failed'):
+        clusterer._save_cache_findParameters(path=path_cache, trial_best=clusterer.study.best_trial)
+    assert list(tmp_path.glob('*.tmp')) == []
+    assert Path(path_cache).read_text() == cache_before
+
+
+def test_remap_sparse_images_local():
+    """
+    Test that interpolating only around each image gives the same output as
+    interpolating the full frame.
+    """
+    rng = np.random.default_rng(0)
+    H, W = 64, 80
+    yy, xx = np.mgrid[:H, :W].astype(np.float32)
+    ims = []
+    for _ in range(10):
+        c = rng.uniform([8, 8], [H - 8, W - 8])
+        im = np.exp(-((yy - c[0])**2 + (xx - c[1])**2) / (2 * rng.uniform(1.5, 3)**2))
+        im[im < 0.05] = 0
+        ims.append(scipy.sparse.csr_matrix(im.astype(np.float32)))
+    ims.append(scipy.sparse.csr_matrix((np.ones(4, dtype=np.float32), ([20] * 4, [30, 31, 32, 33])), shape=(H, W)))  ## 1D image
+    remap = np.stack([xx + 2.3 + 1.5 * np.sin(yy / 10), yy - 1.7 + np.cos(xx / 12)], axis=-1).astype(np.float32)
+    remap[:4, :4] = np.nan
+
+    for method in ['linear', 'cubic']:
+        kwargs = dict(ims_sparse=ims, remappingIdx=remap, method=method, fill_value=0, dtype=np.float32, safe=True, n_workers=2, verbose=False)
+        out_full = helpers.remap_sparse_images(query_local=False, **kwargs)
+        out_local = helpers.remap_sparse_images(query_local=True, **kwargs)
+        out_stacked = helpers.remap_sparse_images(query_local=True, batch_size=3, return_stacked=True, **kwargs)
+        for a, b in zip(out_full, out_local):
+            assert a.shape == b.shape and a.dtype == b.dtype
+            assert np.array_equal(a.indptr, b.indptr) and np.array_equal(a.indices, b.indices) and np.array_equal(a.data, b.data)
+        assert out_stacked.shape == (len(ims), H * W)
+        assert np.array_equal(out_stacked.toarray(), np.stack([a.toarray().reshape(-1) for a in out_full], axis=0))
+
+
+def test_make_remapping_operator(monkeypatch):
+    """
+    Test that the sparse remapping operator matches remap_images, that
+    sessions with the same remapping share an operator, and that the
+    operators are not kept on the Aligner.
+    """
+    from roicat.tracking.alignment import Aligner
+
+    rng = np.random.default_rng(0)
+    H, W = 48, 64
+    yy, xx = np.mgrid[:H, :W].astype(np.float32)
+    remap = np.stack([xx + 2.3 + 1.5 * np.sin(yy / 10), yy - 1.7 + np.cos(xx / 12)], axis=-1).astype(np.float32)
+    im = rng.random((H, W)).astype(np.float32)
+    for method in ['nearest', 'linear', 'cubic']:
+        op = helpers.make_remapping_operator(remappingIdx=remap, method=method)
+        expected = np.asarray(helpers.remap_images(im, remap, backend='torch', interpolation_method=method))
+        np.testing.assert_allclose((op @ im.reshape(-1)).reshape(H, W), expected, atol=1e-4)
+
+    rois = []
+    for _ in range(2):
+        ims = []
+        for c in rng.uniform([6, 6], [H - 6, W - 6], size=(15, 2)):
+            roi = np.exp(-((yy - c[0])**2 + (xx - c[1])**2) / (2 * 2.5**2))
+            roi[roi < 0.05] = 0
+            ims.append(roi.reshape(-1))
+        rois.append(scipy.sparse.csr_matrix(np.stack(ims, axis=0).astype(np.float32)))
+    aligner = Aligner(verbose=False)
+    out_griddata = aligner.transform_ROIs(ROIs=rois, remappingIdx=[remap, remap * 1.01], interpolation_method='griddata')
+    out_cubic = aligner.transform_ROIs(ROIs=rois, remappingIdx=[remap, remap * 1.01], interpolation_method='cubic')
+    ## The (H * W, H * W) operators must not be saved with the Aligner
+    assert not any(scipy.sparse.issparse(val) and val.shape == (H * W, H * W) for val in helpers.flatten_dict(aligner.__dict__).values())
+    operators = aligner.get_remapping_operators(remappingIdx=[remap, remap * 1.01, remap], method='cubic')
+    assert len(operators) == 3 and operators[0] is operators[2] and operators[0] is not operators[1]
+
+    ## A later re-warp reuses the operators instead of building them again
+    operators = aligner.get_remapping_operators(remappingIdx=[remap, remap * 1.01], method='cubic')
+    def make_remapping_operator_fail(*args, **kwargs):
+        raise AssertionError('ROICaT Error: operators were rebuilt instead of reused')
+    monkeypatch.setattr(helpers, 'make_remapping_operator', make_remapping_operator_fail)
+    out_reused = aligner.transform_ROIs(ROIs=rois, remappingIdx=[remap, remap * 1.01], interpolation_method='cubic', operators=operators)
+    for a, b in zip(out_cubic, out_reused):
+        np.testing.assert_array_equal(a.toarray(), b.toarray())
+    for a, b in zip(out_griddata, out_cubic):
+        assert a.shape == b.shape == (15, H * W)
+        np.testing.assert_allclose(np.asarray(b.sum(1)).squeeze(), 1, rtol=1e-4)
+        assert np.corrcoef(a.toarray().ravel(), b.toarray().ravel())[0, 1] > 0.99
+
+
+def test_score_alignment_batched():
+    """
+    Test that tiling the all-to-all alignment scoring does not change the
+    scores, and that the phase correlation images are only returned on
+    request.
+    """
+    rng = np.random.default_rng(0)
+    H, W = 64, 80
+    base = rng.random((H, W)).astype(np.float32)
+    ims = np.stack([np.roll(base, (ii, 2 * ii), axis=(0, 1)) + 0.3 * rng.random((H, W)).astype(np.float32) for ii in range(5)], axis=0)
+    iac = helpers.ImageAlignmentChecker(hw=(H, W), radius_in=4, radius_out=20, order=5)
+
+    out_full = iac.score_alignment(images=ims, batch_size=len(ims)**2, return_pc=True)
+    assert out_full['pc'].shape == (5, 5, H, W)
+    for batch_size in [1, 3, 7]:
+        out = iac.score_alignment(images=ims, batch_size=batch_size)
+        assert 'pc' not in out
+        for k, val in out.items():
+            assert val.shape == (5, 5)
+            np.testing.assert_allclose(val, out_full[k], rtol=1e-5, atol=1e-9)  ## batched inverse FFTs differ at float precision
+    out_ref = iac.score_alignment(images=ims, images_ref=ims[:2], batch_size=3)
+    np.testing.assert_allclose(out_ref['z_in'], out_full['z_in'][:, :2], rtol=1e-5)
+
+
+def test_spectrum_cache():
+    """
+    Test that cached spectra give the same phase correlation as computing
+    them anew, that they are reused, and that the LRU memory cap holds.
+    """
+    rng = np.random.default_rng(0)
+    H, W = 32, 48
+    ims = rng.random((4, H, W)).astype(np.float32)
+    mask = helpers.make_2D_frequency_filter(hw=(H, W), low=2, high=10)
+
+    cache = helpers.SpectrumCache()
+    for mask_fft in [None, mask]:
+        expected = helpers.phase_correlation(ims[None, :2], ims[:, None], mask_fft=mask_fft)
+        for _ in range(2):
+            np.testing.assert_array_equal(helpers.phase_correlation(ims[None, :2], ims[:, None], mask_fft=mask_fft, cache_fft=cache), expected)
+    assert cache.n_misses == 4
+    assert cache.n_hits == 4 * 6 - 4
+    ## Cached spectra must not be modified by the mask
+    np.testing.assert_allclose(cache.rfft2(torch.as_tensor(ims)).numpy(), torch.fft.rfft2(torch.as_tensor(ims)).numpy(), rtol=1e-5, atol=1e-4)
+
+    nbytes = H * (W // 2 + 1) * 8
+    cache = helpers.SpectrumCache(max_bytes=nbytes * 2)
+    cache.rfft2(torch.as_tensor(ims[:3]))
+    assert len(cache._spectra) == 2 and cache._nbytes == nbytes * 2
+    cache.rfft2(torch.as_tensor(ims[2]))
+    assert cache.n_hits == 1
+    cache.rfft2(torch.as_tensor(ims[0] + 1))
+    assert cache.n_misses == 4
+
+
+def test_aligner_richfile_roundtrip(tmp_path):
+    """
+    Test that a fitted Aligner, including its cache of image spectra, can be
+    saved and loaded with RichFile_ROICaT.
+    """
+    import scipy.ndimage
+    from roicat.tracking import alignment
+
+    rng = np.random.default_rng(0)
+    base = scipy.ndimage.gaussian_filter(rng.random((64, 64)), 2).astype(np.float32)
+    ims = [np.roll(base, (ii, -ii), axis=(0, 1)) + 0.1 * rng.random((64, 64)).astype(np.float32) for ii in range(3)]
+
+    aligner = alignment.Aligner(verbose=False)
+    aligner.fit_geometric(template=0, ims_moving=ims, template_method='image', method='PhaseCorrelation', verbose=False)
+    aligner.transform_images_geometric(ims)
+    aligner.fit_nonrigid(template=0, ims_moving=aligner.ims_registered_geo, remappingIdx_init=aligner.remappingIdx_geo, template_method='image', method='OpticalFlowFarneback')
+    aligner.transform_images_nonrigid(ims)
+
+    path = str(tmp_path / 'aligner.richfile')
+    util.RichFile_ROICaT(path=path).save(obj=aligner.__dict__, overwrite=True)
+    loaded = util.RichFile_ROICaT(path=path).load()
+    assert isinstance(loaded['_cache_fft'], helpers.SpectrumCache)
+    assert len(loaded['_cache_fft']._spectra) == 0
+    assert loaded['_cache_fft'].max_bytes == aligner._cache_fft.max_bytes
+    np.testing.assert_array_equal(loaded['remappingIdx_nonrigid'], aligner.remappingIdx_nonrigid)
+
+
+def test_fit_geometric_pairwise_parallel():
+    """
+    Test that the all-to-all search of Aligner.fit_geometric gives the same
+    warps with a process pool as serially, and that each pair of images is
+    registered in only one direction when the first one aligns.
+    """
+    import scipy.ndimage
+    from roicat.tracking import alignment
+
+    rng = np.random.default_rng(0)
+    base = scipy.ndimage.gaussian_filter(rng.random((96, 96)), 2).astype(np.float32)
+    ims = [np.roll(base, (int(rng.integers(-6, 6)), int(rng.integers(-6, 6))), axis=(0, 1)) + 0.2 * rng.random((96, 96)).astype(np.float32) for _ in range(4)]
+
+    n_calls = []
+    fit_rigid = alignment.PhaseCorrelationRegistration.fit_rigid
+    def fit_rigid_counted(self, *args, **kwargs):
+        n_calls.append(1)
+        return fit_rigid(self, *args, **kwargs)
+
+    warps = {}
+    for n_workers in [1, 2]:
+        aligner = alignment.Aligner(all_to_all=True, verbose=False)
+        if n_workers == 1:
+            alignment.PhaseCorrelationRegistration.fit_rigid = fit_rigid_counted
+        try:
+            aligner.fit_geometric(template=0, ims_moving=ims, template_method='image', method='PhaseCorrelation', n_workers=n_workers, verbose=False)
+        finally:
+            alignment.PhaseCorrelationRegistration.fit_rigid = fit_rigid
+        assert aligner.results_geometric['final']['alignment_template_to_all'].all()
+        warps[n_workers] = np.stack(aligner.results_geometric['warp_matrices'], axis=0)
+    ## 4 registrations to the template, then 4 * 3 / 2 pairs
+    assert len(n_calls) == 4 + 6
+    np.testing.assert_array_equal(warps[1], warps[2])